@@ -8,13 +8,17 @@ import argparse
 import csv
 import numpy as np
 import os
+import sys
 import time
 
 from autocorrect import spell
-from nltk.metrics import edit_distance
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))  # shared modules
+from scoring import error_rates
+from vocab_index import VocabIndex, closest_words
 
-def cer_from_transcripts(transcripts, ys, log_path=None, truncate=True):
+
+def cer_from_transcripts(transcripts, ys, log_path=None, truncate=True, processes=1):
     '''
     Args:
         transcripts: list of strings
@@ -23,32 +27,17 @@ def cer_from_transcripts(transcripts, ys, log_path=None, truncate=True):
         norm_dists: list of CER values
         dist: edit distances
     '''
-    norm_dists = []
-    dists = []
-    for i, t in enumerate(transcripts):
-        curr_t = t
-        curr_y = ys[i]
-        if len(curr_y) == 0:
+    for i, y in enumerate(ys[:len(transcripts)]):
+        if len(y) == 0:
             print('%d is 0' % i)
-        curr_t_nos = curr_t.replace(' ', '')
-        curr_y_nos = curr_y.replace(' ', '')
-        if truncate:
-            curr_t = curr_t[:len(curr_y)]
-            curr_t_nos = curr_t_nos[:len(curr_y_nos)]
-        dist = edit_distance(curr_t, curr_y)
-        norm_dist = dist / len(curr_y)
-        dist_nos = edit_distance(curr_t_nos, curr_y_nos)
-        norm_dist_nos = dist_nos / len(curr_y_nos)
-        best_dist = min(dist, dist_nos)
-        best_norm = min(norm_dist, norm_dist_nos)
-        if log_path is not None:
-            with open(log_path, 'a') as ouf:
+    norm_dists, dists = error_rates(transcripts, ys, truncate=truncate, processes=processes)
+    if log_path is not None:
+        with open(log_path, 'a') as ouf:
+            for best_dist, best_norm in zip(dists, norm_dists):
                 ouf.write('dist: %.2f, norm_dist: %.2f\n' % (best_dist, best_norm))
-        norm_dists.append(best_norm)
-        dists.append(best_dist)
     return norm_dists, dists
 
-def get_cer(transcripts_file, save_dir='output/baseline/v1'):
+def get_cer(transcripts_file, save_dir='output/baseline/v1', processes=1):
     '''
     Args:
         transcripts_file: .csv file containing transcripts
@@ -69,14 +58,14 @@ def get_cer(transcripts_file, save_dir='output/baseline/v1'):
 
     transcripts = [l.strip() for l in transcripts]
     cer_log_path = os.path.join(save_dir, 'cer_log.txt')
-    norm_dists, dists = cer_from_transcripts(transcripts, test_ys, log_path=cer_log_path)
+    norm_dists, dists = cer_from_transcripts(transcripts, test_ys, log_path=cer_log_path, processes=processes)
 
     cers_path = os.path.join(save_dir, 'cers.npy')
     np.save(cers_path, norm_dists)
     
     print('avg CER:', np.mean(norm_dists))
 
-def get_topk_cer(beam_file, save_dir='output/baseline/beam'):
+def get_topk_cer(beam_file, save_dir='output/baseline/beam', processes=1):
     '''
     Args:
         beam_file: .csv file containing beam results
@@ -112,7 +101,7 @@ def get_topk_cer(beam_file, save_dir='output/baseline/beam'):
     print('computing CER for all test samples (at %.2f seconds)' % (t1-t0))
 
     CER_LOG_PATH = os.path.join(save_dir, 'cer_log.txt')
-    raw_norm_dists, raw_dists = cer_from_transcripts(raw_beams, test_ys_rep, log_path=CER_LOG_PATH)
+    raw_norm_dists, raw_dists = cer_from_transcripts(raw_beams, test_ys_rep, log_path=CER_LOG_PATH, processes=processes)
     CER_PATH = os.path.join(save_dir, 'test_cer.npy')
     DIST_PATH = os.path.join(save_dir, 'test_dist.npy')
     raw_norm_dists = np.array(raw_norm_dists)
@@ -158,53 +147,14 @@ def closest_word(word, vocab, threshold=5, sub_thres=2):
     '''Finds closest word in the vocabulary (w.r.t. edit distance)
 
     Returns 2 words if no closest word found
+
+    Args:
+        vocab: set of words, or a VocabIndex built from one (much faster
+            when looking up many words)
     '''
-    best_word = word
-    best_dist = float("inf")
-    prefix_len_best = float("inf")
-    for vocab_word in vocab:
-        curr_dist = edit_distance(word, vocab_word)
-        if curr_dist < best_dist:
-            best_dist = curr_dist
-            best_word = vocab_word
-            prefix_len_best = len(os.path.commonprefix([word, vocab_word]))
-        elif curr_dist == best_dist and abs(len(best_word)-len(word)) > abs(len(vocab_word)-len(word)):
-            prefix_len_vocab = len(os.path.commonprefix([word, vocab_word]))
-            if prefix_len_best < prefix_len_vocab:
-                best_word = vocab_word
-                prefix_len_best = prefix_len_vocab
-    if best_dist > 5: # margin of error is sub_thres for each subword
-        for i in range(len(word)-1):
-            word1 = word[:i+1]
-            word2 = word[i+1:]
-            curr_dist = float("inf")
-            vocab_word1 = word1
-            for vocab_word in vocab:
-                if word1 == vocab_word:
-                    vocab_word1 = vocab_word
-                    curr_dist = 0
-                    break
-                dist1 = edit_distance(word1, vocab_word)
-                if dist1 < curr_dist:
-                    vocab_word1 = vocab_word
-                    curr_dist = dist1
-            vocab_word2 = word2
-            if curr_dist <= sub_thres:
-                curr_dist2 = float("inf")
-                for vocab_word in vocab:
-                    if word2 == vocab_word:
-                        vocab_word2 = vocab_word
-                        curr_dist2 = 0
-                        break
-                    dist2 = edit_distance(word2, vocab_word)
-                    if dist2 < curr_dist2:
-                        vocab_word2 = vocab_word
-                        curr_dist2 = dist2
-                curr_dist += curr_dist2
-                if curr_dist < best_dist:
-                    best_word = vocab_word1+' '+vocab_word2
-                    best_dist = curr_dist
-    return best_word
+    if not isinstance(vocab, VocabIndex):
+        vocab = VocabIndex(vocab)
+    return vocab.closest_word(word, threshold=threshold, sub_thres=sub_thres)
 
 def mk_map(vocab):
     '''
@@ -238,7 +188,7 @@ def map_lines(lines, wmap):
         new_lines.append(new_l)
     return new_lines
 
-def get_wer(transcripts_file, save_dir='output/baseline/v1'):
+def get_wer(transcripts_file, save_dir='output/baseline/v1', processes=1):
     '''
     Args:
         transcripts_file: .csv file containing transcripts
@@ -272,6 +222,9 @@ def get_wer(transcripts_file, save_dir='output/baseline/v1'):
         print('generating transcripts (at %.2f seconds)' % (t1-t0))
 
         transcript_lists = [l.split() for l in transcripts]
+        index = VocabIndex.load_or_build(test_vocab, save_dir)
+        oov_words = sorted(set(w for l_list in transcript_lists for w in l_list if w not in test_vocab))
+        prox_words = dict(zip(oov_words, closest_words(index, oov_words, processes=processes)))
 
         new_transcripts_autoc = []
         new_transcripts_prox = []
@@ -286,7 +239,7 @@ def get_wer(transcripts_file, save_dir='output/baseline/v1'):
                 new_ap_word = w
                 if w not in test_vocab:
                     new_a_word = spell(w)
-                    new_p_word = closest_word(w, test_vocab)
+                    new_p_word = prox_words[w]
                 if new_a_word in test_vocab:
                     new_ap_word = new_a_word
                 else:
@@ -354,7 +307,7 @@ def get_wer(transcripts_file, save_dir='output/baseline/v1'):
     PROX_WER_LOG_PATH = os.path.join(save_dir, 'prox_wer_log.txt')
     PROX_WER_PATH = os.path.join(save_dir, 'prox_wer.npy')
     PROX_DIST_PATH = os.path.join(save_dir, 'prox_dist.npy')
-    prox_norm_dists, prox_dists = cer_from_transcripts(transcripts_prox_uni, test_ys_uni, PROX_WER_LOG_PATH)
+    prox_norm_dists, prox_dists = cer_from_transcripts(transcripts_prox_uni, test_ys_uni, PROX_WER_LOG_PATH, processes=processes)
     np.save(PROX_WER_PATH, prox_norm_dists)
     np.save(PROX_DIST_PATH, prox_dists)
     print('prox avg wer:', np.mean(prox_norm_dists))
@@ -366,7 +319,7 @@ def get_wer(transcripts_file, save_dir='output/baseline/v1'):
     AUTOC_PROX_WER_LOG_PATH = os.path.join(save_dir, 'autoc_prox_wer_log.txt')
     AUTOC_PROX_WER_PATH = os.path.join(save_dir, 'autoc_prox_wer.npy')
     AUTOC_PROX_DIST_PATH = os.path.join(save_dir, 'autoc_prox_dist.npy')
-    autoc_prox_norm_dists, autoc_prox_dists = cer_from_transcripts(transcripts_autoc_prox_uni, test_ys_autoc_prox_uni, AUTOC_PROX_WER_LOG_PATH)
+    autoc_prox_norm_dists, autoc_prox_dists = cer_from_transcripts(transcripts_autoc_prox_uni, test_ys_autoc_prox_uni, AUTOC_PROX_WER_LOG_PATH, processes=processes)
     np.save(AUTOC_PROX_WER_PATH, autoc_prox_norm_dists)
     np.save(AUTOC_PROX_DIST_PATH, autoc_prox_dists)
     print('autoc prox avg wer:', np.mean(autoc_prox_norm_dists))
@@ -388,7 +341,7 @@ def get_wer(transcripts_file, save_dir='output/baseline/v1'):
     AUTOC_WER_LOG_PATH = os.path.join(save_dir, 'autoc_wer_log.txt')
     AUTOC_WER_PATH = os.path.join(save_dir, 'autoc_wer.npy')
     AUTOC_DIST_PATH = os.path.join(save_dir, 'autoc_dist.npy')
-    autoc_norm_dists, autoc_dists = cer_from_transcripts(transcripts_autoc_uni, test_ys_autoc_uni, AUTOC_WER_LOG_PATH)
+    autoc_norm_dists, autoc_dists = cer_from_transcripts(transcripts_autoc_uni, test_ys_autoc_uni, AUTOC_WER_LOG_PATH, processes=processes)
     np.save(AUTOC_WER_PATH, autoc_norm_dists)
     np.save(AUTOC_DIST_PATH, autoc_dists)
     print('autoc avg wer:', np.mean(autoc_prox_norm_dists))
@@ -400,17 +353,18 @@ def parse_args():
     parser.add_argument('--file', type=str, default='submission.csv', help='csv file with transcripts')
     parser.add_argument('--save-directory', type=str, default='output/baseline/v1', help='output directory')
     parser.add_argument('--mode', type=str, default='wer', help='wer, cer, or topk')
+    parser.add_argument('--processes', type=int, default=1, metavar='N', help='worker processes for edit distances')
     return parser.parse_args()
 
 def main():
     args = parse_args()
 
     if args.mode == 'wer':
-        get_wer(args.file, save_dir=args.save_directory)
+        get_wer(args.file, save_dir=args.save_directory, processes=args.processes)
     elif args.mode == 'cer':
-        get_cer(args.file, save_dir=args.save_directory)
+        get_cer(args.file, save_dir=args.save_directory, processes=args.processes)
     else:
-        get_topk_cer(args.file, save_dir=args.save_directory)
+        get_topk_cer(args.file, save_dir=args.save_directory, processes=args.processes)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -15,12 +15,15 @@ peterw1@andrew.cmu.edu
 import itertools
 import os
 import numpy as np
+import sys
 import torch
 
-from nltk.metrics import edit_distance
 from torch.autograd import Variable
 from torch.utils.data import DataLoader, Dataset
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))  # shared modules
+from scoring import edit_distances, error_rates
+
 def output_mask(maxlen, lengths):
     """
     Create a mask on-the-fly
@@ -145,46 +148,27 @@ def cer(args, model, loader, charset, ys, truncate=True, device=0):
         number
     '''
     model.eval()
-    norm_dists = []
-    transcripts = generate_transcripts(args, model, loader, charset, device=device)
-    for i, t in enumerate(transcripts):
-        if truncate:
-            dist = edit_distance(t[:len(ys[i])], ys[i])
-        else:
-            dist = edit_distance(t, ys[i])
-        norm_dist = dist / len(ys[i])
-        norm_dists.append(norm_dist)
+    transcripts = list(generate_transcripts(args, model, loader, charset, device=device))
+    if truncate:
+        transcripts = [t[:len(ys[i])] for i, t in enumerate(transcripts)]
+    dists = edit_distances(transcripts, ys[:len(transcripts)])
+    norm_dists = [d / len(y) for d, y in zip(dists, ys)]
     return sum(norm_dists)/len(ys)
 
-def cer_from_transcripts(transcripts, ys, log_path, truncate=True, spaces='best'):
+def cer_from_transcripts(transcripts, ys, log_path, truncate=True, spaces='best', processes=1):
     '''
     Return:
         norm_dists: list of CER values
         dist: edit distances
         spaces: no, yes, best (to account for incongruity in raw data spacing)
     '''
-    norm_dists = []
-    dists = []
-    for i, t in enumerate(transcripts):
-        curr_t = t
-        curr_y = ys[i]
-        if len(curr_y) == 0:
+    for i, y in enumerate(ys[:len(transcripts)]):
+        if len(y) == 0:
             print('%d is 0' % i)
-        curr_t_nos = curr_t.replace(' ', '')
-        curr_y_nos = curr_y.replace(' ', '')
-        if truncate:
-            curr_t = curr_t[:len(curr_y)]
-            curr_t_nos = curr_t_nos[:len(curr_y_nos)]
-        dist = edit_distance(curr_t, curr_y)
-        norm_dist = dist / len(curr_y)
-        dist_nos = edit_distance(curr_t_nos, curr_y_nos)
-        norm_dist_nos = dist_nos / len(curr_y_nos)
-        best_dist = min(dist, dist_nos)
-        best_norm = min(norm_dist, norm_dist_nos)
-        with open(log_path, 'a') as ouf:
+    norm_dists, dists = error_rates(transcripts, ys, truncate=truncate, spaces=spaces, processes=processes)
+    with open(log_path, 'a') as ouf:
+        for best_dist, best_norm in zip(dists, norm_dists):
             ouf.write('dist: %.2f, norm_dist: %.2f\n' % (best_dist, best_norm))
-        norm_dists.append(best_norm)
-        dists.append(best_dist)
     return norm_dists, dists
 
 def print_log(s, log_path):
@@ -16,12 +16,12 @@ import time
 import torch
 
 from autocorrect import spell
-from nltk.metrics import edit_distance
 from torch.autograd import Variable
 from torch.utils.data import DataLoader, Dataset
 
 from baseline import parse_args, Seq2SeqModel, write_transcripts
 from model_utils import *
+from vocab_index import VocabIndex, closest_words
 
 
 def is_chinese_char(ch):
@@ -48,54 +48,14 @@ def closest_word(word, vocab, threshold=5, sub_thres=2):
     '''Finds closest word in the vocabulary (w.r.t. edit distance)
 
     Returns 2 words if no closest word found
-    '''
-    best_word = word
-    best_dist = float("inf")
-    prefix_len_best = float("inf")
-    for vocab_word in vocab:
-        curr_dist = edit_distance(word, vocab_word)
-        if curr_dist < best_dist:
-            best_dist = curr_dist
-            best_word = vocab_word
-            prefix_len_best = len(os.path.commonprefix([word, vocab_word]))
-        elif curr_dist == best_dist and abs(len(best_word)-len(word)) > abs(len(vocab_word)-len(word)):
-            prefix_len_vocab = len(os.path.commonprefix([word, vocab_word]))
-            if prefix_len_best < prefix_len_vocab:
-                best_word = vocab_word
-                prefix_len_best = prefix_len_vocab
-    if best_dist > 5: # margin of error is sub_thres for each subword
-        for i in range(len(word)-1):
-            word1 = word[:i+1]
-            word2 = word[i+1:]
-            curr_dist = float("inf")
-            vocab_word1 = word1
-            for vocab_word in vocab:
-                if word1 == vocab_word:
-                    vocab_word1 = vocab_word
-                    curr_dist = 0
-                    break
-                dist1 = edit_distance(word1, vocab_word)
-                if dist1 < curr_dist:
-                    vocab_word1 = vocab_word
-                    curr_dist = dist1
-            vocab_word2 = word2
-            if curr_dist <= sub_thres:
-                curr_dist2 = float("inf")
-                for vocab_word in vocab:
-                    if word2 == vocab_word:
-                        vocab_word2 = vocab_word
-                        curr_dist2 = 0
-                        break
-                    dist2 = edit_distance(word2, vocab_word)
-                    if dist2 < curr_dist2:
-                        vocab_word2 = vocab_word
-                        curr_dist2 = dist2
-                curr_dist += curr_dist2
-                if curr_dist < best_dist:
-                    best_word = vocab_word1+' '+vocab_word2
-                    best_dist = curr_dist
-    return best_word
 
+    Args:
+        vocab: set of words, or a VocabIndex built from one (much faster
+            when looking up many words)
+    '''
+    if not isinstance(vocab, VocabIndex):
+        vocab = VocabIndex(vocab)
+    return vocab.closest_word(word, threshold=threshold, sub_thres=sub_thres)
 
 def mk_map(vocab):
     '''
@@ -143,7 +103,7 @@ def map_lines(lines, wmap):
         new_lines.append(new_l)
     return new_lines
 
-def get_mer(save_dir='output/baseline/v1'):
+def get_mer(save_dir='output/baseline/v1', processes=1):
     t0 = time.time()
     test_ys = load_y_data('test') # 1-dim np array of strings
     CSV_PATH = os.path.join(save_dir, 'submission.csv')
@@ -214,6 +174,10 @@ def get_mer(save_dir='output/baseline/v1'):
                 test_eng_vocab.add(word)
 
         transcripts_spaced_lists = [l.split() for l in transcripts_spaced]
+        index = VocabIndex.load_or_build(test_eng_vocab, save_dir)
+        oov_words = sorted(set(w for l_list in transcripts_spaced_lists for w in l_list
+                               if not is_chinese_char(w[0]) and w not in test_eng_vocab))
+        prox_words = dict(zip(oov_words, closest_words(index, oov_words, processes=processes)))
 
         new_transcripts_autoc = []
         new_transcripts_prox = []
@@ -229,7 +193,7 @@ def get_mer(save_dir='output/baseline/v1'):
                     new_ap_word = w
                     if w not in test_eng_vocab:
                         new_a_word = spell(w)
-                        new_p_word = closest_word(w, test_eng_vocab)
+                        new_p_word = prox_words[w]
                     if new_a_word in test_eng_vocab:
                         new_ap_word = new_a_word
                     else:
@@ -412,12 +376,13 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--save-directory', type=str, default='output/baseline/v1', help='output directory')
     parser.add_argument('--mode', type=str, default='mer', help='mer or topk')
+    parser.add_argument('--processes', type=int, default=1, metavar='N', help='worker processes for vocabulary lookups')
     return parser.parse_args()
 
 def main():
     args = parse_args()
     if args.mode == 'mer':
-        get_mer(save_dir=args.save_directory)
+        get_mer(save_dir=args.save_directory, processes=args.processes)
     else:
         get_topk_cer()
 
@@ -14,6 +14,8 @@ import sys
 import time
 import torch
 
+import torch.nn.functional as F
+
 from torch import nn
 from torch.autograd import Variable
 from torch.nn.utils.rnn import PackedSequence
@@ -475,11 +477,11 @@ class TextDiscriminator(nn.Module):
     def __init__(self):
         super(TextDiscriminator, self).__init__()
         self.cnn = nn.Sequential(
-            nn.Conv1d(1, 64, 3),
-            nn.BatchNorm2d(64),
+            nn.Conv1d(1, 64, 3, padding=1),
+            nn.BatchNorm1d(64),
             nn.LeakyReLU(0.2),
-            nn.Conv1d(1, 128, 3),
-            nn.BatchNorm2d(128),
+            nn.Conv1d(64, 128, 3, padding=1),
+            nn.BatchNorm1d(128),
             nn.LeakyReLU(0.2)
         )
         self.mlp = nn.Sequential(
@@ -491,13 +493,13 @@ class TextDiscriminator(nn.Module):
     def forward(self, x):
         '''
         Args:
-            x: shape (max_seq_len, batch_size), all values 0 or 1
+            x: shape (max_seq_len, batch_size), values in [0, 1] (LIDs or LID posteriors)
         '''
         x = x.transpose(0, 1) # shape: (batch_size, max_seq_len)
         x = x.unsqueeze(1)    # shape: (batch_size, 1, max_seq_len)
         h = self.cnn(x)       # shape: (batch_size, 128, seq_len)
         h = F.max_pool1d(h, kernel_size=h.shape[2]) # shape: (batch_size, 128, 1)
-        h = h.squeeze()       # shape: (batch_size, 128)
+        h = h.squeeze(2)      # shape: (batch_size, 128)
         out = self.mlp(h)     # shape: (batch_size, 2)
         return out
 
@@ -514,6 +516,18 @@ class Seq2SeqModel(nn.Module):
         logits, attns, generated = self.decoder.forward_lid(chars, char_lengths, keys, values, lengths, future=future)
         return logits, generated, char_lengths
 
+    def forward_multitask(self, utterances, utterance_lengths, chars, char_lengths):
+        '''Runs the encoder once and fans its output out to the character and LID decoders
+
+        Return:
+            prediction: (logits, generated, char_lengths) for characters
+            prediction_lid: (logits, generated, char_lengths) for language IDs
+        '''
+        _, keys, values, lengths = self.encoder(utterances, utterance_lengths)
+        logits, _, generated = self.decoder(chars, char_lengths, keys, values, lengths)
+        lid_logits, _, lid_generated = self.decoder.forward_lid(chars, char_lengths, keys, values, lengths)
+        return (logits, generated, char_lengths), (lid_logits, lid_generated, char_lengths)
+
     def forward_discr(self, x, x_p):
         '''inputs are actual and generated text'''
         out = self.text_discr(x)
@@ -621,6 +635,13 @@ def parse_args():
     parser.add_argument('--key-dim', type=int, default=128, metavar='N', help='hidden dimension')
     parser.add_argument('--generator-length', type=int, default=250, metavar='N', help='maximum length to generate')
 
+    parser.add_argument('--multitask-mode', type=str, default='joint', choices=['joint', 'alternate'], help='joint: one backward over weighted losses, alternate: one step per head from the shared encoder pass')
+    parser.add_argument('--asr-weight', type=float, default=1.0, metavar='N', help='character decoder loss weight')
+    parser.add_argument('--lid-weight', type=float, default=1.0, metavar='N', help='LID decoder loss weight')
+    parser.add_argument('--gen-weight', type=float, default=1.0, metavar='N', help='generator (adversarial LID) loss weight')
+    parser.add_argument('--discr-weight', type=float, default=1.0, metavar='N', help='discriminator loss weight')
+    parser.add_argument('--discr-every', type=int, default=1, metavar='N', help='update the discriminator every N batches')
+
     parser.add_argument('--test-mode', type=str, default='transcript', help='Test mode: transcript, cer, perp')
 
     return parser.parse_args()
@@ -679,7 +700,9 @@ def main():
 
     print("Building Model")
     model = Seq2SeqModel(args, vocab_size=charcount)
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    asr_params = [p for n, p in model.named_parameters() if not n.startswith('text_discr.')]
+    optimizer = torch.optim.Adam(asr_params, lr=args.lr, weight_decay=args.weight_decay)
+    optim_discr = torch.optim.Adam(model.text_discr.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     discr_loss = DiscrLoss()
     gen_loss = GenLoss()
     seq_cross_entropy = SequenceCrossEntropy()
@@ -718,42 +741,44 @@ def main():
                         ulens.cuda(), y1array.cuda(), ylens.cuda(), y2array.cuda(), \
                         lid1_arr.cuda(), lid2_arr.cuda()
                 
-                optimizer.zero_grad()
-                prediction = model(uarray, ulens, y1array, ylens)
+                prediction, prediction_lid = model.forward_multitask(uarray, ulens, y1array, ylens)
                 logits, _, char_lengths = prediction
                 perp = perplexity(logits, y2array, char_lengths)
                 tot_perp += perp.item()
                 loss_asr = seq_cross_entropy(prediction, y2array)
                 tot_loss_asr += loss_asr.item()
-                loss_asr.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                optimizer.step()
-
-                optimizer.zero_grad()
-                prediction_lid = model.forward_lid(uarray, ulens, y1array, ylens)
                 loss_lid = seq_cross_entropy(prediction_lid, lid2_arr)
                 tot_loss_lid += loss_lid.item()
-                loss_lid.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                optimizer.step()
-
-                optimizer.zero_grad() # train discriminator
-                out, out_p = model.forward_discr(prediction, y2array)
-                loss_discr = discr_loss(out, out_p)
-                loss_discr.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                optim_discr.step()
-                tot_discr_loss += loss_discr.item()
-
-                optim_gen.zero_grad() # train generator
-                loss_gen = gen_loss(out_p)
-                loss_gen.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                optim_gen.step()
-                tot_gen_loss += loss_gen.item()
 
-                loss = loss_asr + loss_lid + loss_discr + loss_gen
-                tot_loss += loss.item()
+                # LID posteriors from the shared pass are the generator output
+                lid_mask = output_mask(lid2_arr.size(0), char_lengths.data).float()
+                real_lids = lid2_arr.float() * lid_mask
+                fake_lids = F.softmax(prediction_lid[0], 2)[:, :, 1] * lid_mask
+
+                discr_val = 0.0
+                if (i+1) % args.discr_every == 0: # train discriminator
+                    optim_discr.zero_grad()
+                    out, out_p = model.forward_discr(real_lids, fake_lids.detach())
+                    loss_discr = discr_loss(out, out_p)
+                    (args.discr_weight * loss_discr).backward()
+                    torch.nn.utils.clip_grad_norm_(model.text_discr.parameters(), 0.25)
+                    optim_discr.step()
+                    discr_val = loss_discr.item()
+                    tot_discr_loss += discr_val
+
+                loss_gen = gen_loss(model.text_discr(fake_lids)) # train generator
+                tot_gen_loss += loss_gen.item()
+                losses = [args.asr_weight * loss_asr, args.lid_weight * loss_lid, args.gen_weight * loss_gen]
+                if args.multitask_mode == 'alternate':
+                    alternating_step(optimizer, asr_params, losses)
+                else:
+                    optimizer.zero_grad()
+                    sum(losses).backward()
+                    torch.nn.utils.clip_grad_norm_(asr_params, 0.25)
+                    optimizer.step()
+
+                loss = loss_asr + loss_lid + loss_gen
+                tot_loss += loss.item() + discr_val
             if (i+1) % 100 == 0:
                 t1 = time.time()
                 print('Processed %d Batches (%.2f Seconds)' % (i+1, t1-t0))
@@ -33,6 +33,25 @@ def output_mask(maxlen, lengths):
     mask = ran < lens
     return mask
 
+def alternating_step(optimizer, params, losses, max_norm=0.25):
+    '''Applies one optimizer step per loss
+
+    All gradients are taken before any update, so the losses can share a single
+    forward pass (e.g. one encoder run feeding several heads)
+
+    Args:
+        params: list of parameters updated by optimizer
+        losses: list of scalar losses, stepped in order
+    '''
+    all_grads = [torch.autograd.grad(loss, params, retain_graph=True, allow_unused=True) for loss in losses]
+    for grads in all_grads:
+        optimizer.zero_grad()
+        for p, g in zip(params, grads):
+            if g is not None:
+                p.grad = g
+        torch.nn.utils.clip_grad_norm_(params, max_norm)
+        optimizer.step()
+
 def log_l(logits, target, lengths):
     '''Calculates the log-likelihood for the given batch
 
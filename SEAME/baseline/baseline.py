@@ -11,6 +11,7 @@ peterw1@andrew.cmu.edu
 '''
 
 import argparse
+import contextlib
 import csv
 import itertools
 import numpy as np
@@ -20,11 +21,14 @@ import time
 import torch
 
 from torch import nn
+from torch.nn.functional import log_softmax
 from torch.autograd import Variable
 from torch.nn.utils.rnn import PackedSequence
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
 
 from model_utils import *
+from scoring import batch_edit_distance
 
 
 class SequenceShuffle(nn.Module):
@@ -89,6 +93,23 @@ class EncoderModel(nn.Module):
         self.rnns.append(pLSTM(args.encoder_dim * 4, args.encoder_dim, bidirectional=True))
         self.key_projection = nn.Linear(args.encoder_dim * 2, args.key_dim)
         self.value_projection = nn.Linear(args.encoder_dim * 2, args.value_dim)
+        self.checkpoint_layers = set(args.checkpoint_encoder)
+
+    def run_rnn(self, i, h, hx=None):
+        '''Runs RNN layer i, recomputing its activations on backward if checkpointed
+
+        Return:
+            output sequence, or (output sequence, final states) if hx is given
+        '''
+        rnn = self.rnns[i]
+        if i in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+            # non-reentrant checkpointing accepts PackedSequence inputs and inputs without grad
+            if hx is None:
+                return checkpoint(lambda x: rnn(x)[0], h, use_reentrant=False)
+            return checkpoint(lambda x, h0, c0: rnn(x, (h0, c0)), h, hx[0], hx[1], use_reentrant=False)
+        if hx is None:
+            return rnn(h)[0]
+        return rnn(h, hx)
 
     def forward(self, utterances, utterance_lengths):
         '''Calculates keys and values
@@ -108,8 +129,8 @@ class EncoderModel(nn.Module):
         h = pack_padded_sequence(h, sorted_lengths.data.cpu().numpy())
 
         # RNNs
-        for rnn in self.rnns:
-            h, _ = rnn(h)
+        for i in range(len(self.rnns)):
+            h = self.run_rnn(i, h)
 
         # Unpack and unsort the sequences
         h, output_lengths = pad_packed_sequence(h)
@@ -127,6 +148,209 @@ class EncoderModel(nn.Module):
         return keys, values, output_lengths
 
 
+class StreamingEncoderModel(EncoderModel):
+    '''Latency-controlled version of EncoderModel, with the same parameters
+
+    Utterances are encoded in chunks of stream_chunk input frames. In every layer,
+    the forward direction continues from its state at the end of the previous
+    chunk, while the backward direction starts from the initial state at the end
+    of the chunk's stream_right_context look-ahead frames. Keys and values of a
+    chunk are final once its look-ahead has arrived, so batched training and
+    evaluation match incremental decoding (see streaming.py) exactly.
+    '''
+    def __init__(self, args):
+        super(StreamingEncoderModel, self).__init__(args)
+        self.min_frames = 2 ** (len(self.rnns) - 1)  # input frames per output frame
+        assert args.stream_chunk % self.min_frames == 0, 'stream-chunk must be a multiple of %d' % self.min_frames
+        self.chunk = args.stream_chunk
+        self.right_context = args.stream_right_context
+
+    def initial_states(self, n):
+        '''
+        Return:
+            size-4 list of forward direction (h, c) pairs, each shape (1, n, encoder_dim)
+        '''
+        return [tuple(s[:1] for s in rnn.initial_state(n)) for rnn in self.rnns]
+
+    def encode_chunk(self, window, window_lengths, chunk_lengths, states):
+        '''Runs all layers over one chunk of each utterance followed by its look-ahead
+
+        Each window is batched with a copy cut at the end of its chunk: the windows
+        give the outputs and the copies give the forward states at the chunk ends
+
+        Args:
+            window: shape (W, n, INPUT_DIM)
+            window_lengths: list of n ints, chunk and look-ahead frames
+            chunk_lengths: list of n ints, each at least min_frames
+            states: forward states at the chunk starts, as from initial_states
+
+        Return:
+            h: shape (C, n, 2*encoder_dim), look-ahead outputs past output_lengths
+            output_lengths: list of n ints
+            states: forward states at the chunk ends
+        '''
+        n = len(window_lengths)
+        lengths = torch.LongTensor(list(window_lengths) + list(chunk_lengths))
+        sorted_lengths, order = torch.sort(lengths, 0, descending=True)
+        _, backorder = torch.sort(order, 0)
+        order_d = order.to(window.device)
+        backorder_d = backorder.to(window.device)
+        h = torch.cat([window, window], 1)[:, order_d, :]
+        h = pack_padded_sequence(h, sorted_lengths)
+
+        new_states = []
+        for i, (rnn, (fh, fc)) in enumerate(zip(self.rnns, states)):
+            h0, c0 = rnn.initial_state(2 * n)
+            # carried forward state, fresh backward state
+            h0 = torch.cat([fh.repeat(1, 2, 1)[:, order_d, :], h0[1:]], 0)
+            c0 = torch.cat([fc.repeat(1, 2, 1)[:, order_d, :], c0[1:]], 0)
+            h, (hn, cn) = self.run_rnn(i, h, (h0, c0))
+            new_states.append((hn[:1, backorder_d[n:]], cn[:1, backorder_d[n:]]))
+
+        h, output_lengths = pad_packed_sequence(h)
+        output_lengths = output_lengths[backorder[n:]].tolist()
+        h = h[:max(output_lengths), backorder_d[:n], :]
+            # shape: (C, n, 2*encoder_dim)
+        return h, output_lengths, new_states
+
+    def forward(self, utterances, utterance_lengths):
+        '''Calculates keys and values chunk by chunk, batched over utterances
+
+        Trailing frames that are too few for an output frame only serve as
+        look-ahead, as they are dropped by the pyramid in EncoderModel
+
+        Return:
+            keys: shape (T, B, key_dim)
+            values: shape (T, B, value_dim)
+            output_lengths: shape (B,)
+        '''
+        lengths = utterance_lengths.tolist()
+        n = len(lengths)
+        stride = self.chunk // self.min_frames  # output frames per full chunk
+        states = self.initial_states(n)
+        hs = []
+        output_lengths = [0] * n
+        for start in range(0, max(lengths), self.chunk):
+            rows = [i for i in range(n) if lengths[i] - start >= self.min_frames]
+            if len(rows) == 0:
+                break
+            window_lengths = [min(lengths[i], start + self.chunk + self.right_context) - start for i in rows]
+            chunk_lengths = [min(lengths[i] - start, self.chunk) for i in rows]
+            idx = torch.LongTensor(rows).to(utterances.device)
+            window = utterances[start:start + max(window_lengths)].index_select(1, idx)
+            h, chunk_output_lengths, chunk_states = self.encode_chunk(
+                window, window_lengths, chunk_lengths, [(fh[:, idx], fc[:, idx]) for fh, fc in states])
+            states = [(fh.index_copy(1, idx, ch), fc.index_copy(1, idx, cc))
+                      for (fh, fc), (ch, cc) in zip(states, chunk_states)]
+            # only the last chunk of an utterance can be short, so padding each
+            # chunk to stride keeps every utterance's frames contiguous
+            h = torch.cat([h, h.new_zeros(stride - h.size(0), h.size(1), h.size(2))], 0)
+            hs.append(h.new_zeros(stride, n, h.size(2)).index_copy(1, idx, h))
+            for i, l in zip(rows, chunk_output_lengths):
+                output_lengths[i] += l
+        h = torch.cat(hs, 0)[:max(output_lengths)]
+            # shape: (T, B, 2*encoder_dim)
+        output_lengths = torch.LongTensor(output_lengths).to(utterances.device)
+
+        keys = self.key_projection(h)
+        values = self.value_projection(h)
+        return keys, values, output_lengths
+
+
+class PositionalEncoding(nn.Module):
+    # Adds fixed sinusoidal position information to (T, B, D) inputs
+    def __init__(self, dim, dropout=0.1, max_len=10000):
+        super(PositionalEncoding, self).__init__()
+        self.dropout = nn.Dropout(dropout)
+        position = torch.arange(0, max_len, dtype=torch.float32).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, dim, 2, dtype=torch.float32) * (-np.log(10000.0) / dim))
+        pe = torch.zeros(max_len, dim)
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
+        self.register_buffer('pe', pe.unsqueeze(1))  # (max_len, 1, D)
+
+    def forward(self, x):
+        return self.dropout(x + self.pe[:x.size(0)])
+
+
+class Conv2dSubsampling(nn.Module):
+    # Downsamples frames by 8 in time to match the three pLSTM layers
+    def __init__(self, out_dim, channels=32):
+        super(Conv2dSubsampling, self).__init__()
+        self.conv = nn.Sequential(
+            nn.Conv2d(1, channels, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(channels, channels, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(channels, channels, 3, stride=2, padding=1),
+            nn.ReLU()
+        )
+        freq_dim = INPUT_DIM
+        for _ in range(3):
+            freq_dim = (freq_dim - 1) // 2 + 1
+        self.out = nn.Linear(channels * freq_dim, out_dim)
+
+    def forward(self, x, lengths):
+        '''
+        Args:
+            x: shape (T, B, INPUT_DIM)
+            lengths: shape (B,)
+
+        Return:
+            h: shape (T', B, out_dim)
+            lengths: shape (B,)
+        '''
+        h = self.conv(x.transpose(0, 1).unsqueeze(1))
+            # shape: (B, C, T', F')
+        b, c, t, f = h.size()
+        h = self.out(h.permute(2, 0, 1, 3).contiguous().view(t, b, c * f))
+        for _ in range(3):
+            lengths = (lengths - 1) // 2 + 1
+        return h, lengths
+
+
+class TransformerEncoderModel(nn.Module):
+    # Self-attention alternative to EncoderModel with the same outputs
+    def __init__(self, args):
+        super(TransformerEncoderModel, self).__init__()
+        self.subsampling = Conv2dSubsampling(args.encoder_dim)
+        self.positional_encoding = PositionalEncoding(args.encoder_dim, dropout=args.encoder_dropout)
+        layer = nn.TransformerEncoderLayer(
+            args.encoder_dim, args.encoder_heads,
+            dim_feedforward=args.encoder_ff_dim, dropout=args.encoder_dropout)
+        self.layers = nn.TransformerEncoder(layer, args.encoder_layers)
+        self.key_projection = nn.Linear(args.encoder_dim, args.key_dim)
+        self.value_projection = nn.Linear(args.encoder_dim, args.value_dim)
+
+    def forward(self, utterances, utterance_lengths):
+        '''Calculates keys and values
+
+        Return:
+            keys: shape (T, B, key_dim)
+            values: shape (T, B, value_dim)
+            output_lengths: shape (B,)
+        '''
+        h, output_lengths = self.subsampling(utterances, utterance_lengths.long())
+        h = self.positional_encoding(h)
+            # shape: (T, B, encoder_dim)
+        padding_mask = output_mask(h.size(0), output_lengths).transpose(0, 1) == 0
+            # shape: (B, T), True on padded frames
+        h = self.layers(h, src_key_padding_mask=padding_mask)
+        keys = self.key_projection(h)
+        values = self.value_projection(h)
+        return keys, values, output_lengths
+
+
+def make_encoder(args):
+    if args.encoder_type == 'transformer':
+        if args.checkpoint_encoder:
+            raise ValueError('--checkpoint-encoder only applies to the lstm encoder')
+        return TransformerEncoderModel(args)
+    if args.stream_chunk > 0:
+        return StreamingEncoderModel(args)
+    return EncoderModel(args)
+
+
 def sample_gumbel(shape, eps=1e-10, out=None):
     """
     Sample from Gumbel(0, 1)
@@ -200,6 +424,51 @@ def calculate_context(attn, values):
     return ctx
 
 
+def calculate_windowed_attention(keys, values, mask, queries, prev_attn, window, min_confidence=0.):
+    """Attention restricted to a window around the previous attention peak
+
+    Keys and values inside each row's window are gathered in one batched call, so
+    the scoring cost per step is O(window) instead of O(T). Rows whose previous
+    attention peak is below min_confidence fall back to full attention.
+
+    Args:
+        keys: shape (B, T, key_dim)
+        values: shape (B, T, value_dim)
+        mask: lengths, shape (B, T)
+        queries: shape (B, key_dim)
+        prev_attn: attention of the previous decoder step, shape (B, T)
+        window: number of frames scored on each side of the previous peak
+
+    Return:
+        attn: attention, zero outside the window, shape (B, T)
+        ctx: context, shape (B, value_dim)
+    """
+    n, maxlen = mask.size()
+    width = 2 * window + 1
+    if width >= maxlen:
+        attn = calculate_attention(keys, mask, queries)
+        return attn, calculate_context(attn, values)
+    confidence, centers = torch.max(prev_attn, 1)
+    lengths = mask.sum(1).long()
+    # Shift windows so they stay inside the valid frames where possible
+    starts = torch.min(centers - window, lengths - width).clamp(min=0)
+    idx = starts.unsqueeze(1) + torch.arange(width, device=keys.device).unsqueeze(0)
+        # shape: (B, W)
+    keys_w = torch.gather(keys, 1, idx.unsqueeze(2).expand(-1, -1, keys.size(2)))
+    values_w = torch.gather(values, 1, idx.unsqueeze(2).expand(-1, -1, values.size(2)))
+    attn_w = calculate_attention(keys_w, torch.gather(mask, 1, idx), queries)
+        # shape: (B, W)
+    ctx = calculate_context(attn_w, values_w)
+    attn = mask.new_zeros((n, maxlen)).scatter(1, idx, attn_w)
+
+    low = (confidence < min_confidence).nonzero().view(-1)
+    if low.numel() > 0:
+        attn_full = calculate_attention(keys[low], mask[low], queries[low])
+        attn = attn.index_copy(0, low, attn_full)
+        ctx = ctx.index_copy(0, low, calculate_context(attn_full, values[low]))
+    return attn, ctx
+
+
 class DecoderModel(nn.Module):
     # Speller/Decoder
     def __init__(self, args, vocab_size):
@@ -217,8 +486,34 @@ class DecoderModel(nn.Module):
         )
         self.force_rate = args.teacher_force_rate
         self.char_projection[-1].weight = self.embedding.weight  # weight tying
+        self.attention_window = args.attention_window
+        self.attention_confidence = args.attention_confidence
+        self.initial_frames = 0  # encoder frames the initial context attends to, 0 for all
+
+    def initial_context(self, keys, values, mask, input_states):
+        '''Attention context before the first step, over the first initial_frames frames
 
-    def forward_pass(self, input_t, keys, values, mask, ctx, input_states):
+        Args:
+            keys: shape (B, T, key_dim)
+            values: shape (B, T, value_dim)
+            mask: shape (B, T)
+            input_states: initial state of the stacked LSTM
+
+        Return:
+            ctx: shape (B, value_dim)
+            attn: shape (B, T)
+        '''
+        if self.initial_frames > 0:
+            mask = mask.clone()
+            mask[:, self.initial_frames:] = 0
+        query = self.query_projection(input_states[-1][0])
+            # linear transformation of prev decoder hidden state
+            # shape: (B, key_dim)
+        attn = calculate_attention(keys, mask, query)
+        ctx = calculate_context(attn, values)
+        return ctx, attn
+
+    def forward_pass(self, input_t, keys, values, mask, ctx, input_states, prev_attn=None):
         '''
         Args:
             input_t: current input character fed into decoder
@@ -229,6 +524,8 @@ class DecoderModel(nn.Module):
             ctx: attention context values (B, value_dim)
             input_states: basically current hidden state of stacked LSTM,
                 size-3 list of (shape (1, self.hidden_size), shape (1, self.hidden_size)) pairs
+            prev_attn: previous attention (B, T), enables windowed attention at
+                inference when attention_window > 0
         
         Return:
             logit: probibility distribution of next predicted character
@@ -255,12 +552,17 @@ class DecoderModel(nn.Module):
         # Calculate query
         query = self.query_projection(ht)
             # shape: (B, key_dim)
-        # Calculate attention
-        attn = calculate_attention(keys=keys, mask=mask, queries=query)
-            # shape: (B, T)
-        # Calculate context
-        ctx = calculate_context(attn=attn, values=values)
-            # shape: (B, value_dim)
+        if self.attention_window > 0 and prev_attn is not None and not self.training:
+            attn, ctx = calculate_windowed_attention(
+                keys=keys, values=values, mask=mask, queries=query, prev_attn=prev_attn,
+                window=self.attention_window, min_confidence=self.attention_confidence)
+        else:
+            # Calculate attention
+            attn = calculate_attention(keys=keys, mask=mask, queries=query)
+                # shape: (B, T)
+            # Calculate context
+            ctx = calculate_context(attn=attn, values=values)
+                # shape: (B, value_dim)
         # Concatenate hidden state and context
         ht = torch.cat((ht, ctx), dim=1)
             # shape: (B, decoder_dim+value_dim)
@@ -292,15 +594,8 @@ class DecoderModel(nn.Module):
             # size-3 list of (shape (1, self.hidden_size), shape (1, self.hidden_size)) pairs
 
         # Initial context
-        h0 = input_states[-1][0]
-            # shape: (B, decoder_dim)
-        query = self.query_projection(h0)
-            # linear transformation of prev decoder hidden state
-            # shape: (B, key_dim)
-        attn = calculate_attention(keys_t, mask, query)
-            # shape: (B, T)
-        ctx = calculate_context(attn, values_t)
-            # shape: (B, value_dim)
+        ctx, attn = self.initial_context(keys_t, values_t, mask, input_states)
+            # ctx shape: (B, value_dim), attn shape: (B, T)
 
         # Decoder loop
         logits = []
@@ -318,7 +613,7 @@ class DecoderModel(nn.Module):
             # Run a single timestep
             logit, generated, ctx, attn, input_states = self.forward_pass(
                 input_t=input_t, keys=keys_t, values=values_t, mask=mask, ctx=ctx,
-                input_states=input_states
+                input_states=input_states, prev_attn=attn
             )
                 # ctx shape: (B, value_dim), attn shape: (B, T)
             # Save outputs
@@ -334,7 +629,7 @@ class DecoderModel(nn.Module):
                 # Run a single timestep
                 logit, generated, ctx, attn, input_states = self.forward_pass(
                     input_t=input_t, keys=keys_t, values=values_t, mask=mask, ctx=ctx,
-                    input_states=input_states
+                    input_states=input_states, prev_attn=attn
                 )
                 # Save outputs
                 logits.append(logit)
@@ -349,34 +644,154 @@ class DecoderModel(nn.Module):
         generateds = torch.stack(generateds,dim=0)
         return logits, attns, generateds
 
+    def beam_search(self, keys, values, beam_width=5, max_len=250, ctc_scorer=None, ctc_weight=0.):
+        '''Beam search over a single utterance, running all beams as one batch
+
+        With a ctc_scorer, the top 1.5 * beam_width attention candidates of each
+        beam are rescored with CTC prefix probabilities, and search stops as soon
+        as the best finished hypothesis outscores every active one
+
+        Args:
+            keys: shape (T, key_dim), only valid frames
+            values: shape (T, value_dim), only valid frames
+            ctc_scorer: CTCPrefixScorer for the same utterance or None
+
+        Return:
+            list of (tokens, score) pairs sorted best first, tokens exclude the end token
+        '''
+        keys_t = keys.unsqueeze(0)
+        values_t = values.unsqueeze(0)
+        mask = keys.new_ones((1, keys.size(0)))
+
+        input_states = [rnn.initial_state(1) for rnn in self.input_rnns]
+        ctx, attn = self.initial_context(keys_t, values_t, mask, input_states)
+
+        ctc_state = ctc_scorer.initial_state() if ctc_scorer is not None else None
+        hyps = [dict(tokens=[], score=0., ctc_state=ctc_state)]
+        pre_beam = int(1.5 * beam_width) if ctc_scorer is not None else beam_width
+        ended = []
+        for _ in range(max_len):
+            n = len(hyps)
+            last_tokens = [h['tokens'][-1] if len(h['tokens']) > 0 else 0 for h in hyps]
+            input_t = torch.LongTensor(last_tokens).to(keys.device)
+            logit, _, ctx, attn, input_states = self.forward_pass(
+                input_t=input_t, keys=keys_t.expand(n, -1, -1), values=values_t.expand(n, -1, -1),
+                mask=mask.expand(n, -1), ctx=ctx, input_states=input_states, prev_attn=attn
+            )
+            log_probs = log_softmax(logit, dim=1)  # (n, vocab_size)
+            top_lps, top_tokens = torch.topk(log_probs, k=min(pre_beam, log_probs.size(1)), dim=1)
+
+            if ctc_scorer is not None:
+                psis, rs = ctc_scorer.score([h['ctc_state'] for h in hyps], top_tokens)
+            candidates = []  # (score, hyp index, token, ctc state)
+            for i, hyp in enumerate(hyps):
+                scores = hyp['score'] + top_lps[i]
+                new_ctc_states = [None] * top_tokens.size(1)
+                if ctc_scorer is not None:
+                    psi = psis[i]
+                    scores = hyp['score'] + (1 - ctc_weight) * top_lps[i] \
+                        + ctc_weight * (psi - hyp['ctc_state'][1])
+                    new_ctc_states = [(rs[:, :, i, k], psi[k].item(), top_tokens[i, k].item())
+                                      for k in range(top_tokens.size(1))]
+                for k in range(top_tokens.size(1)):
+                    candidates.append((scores[k].item(), i, top_tokens[i, k].item(), new_ctc_states[k]))
+            candidates.sort(key=lambda c: c[0], reverse=True)
+
+            new_hyps = []
+            rows = []
+            for score, i, token, new_ctc_state in candidates[:beam_width]:
+                if token == 0:
+                    ended.append((hyps[i]['tokens'], score))
+                else:
+                    new_hyps.append(dict(tokens=hyps[i]['tokens'] + [token], score=score, ctc_state=new_ctc_state))
+                    rows.append(i)
+            if len(new_hyps) == 0 or len(ended) >= beam_width:
+                break
+            if ctc_scorer is not None and len(ended) > 0 \
+                    and max(e[1] for e in ended) > max(h['score'] for h in new_hyps):
+                break
+            rows = torch.LongTensor(rows).to(keys.device)
+            input_states = [(h[rows], c[rows]) for h, c in input_states]
+            ctx = ctx[rows]
+            attn = attn[rows]
+            hyps = new_hyps
+
+        if len(ended) == 0:
+            ended = [(h['tokens'], h['score']) for h in hyps]
+        ended.sort(key=lambda e: e[1], reverse=True)
+        return ended
+
 
 class Seq2SeqModel(nn.Module):
     # Tie encoder and decoder together
     def __init__(self, args, vocab_size):
         super(Seq2SeqModel, self).__init__()
-        self.encoder = EncoderModel(args)
+        self.encoder = make_encoder(args)
         self.decoder = DecoderModel(args, vocab_size=vocab_size)
+        if isinstance(self.encoder, StreamingEncoderModel):
+            # a streaming decoder starts once the first chunk is encoded, so training and
+            # offline decoding take the initial context from that chunk as well
+            self.decoder.initial_frames = self.encoder.chunk // self.encoder.min_frames
+        if args.ctc_weight > 0:
+            self.ctc_projection = nn.Linear(args.value_dim, vocab_size + 1)
+        else:
+            self.ctc_projection = None
         self._state_hooks = {}
 
     def forward(self, utterances, utterance_lengths, chars, char_lengths, future=0):
         keys, values, lengths = self.encoder(utterances, utterance_lengths)
         logits, attns, generated = self.decoder(chars, char_lengths, keys, values, lengths, future=future)
         self._state_hooks['attention'] = attns.permute(1, 0, 2).unsqueeze(1)
+        if self.ctc_projection is not None:
+            self._state_hooks['ctc'] = (log_softmax(self.ctc_projection(values), dim=2), lengths)
         return logits, generated, char_lengths
 
+    def forward_ctc(self, utterances, utterance_lengths):
+        '''
+        Return:
+            log_probs: shape (T, B, vocab_size+1), index 0 is the blank
+            lengths: shape (B,)
+        '''
+        assert self.ctc_projection is not None, 'model was trained without a CTC head'
+        keys, values, lengths = self.encoder(utterances, utterance_lengths)
+        return log_softmax(self.ctc_projection(values), dim=2), lengths
+
+    def beam_search(self, utterances, utterance_lengths, beam_width=5, max_len=250, ctc_weight=0., nbest=1):
+        '''
+        Return:
+            list of B int lists, the best hypothesis for each utterance
+                (with nbest > 1, list of B lists of up to nbest int lists, best first)
+        '''
+        with torch.no_grad():
+            keys, values, lengths = self.encoder(utterances, utterance_lengths)
+            use_ctc = self.ctc_projection is not None and ctc_weight > 0
+            if use_ctc:
+                ctc_log_probs = log_softmax(self.ctc_projection(values), dim=2)
+            outputs = []
+            for i in range(keys.size(1)):
+                length = int(lengths[i])
+                ctc_scorer = CTCPrefixScorer(ctc_log_probs[:length, i]) if use_ctc else None
+                hyps = self.decoder.beam_search(
+                    keys[:length, i], values[:length, i], beam_width=beam_width,
+                    max_len=max_len, ctc_scorer=ctc_scorer, ctc_weight=ctc_weight)
+                outputs.append(hyps[0][0] if nbest == 1 else [h[0] for h in hyps[:nbest]])
+        return outputs
+
 
 def write_transcripts(path, args, model, loader, charset, log_path):
     # Write CSV file
     model.eval()
     os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
-    with open(path, 'w', newline='') as f:
+    transcripts = []
+    with open(path, 'w', newline='') as f, open(log_path, 'a') as ouf:
         w = csv.writer(f)
-        transcripts = generate_transcripts(args, model, loader, charset)
-        for i, t in enumerate(transcripts):
+        for i, t in enumerate(generate_transcripts(args, model, loader, charset)):
             w.writerow([i+1, t])
-            with open(log_path, 'a') as ouf:
-                ouf.write('%s\n' % t)
-            if (i+1) % 100 == 0:
+            ouf.write('%s\n' % t)
+            transcripts.append(t)
+            if (i+1) % args.flush_every == 0:
+                f.flush()
+                ouf.flush()
                 print('Wrote %d Lines' % (i+1))
     return transcripts
 
@@ -395,11 +810,280 @@ class SequenceCrossEntropy(nn.CrossEntropyLoss):
         return loss
 
 
+class SequenceCTC(nn.Module):
+    # CTC loss on the encoder head, normalized per utterance like SequenceCrossEntropy
+    def forward(self, ctc_output, target, target_lengths):
+        '''
+        Args:
+            ctc_output: (log_probs, lengths) stored by Seq2SeqModel.forward
+            target: shape (seq_len, batch_size), padded with 0
+            target_lengths: shape (batch_size,), excluding the end token
+        '''
+        log_probs, lengths = ctc_output
+        loss = nn.functional.ctc_loss(
+            log_probs, target.transpose(0, 1), lengths.long(), target_lengths.long(),
+            blank=0, reduction='sum', zero_infinity=True)
+        return loss / log_probs.size(1)
+
+
+class GradientAccumulator(object):
+    '''Accumulates micro-batch gradients until a frame or label budget is reached
+
+    Micro-batch losses are backpropagated as sums over utterances; step() sums
+    the gradients over replicas, rescales them by the number of utterances (or
+    labels) that actually contributed, clips once and steps the optimizer
+    '''
+    def __init__(self, args, model, optimizer):
+        self.args = args
+        self.model = model
+        self.optimizer = optimizer
+        self.reset()
+        self.num_updates = 0
+        self.tot_utterances = 0
+        self.tot_frames = 0
+        self.tot_labels = 0
+
+    def reset(self):
+        self.utterances = 0
+        self.frames = 0
+        self.labels = 0
+        self.local_utterances = 0
+        self.local_labels = 0
+
+    def add(self, utterances, frames, labels):
+        '''Registers a planned micro-batch (global counts when distributed)
+
+        Return:
+            True if the optimizer should step after this micro-batch
+        '''
+        self.utterances += utterances
+        self.frames += frames
+        self.labels += labels
+        if self.args.accum_frames <= 0 and self.args.accum_labels <= 0:
+            return True
+        if self.args.accum_frames > 0 and self.frames >= self.args.accum_frames:
+            return True
+        return self.args.accum_labels > 0 and self.labels >= self.args.accum_labels
+
+    def contribute(self, utterances, labels):
+        # utterances whose gradients are currently held on this replica
+        self.local_utterances += utterances
+        self.local_labels += labels
+
+    def discard(self):
+        # drops the gradients accumulated so far, e.g. after a failed backward
+        self.optimizer.zero_grad()
+        self.local_utterances = 0
+        self.local_labels = 0
+
+    def step(self):
+        all_reduce_gradients(self.args, self.model.parameters())
+        utterances, labels = all_reduce_sum(self.args, self.local_utterances, self.local_labels)
+        normalizer = labels if self.args.accum_normalize == 'labels' else utterances
+        if normalizer > 0:
+            for p in self.model.parameters():
+                if p.grad is not None:
+                    p.grad.data.div_(normalizer)
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.25)
+            self.optimizer.step()
+        self.optimizer.zero_grad()
+        self.num_updates += 1
+        self.tot_utterances += self.utterances
+        self.tot_frames += self.frames
+        self.tot_labels += self.labels
+        self.reset()
+
+    def state_dict(self):
+        # epoch totals; only saved between updates, when nothing is pending
+        return {'num_updates': self.num_updates, 'tot_utterances': self.tot_utterances,
+                'tot_frames': self.tot_frames, 'tot_labels': self.tot_labels}
+
+    def load_state_dict(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def stats(self):
+        n = max(self.num_updates, 1)
+        return 'Updates: %d, Avg Per Update: %.1f utterances, %.1f frames, %.1f labels' % (
+            self.num_updates, self.tot_utterances / n, self.tot_frames / n, self.tot_labels / n)
+
+
+def train_batch(args, net, model, criterion, batch, accumulator, safe_sizes, log, log_path):
+    '''Runs forward and backward over a batch, splitting it on allocation failures
+
+    The batch is first cut into micro-batches of the safe size learned for its
+    length bucket. A micro-batch that still fails is split in half and retried;
+    a single utterance that fails is dropped. A failure inside backward may
+    leave partial gradients, so the gradients held for the update are discarded
+
+    Return:
+        loss and perplexity, averaged over the batch like a single forward pass
+    '''
+    ulens = batch[1]
+    batch_size = ulens.size(0)
+    bucket = safe_sizes.bucket(torch.max(ulens).item())
+    size = safe_sizes.get(bucket, batch_size)
+    order = torch.sort(ulens, descending=True)[1]
+    chunks = [order[i:i+size] for i in range(0, batch_size, size)]
+    l, tot_perp = 0., 0.
+    while chunks:
+        idx = chunks.pop(0)
+        failed = None
+        stage = 'forward'
+        try:
+            uarray, ulens, l1array, llens, l2array = slice_batch(batch, idx)
+            uarray, ulens, l1array, llens, l2array = Variable(uarray), \
+                Variable(ulens), Variable(l1array), Variable(llens), Variable(l2array)
+            if args.cuda:
+                uarray, ulens, l1array, llens, l2array = uarray.cuda(), \
+                    ulens.cuda(), l1array.cuda(), llens.cuda(), l2array.cuda()
+            prediction = net(uarray, ulens, l1array, llens)
+            logits, _, char_lengths = prediction
+            loss = compute_loss(args, model, criterion, prediction, l2array, llens)
+            perp = perplexity(logits, l2array, char_lengths)
+            stage = 'backward'
+            (loss * len(idx)).backward()
+        except RuntimeError as e:
+            if not is_oom_error(e):
+                raise
+            failed = stage
+        if failed is not None:
+            # release the failed graph before retrying
+            prediction = logits = loss = perp = None
+            free_memory(args)
+            safe_sizes.record(bucket, len(idx))
+            log('Allocation failure in %s: %d utterances, up to %d frames' % (
+                failed, len(idx), int(torch.max(batch[1][idx]))), log_path)
+            if failed == 'backward':
+                accumulator.discard()
+            if len(idx) > 1:
+                half = (len(idx) + 1) // 2
+                chunks[:0] = [idx[:half], idx[half:]]
+            else:
+                safe_sizes.dropped += 1
+            continue
+        accumulator.contribute(len(idx), torch.sum(batch[3][idx]).item())
+        l += loss.item() * len(idx) / batch_size
+        tot_perp += perp.item() * len(idx) / batch_size
+    return l, tot_perp
+
+
+def train_epoch(args, net, model, criterion, loader, batches, accumulator, safe_sizes, log, log_path,
+                start_batch=0, totals=(0, 0, 0), save=None, t0=None):
+    '''Trains on batches[start_batch:], stepping the optimizer whenever the accumulator is full
+
+    Args:
+        batches: list of index lists drawn from loader.batch_sampler
+        totals: (loss, perplexity, utterances) sums of a resumed epoch
+        save: called as save(batch, loss, perplexity, utterances) at mid-epoch checkpoints
+        t0: start time for progress messages
+
+    Return:
+        train loss, perplexity and utterance sums on this replica
+    '''
+    l, tot_perp, num_train = totals
+    t0 = time.time() if t0 is None else t0
+    save_due = False
+    for i, t in enumerate(epoch_loader(loader, batches[start_batch:]), start_batch):
+        uarray, ulens, l1array, llens, l2array = t
+        valid = torch.min(ulens).item() > 8 and torch.min(llens).item() > 0
+        # counts are summed over replicas so that every rank skips and steps together
+        num_utts, num_frames, num_labels, num_invalid = all_reduce_sum(
+            args, ulens.size(0), torch.sum(ulens).item(), torch.sum(llens).item(), 0 if valid else 1)
+        if num_invalid == 0:
+            will_step = accumulator.add(num_utts, num_frames, num_labels)
+            # replicas may split batches differently, so gradients are reduced in accumulator.step
+            with net.no_sync() if args.distributed else contextlib.suppress():
+                batch_loss, batch_perp = train_batch(
+                    args, net, model, criterion, t, accumulator, safe_sizes, log, log_path)
+            # batches repeated to even out the replicas still train but are not counted
+            if not (args.distributed and loader.batch_sampler.is_repeat(i)):
+                l += batch_loss
+                tot_perp += batch_perp
+                num_train += ulens.size(0)
+            if will_step:
+                accumulator.step()
+        if (i+1) % 100 == 0 and (not args.distributed or args.rank == 0):
+            t1 = time.time()
+            print('Processed %d Batches (%.2f Seconds)' % (i+1, t1-t0))
+        # mid-epoch checkpoints wait for the pending update so no gradients are lost
+        save_due = save_due or (args.checkpoint_every > 0 and (i+1) % args.checkpoint_every == 0)
+        if save_due and accumulator.utterances == 0 and i < len(batches) - 1:
+            save_due = False
+            if save is not None:
+                save(i+1, l, tot_perp, num_train)
+    # the last update may be pending, e.g. when the final batches were skipped as invalid;
+    # accumulator.utterances is summed over replicas, so all ranks step here together
+    if accumulator.utterances > 0:
+        accumulator.step()
+    return l, tot_perp, num_train
+
+
+def compute_loss(args, model, criterion, prediction, target, target_lengths):
+    '''Attention loss, interpolated with the CTC loss when the model has a CTC head
+
+    Args:
+        target_lengths: decoder lengths including the end token
+    '''
+    loss = criterion(prediction, target)
+    if args.ctc_weight > 0:
+        ctc_loss = SequenceCTC()(model._state_hooks['ctc'], target, target_lengths - 1)
+        loss = (1 - args.ctc_weight) * loss + args.ctc_weight * ctc_loss
+    return loss
+
+
+def evaluate(args, model, criterion, loader, charset, decode=True):
+    '''Dev loss, perplexity and CER from a single pass over the loader
+
+    The teacher-forced decoder steps give the loss and perplexity, and the same
+    encoder output and decoder state continue for args.generator_length free
+    running steps to produce the transcripts scored for CER (as in cer()).
+    References are read back from the batch labels, so the loader may be shuffled
+
+    Batches that BucketBatchSampler repeats to even out the replicas are skipped
+
+    Return:
+        loss and perplexity sums over the batches passing the length guard,
+        number of utterances in those batches, normalized CER sum,
+        number of utterances scored for CER
+    '''
+    model.eval()
+    sampler = loader.batch_sampler if isinstance(loader.batch_sampler, BucketBatchSampler) else None
+    l, tot_perp, num_loss, cer_sum, num_cer = 0., 0., 0, 0., 0
+    with torch.no_grad():
+        for k, (uarray, ulens, l1array, llens, l2array) in enumerate(loader):
+            if sampler is not None and sampler.is_repeat(k):
+                continue
+            valid = torch.min(ulens).item() > 8 and torch.min(llens).item() > 0
+            refs = [decode_output(l2array[:, i].numpy(), charset) for i in range(l2array.size(1))]
+            if args.cuda:
+                uarray, ulens, l1array, llens, l2array = uarray.cuda(), \
+                    ulens.cuda(), l1array.cuda(), llens.cuda(), l2array.cuda()
+            if not valid and not decode:
+                continue
+            future = args.generator_length if decode else 0
+            logits, generated, char_lengths = model(uarray, ulens, l1array, llens, future=future)
+            if valid:
+                prediction = (logits[:l1array.size(0)], generated, char_lengths)
+                l += compute_loss(args, model, criterion, prediction, l2array, llens).item()
+                tot_perp += perplexity(prediction[0], l2array, char_lengths).item()
+                num_loss += ulens.size(0)
+            if decode:
+                generated = generated.data.cpu().numpy()
+                hyps = [decode_output(generated[:, i], charset)[:len(refs[i])] for i in range(len(refs))]
+                dists = batch_edit_distance(hyps, refs)
+                cer_sum += sum(d / max(len(r), 1) for d, r in zip(dists, refs))
+                num_cer += len(refs)
+    return l, tot_perp, num_loss, cer_sum, num_cer
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--batch-size', type=int, default=32, metavar='N', help='batch size')
     parser.add_argument('--save-directory', type=str, default='output/baseline/v1', help='output directory')
     parser.add_argument('--save-all', type=bool, default=False, help='saves all epoch models')
+    parser.add_argument('--no-inline-cer', action='store_true', default=False, help='skip the per-epoch dev CER pass and save every epoch for evaluate_checkpoints.py')
+    parser.add_argument('--checkpoint-every', type=int, default=0, metavar='N', help='also save the training state every N batches (0 to only save per epoch)')
     parser.add_argument('--epochs', type=int, default=100, metavar='N', help='number of epochs')
     parser.add_argument('--patience', type=int, default=10, help='patience for early stopping')
     parser.add_argument('--num-workers', type=int, default=2, metavar='N', help='number of workers')
@@ -409,37 +1093,87 @@ def parse_args():
     parser.add_argument('--max-dev', type=int, default=1000000000, help='max dev')
     parser.add_argument('--max-test', type=int, default=1000000000, help='max test')
 
+    parser.add_argument('--accum-frames', type=int, default=0, metavar='N', help='accumulate gradients until this many input frames per update (0 to disable)')
+    parser.add_argument('--accum-labels', type=int, default=0, metavar='N', help='accumulate gradients until this many labels per update (0 to disable)')
+    parser.add_argument('--accum-normalize', type=str, default='utterances', choices=['utterances', 'labels'], help='average accumulated gradients per utterance or per label')
+    parser.add_argument('--oom-bucket-frames', type=int, default=200, metavar='N', help='utterance length bucket width for learned safe micro-batch sizes')
+
     parser.add_argument('--lr', type=float, default=1e-3, metavar='N', help='lr')
     parser.add_argument('--weight-decay', type=float, default=1e-5, metavar='N', help='weight decay')
     parser.add_argument('--teacher-force-rate', type=float, default=0.9, metavar='N', help='teacher forcing rate')
 
+    parser.add_argument('--encoder-type', type=str, default='lstm', choices=['lstm', 'transformer'], help='encoder architecture')
     parser.add_argument('--encoder-dim', type=int, default=256, metavar='N', help='hidden dimension')
+    parser.add_argument('--checkpoint-encoder', type=int, nargs='*', default=[], metavar='N', help='lstm encoder layers (0-3) to recompute on backward instead of storing activations (not for the transformer encoder)')
+    parser.add_argument('--stream-chunk', type=int, default=0, metavar='N', help='input frames per chunk of the latency-controlled lstm encoder, a multiple of 8 (0 for the bidirectional encoder)')
+    parser.add_argument('--stream-right-context', type=int, default=16, metavar='N', help='look-ahead input frames of each chunk with --stream-chunk')
+    parser.add_argument('--encoder-layers', type=int, default=6, metavar='N', help='transformer encoder layers')
+    parser.add_argument('--encoder-heads', type=int, default=4, metavar='N', help='transformer attention heads')
+    parser.add_argument('--encoder-ff-dim', type=int, default=1024, metavar='N', help='transformer feedforward dimension')
+    parser.add_argument('--encoder-dropout', type=float, default=0.1, metavar='N', help='transformer dropout')
     parser.add_argument('--decoder-dim', type=int, default=512, metavar='N', help='hidden dimension')
     parser.add_argument('--value-dim', type=int, default=128, metavar='N', help='hidden dimension')
     parser.add_argument('--key-dim', type=int, default=128, metavar='N', help='hidden dimension')
     parser.add_argument('--generator-length', type=int, default=250, metavar='N', help='maximum length to generate')
+    parser.add_argument('--attention-window', type=int, default=0, metavar='N', help='frames on each side of the previous attention peak scored at inference (0 for full attention)')
+    parser.add_argument('--attention-confidence', type=float, default=0.1, metavar='N', help='minimum previous attention peak for windowed attention')
+
+    parser.add_argument('--ctc-weight', type=float, default=0., metavar='N', help='weight of auxiliary CTC loss (0 disables the CTC head)')
+
+    parser.add_argument('--distributed', action='store_true', default=False, help='data-parallel training with torch.distributed')
+    parser.add_argument('--world-size', type=int, default=1, metavar='N', help='number of distributed processes')
+    parser.add_argument('--rank', type=int, default=0, metavar='N', help='rank of this process')
+    parser.add_argument('--dist-backend', type=str, default='gloo', help='torch.distributed backend')
+    parser.add_argument('--master-addr', type=str, default='127.0.0.1', help='address of the rank 0 process')
+    parser.add_argument('--master-port', type=int, default=29500, metavar='N', help='port of the rank 0 process')
 
     parser.add_argument('--test-mode', type=str, default='transcript', help='Test mode: transcript, cer, perp')
+    parser.add_argument('--decode-mode', type=str, default='greedy', choices=['greedy', 'beam', 'ctc_greedy'], help='Decoding: attention greedy, attention beam (CTC prefix scored if model has a CTC head), CTC greedy')
+    parser.add_argument('--beam-width', type=int, default=5, metavar='N', help='Beam search width')
+    parser.add_argument('--ctc-decode-weight', type=float, default=0.3, metavar='N', help='CTC prefix score weight in beam search')
+    parser.add_argument('--batch-frames', type=int, default=40000, metavar='N', help='padded input frames per batch in transcribe.py')
+    parser.add_argument('--transcribe-split', type=str, default='test', choices=['train', 'dev', 'test'], help='split transcribed by transcribe.py')
+    parser.add_argument('--flush-every', type=int, default=100, metavar='N', help='transcript lines between flushes of the output files')
+    parser.add_argument('--frame-shift', type=float, default=0.01, metavar='N', help='seconds of audio per input frame, for the real-time factor')
+    parser.add_argument('--transcribe-workers', type=int, default=0, metavar='N', help='forked CPU worker processes in transcribe.py (0 decodes in the main process)')
+    parser.add_argument('--worker-threads', type=int, default=0, metavar='N', help='intra-op threads per transcribe.py worker (0 splits the cores evenly)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='serve.py address')
+    parser.add_argument('--port', type=int, default=8000, metavar='N', help='serve.py port (0 picks a free one)')
+    parser.add_argument('--socket-path', type=str, default=None, help='serve.py Unix socket, used instead of --host and --port')
+    parser.add_argument('--max-wait-ms', type=float, default=20., metavar='N', help='longest time serve.py holds a request to batch it with later ones')
+    parser.add_argument('--lm-path', type=str, default=None, help='lm/ language model (e.g. DualLSTM) used by serve.py to rerank beam search hypotheses')
+    parser.add_argument('--lm-dir', type=str, default='../../lm', help='directory of the lm/ code')
+    parser.add_argument('--random-weights', action='store_true', default=False, help='serve.py uses an untrained model and a synthetic charset (for local testing without data)')
+    parser.add_argument('--smoke-test', type=int, default=0, metavar='N', help='serve.py sends N concurrent random requests to itself, prints its stats and exits')
+    parser.add_argument('--client', type=str, nargs='*', default=[], help='serve.py sends these .npy, .wav or .mfcc files to a running server and prints the transcripts')
+    parser.add_argument('--eval-max-dev', type=int, default=1000000000, metavar='N', help='dev utterances scored by evaluate_checkpoints.py')
+    parser.add_argument('--eval-poll', type=float, default=60., metavar='N', help='seconds between checkpoint directory scans')
+    parser.add_argument('--eval-once', action='store_true', default=False, help='score the current checkpoints and exit')
+    parser.add_argument('--metrics-file', type=str, default='metrics.tsv', help='metrics file in the save directory')
 
     return parser.parse_args()
 
-def main():
-    args = parse_args()
+def main(args=None):
+    if args is None:
+        args = parse_args()
     args.cuda = not args.no_cuda and torch.cuda.is_available()
+    is_main = setup_distributed(args)
+    log = print_log if is_main else (lambda s, log_path: None)
 
     t0 = time.time()
 
-    if not os.path.exists(args.save_directory):
-        os.makedirs(args.save_directory)
     LOG_PATH = os.path.join(args.save_directory, 'log')
-    with open(LOG_PATH, 'w+') as ouf:
-        pass
+    if is_main:
+        if not os.path.exists(args.save_directory):
+            os.makedirs(args.save_directory)
+        with open(LOG_PATH, 'w+') as ouf:
+            pass
 
     print("Loading File Paths")
     train_paths, dev_paths, test_paths = load_paths()
     train_paths, dev_paths, test_paths = train_paths[:args.max_train], dev_paths[:args.max_dev], test_paths[:args.max_test]
     t1 = time.time()
-    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+    log('%.2f Seconds' % (t1-t0), LOG_PATH)
 
     train_paths = train_paths[:args.max_data]
     dev_paths = dev_paths[:args.max_data]
@@ -450,110 +1184,139 @@ def main():
     dev_ys = load_y_data('dev')
     test_ys = load_y_data('test')
     t1 = time.time()
-    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+    log('%.2f Seconds' % (t1-t0), LOG_PATH)
 
     print("Building Charset")
     charset = build_charset(np.concatenate((train_ys, dev_ys, test_ys), axis=0))
     charmap = make_charmap(charset) # {string: int}
     charcount = len(charset)
     t1 = time.time()
-    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+    log('%.2f Seconds' % (t1-t0), LOG_PATH)
 
     print("Mapping Characters")
     trainchars = map_characters(train_ys, charmap) # list of 1-dim int np arrays
     devchars = map_characters(dev_ys, charmap) # list of 1-dim int np arrays
     t1 = time.time()
-    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+    log('%.2f Seconds' % (t1-t0), LOG_PATH)
 
     print("Building Loader")
-    dev_loader = make_loader(dev_paths, devchars, args, shuffle=True, batch_size=args.batch_size)
-    train_loader = make_loader(train_paths, trainchars, args, shuffle=True, batch_size=args.batch_size)
+    dev_loader = make_loader(dev_paths, devchars, args, shuffle=True, batch_size=args.batch_size, bucket=args.distributed)
+    train_loader = make_loader(train_paths, trainchars, args, shuffle=True, batch_size=args.batch_size, bucket=args.distributed)
     test_loader = make_loader(test_paths, None, args, shuffle=False, batch_size=args.batch_size)
     t1 = time.time()
-    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+    log('%.2f Seconds' % (t1-t0), LOG_PATH)
 
     print("Building Model")
     model = Seq2SeqModel(args, vocab_size=charcount)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     criterion = SequenceCrossEntropy()
     t1 = time.time()
-    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+    log('%.2f Seconds' % (t1-t0), LOG_PATH)
 
     print("Running")
     CKPT_PATH = os.path.join(args.save_directory, 'model.ckpt')
-    if os.path.exists(CKPT_PATH):
+    STATE_PATH = os.path.join(args.save_directory, 'train_state.ckpt')
+    resume = None
+    if os.path.exists(STATE_PATH):
+        resume = torch.load(STATE_PATH, map_location=lambda storage, loc: storage)
+        model.load_state_dict(resume['model'])
+    elif os.path.exists(CKPT_PATH):
         model.load_state_dict(torch.load(CKPT_PATH))
     if args.cuda:
         model = model.cuda()
+    net = model
+    if args.distributed:
+        device_ids = [torch.cuda.current_device()] if args.cuda else None
+        net = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
 
     best_val_loss = sys.maxsize
     prev_best_epoch = 0
-    for e in range(args.epochs):
+    start_epoch = 0
+    safe_sizes = SafeBatchSizes(args.oom_bucket_frames)
+    saver = CheckpointSaver()
+
+    def save_state(epoch, batch, batches, accumulator, l, tot_perp, num_train, stopped=False):
+        # batch orders are only stored without DDP; BucketBatchSampler replays them from the epoch
+        saver.save({
+            'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+            'epoch': epoch, 'batch': batch, 'batches': None if args.distributed else batches,
+            'accumulator': accumulator.state_dict() if accumulator else None,
+            'train_loss': l, 'train_perp': tot_perp, 'train_utterances': num_train, 'stopped': stopped,
+            'best_val_loss': best_val_loss, 'prev_best_epoch': prev_best_epoch,
+            'safe_sizes': safe_sizes.state_dict(), 'rng': get_rng_states()}, STATE_PATH)
+
+    if resume is not None:
+        optimizer.load_state_dict(resume['optimizer'])
+        best_val_loss = resume['best_val_loss']
+        prev_best_epoch = resume['prev_best_epoch']
+        safe_sizes.load_state_dict(resume['safe_sizes'])
+        start_epoch = args.epochs if resume['stopped'] else resume['epoch']
+        set_rng_states(resume['rng'])
+        log('Resuming at Epoch %d, Batch %d' % (resume['epoch']+1, resume['batch']), LOG_PATH)
+
+    for e in range(start_epoch, args.epochs):
         t1 = time.time()
-        print_log('Starting Epoch %d (%.2f Seconds)' % (e+1, t1-t0), LOG_PATH)
+        log('Starting Epoch %d (%.2f Seconds)' % (e+1, t1-t0), LOG_PATH)
 
         # train
+        if args.distributed:
+            train_loader.batch_sampler.set_epoch(e)
         model.train()
         optimizer.zero_grad()
+        accumulator = GradientAccumulator(args, model, optimizer)
+        start_batch = 0
         l = 0
         tot_perp = 0
-        for i, t in enumerate(train_loader):
-            uarray, ulens, l1array, llens, l2array = t
-            if torch.min(ulens).item() > 8 and torch.min(llens).item() > 0:
-                uarray, ulens, l1array, llens, l2array = Variable(uarray), \
-                    Variable(ulens), Variable(l1array), Variable(llens), Variable(l2array)
-                if torch.cuda.is_available():
-                    uarray, ulens, l1array, llens, l2array = uarray.cuda(), \
-                        ulens.cuda(), l1array.cuda(), llens.cuda(), l2array.cuda()
-                prediction = model(uarray, ulens, l1array, llens)
-                logits, generated, char_lengths = prediction
-                loss = criterion(prediction, l2array)
-                perp = perplexity(logits, l2array, char_lengths)
-                l += loss.item()
-                tot_perp += perp.item()
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                optimizer.step()
-            if (i+1) % 100 == 0:
-                t1 = time.time()
-                print('Processed %d Batches (%.2f Seconds)' % (i+1, t1-t0))
-        print_log('Train Loss: %f' % (l/len(train_loader.dataset)), LOG_PATH)
-        print_log('Avg Train Perplexity: %f' % (tot_perp/len(train_loader.dataset)), LOG_PATH)
+        num_train = 0
+        if resume is not None and resume['epoch'] == e and resume['batch'] > 0:
+            start_batch = resume['batch']
+            batches = resume['batches'] if resume['batches'] is not None else list(train_loader.batch_sampler)
+            accumulator.load_state_dict(resume['accumulator'])
+            l, tot_perp, num_train = resume['train_loss'], resume['train_perp'], resume['train_utterances']
+        else:
+            batches = list(train_loader.batch_sampler)
+        resume = None
+
+        def save(batch, l, tot_perp, num_train):
+            if is_main:
+                save_state(e, batch, batches, accumulator, l, tot_perp, num_train)
+        l, tot_perp, num_train = train_epoch(
+            args, net, model, criterion, train_loader, batches, accumulator, safe_sizes, log, LOG_PATH,
+            start_batch=start_batch, totals=(l, tot_perp, num_train), save=save, t0=t0)
+        l, tot_perp, num_train = all_reduce_sum(args, l, tot_perp, num_train)
+        log('Train Loss: %f' % (l/max(num_train, 1)), LOG_PATH)
+        log('Avg Train Perplexity: %f' % (tot_perp/max(num_train, 1)), LOG_PATH)
+        log(accumulator.stats(), LOG_PATH)
+        log(safe_sizes.summary(), LOG_PATH)
 
         # val
         model.eval()
         with torch.no_grad():
-            l = 0
-            tot_perp = 0
-            for i, t in enumerate(dev_loader):
-                uarray, ulens, l1array, llens, l2array = t
-                if torch.min(ulens).item() > 8 and torch.min(llens).item() > 0:
-                    uarray, ulens, l1array, llens, l2array = Variable(uarray), \
-                        Variable(ulens), Variable(l1array), Variable(llens), Variable(l2array)
-                    if torch.cuda.is_available():
-                        uarray, ulens, l1array, llens, l2array = uarray.cuda(), \
-                            ulens.cuda(), l1array.cuda(), llens.cuda(), l2array.cuda()
-                    prediction = model(uarray, ulens, l1array, llens)
-                    logits, generated, char_lengths = prediction
-                    loss = criterion(prediction, l2array)
-                    perp = perplexity(logits, l2array, char_lengths)
-                    l += loss.item()
-                    tot_perp += perp.item()
-            val_loss = l/len(dev_loader.dataset)
+            l, tot_perp, num_dev, cer_sum, num_cer = evaluate(
+                args, model, criterion, dev_loader, charset, decode=not args.no_inline_cer)
+            # all replicas see the same val_loss, so early stopping stays in sync
+            l, tot_perp, num_dev, cer_sum, num_cer = all_reduce_sum(args, l, tot_perp, num_dev, cer_sum, num_cer)
+            val_loss = l/max(num_dev, 1)
             if val_loss < best_val_loss:
                 best_val_loss = val_loss
                 prev_best_epoch = e
-                torch.save(model.state_dict(), CKPT_PATH)
+                if is_main:
+                    saver.save(model.state_dict(), CKPT_PATH)
             elif e - prev_best_epoch > args.patience:
+                if is_main:
+                    save_state(e+1, 0, None, None, 0, 0, 0, stopped=True)
                 break
-            if args.save_all:
+            # per-epoch checkpoints also feed evaluate_checkpoints.py when CER is not computed inline
+            if (args.save_all or args.no_inline_cer) and is_main:
                 epoch_model_path = os.path.join(args.save_directory, 'model_{:0>2d}.ckpt'.format(e+1))
-                torch.save(model.state_dict(), epoch_model_path)
+                saver.save(model.state_dict(), epoch_model_path)
 
-            print_log('Val Loss: %f' % val_loss, LOG_PATH)
-            print_log('Avg Val Perplexity: %f' % (tot_perp/len(train_loader.dataset)), LOG_PATH)
-            cer_val = cer(args, model, dev_loader, charset, dev_ys)
-            print_log('CER: %f' % cer_val, LOG_PATH)
+            log('Val Loss: %f' % val_loss, LOG_PATH)
+            log('Avg Val Perplexity: %f' % (tot_perp/max(num_dev, 1)), LOG_PATH)
+            if not args.no_inline_cer:
+                log('CER: %f' % (cer_sum / max(num_cer, 1)), LOG_PATH)
+            if is_main:
+                save_state(e+1, 0, None, None, 0, 0, 0)
 
         # log
         '''
@@ -568,6 +1331,10 @@ def main():
     args=args, model=model, loader=test_loader, charset=charset)
     '''
 
+    saver.close()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
+
 if __name__ == '__main__':
     main()
 
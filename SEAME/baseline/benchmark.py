@@ -0,0 +1,261 @@
+'''
+Script to time model components on random inputs
+
+Supported bench-mode values: encoder, attention, checkpoint, pool, stream
+'''
+
+import argparse
+import numpy as np
+import os
+import time
+import torch
+
+from baseline import DecoderModel, EncoderModel, Seq2SeqModel, TransformerEncoderModel, INPUT_DIM
+from model_utils import *
+from streaming import StreamingRecognizer
+from transcribe import frame_batches, pool_transcripts
+
+
+def random_batch(batch_size, max_frames, min_frames=None):
+    '''
+    Return:
+        uarray: shape (max_frames, batch_size, INPUT_DIM)
+        ulens: shape (batch_size,)
+    '''
+    if min_frames is None:
+        min_frames = max_frames // 2
+    ulens = torch.IntTensor(np.random.randint(min_frames, max_frames + 1, size=batch_size))
+    ulens[0] = max_frames
+    uarray = torch.randn(max_frames, batch_size, INPUT_DIM)
+    return uarray, ulens
+
+
+def time_fn(fn, repeats):
+    fn()  # warm-up
+    t0 = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - t0) / repeats
+
+
+def bench_encoder(args):
+    for encoder_type in ['lstm', 'transformer']:
+        args.encoder_type = encoder_type
+        if encoder_type == 'lstm':
+            model = EncoderModel(args)
+        else:
+            model = TransformerEncoderModel(args)
+        model.train()
+        for max_frames in args.frames:
+            uarray, ulens = random_batch(args.batch_size, max_frames)
+
+            def step():
+                keys, values, lengths = model(uarray, ulens)
+                (keys.sum() + values.sum()).backward()
+            sec = time_fn(step, args.repeats)
+            print('%s encoder, %d frames: %.4f seconds per batch' % (encoder_type, max_frames, sec))
+
+
+def saved_bytes(fn, model):
+    '''Total size of the activations saved for backward while running fn
+
+    Each storage is counted once, since the LSTM saves views of the same buffers
+    at every timestep, and the model's parameters are skipped, since they are
+    held anyway.
+    '''
+    params = set(p.untyped_storage().data_ptr() for p in model.parameters())
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in params:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, sum(storages.values())
+
+
+def bench_checkpoint(args):
+    # Compares activation memory and step time of the lstm encoder with and without checkpointing
+    configs = [[], [3], [1, 2, 3], [0, 1, 2, 3]]
+    for layers in configs:
+        args.checkpoint_encoder = layers
+        model = EncoderModel(args)
+        model.train()
+        if args.cuda:
+            model = model.cuda()
+        for max_frames in args.frames:
+            uarray, ulens = random_batch(args.batch_size, max_frames)
+            if args.cuda:
+                uarray = uarray.cuda()
+
+            def forward():
+                keys, values, lengths = model(uarray, ulens)
+                return keys.sum() + values.sum()
+
+            def step():
+                forward().backward()
+            loss, saved = saved_bytes(forward, model)
+            del loss
+            if args.cuda:
+                torch.cuda.reset_peak_memory_stats()
+            sec = time_fn(step, args.repeats)
+            peak = ', peak %.1f MB' % (torch.cuda.max_memory_allocated() / 2**20) if args.cuda else ''
+            print('checkpoint layers %s, %d frames: %.4f seconds per step, %.1f MB saved for backward%s' % (
+                layers, max_frames, sec, saved / 2**20, peak))
+
+
+def bench_attention(args):
+    # Compares full and windowed attention in greedy decoding over encoder length buckets
+    decoder = DecoderModel(args, vocab_size=args.vocab_size)
+    decoder.eval()
+    for num_frames in args.frames:
+        keys = torch.randn(num_frames, args.batch_size, args.key_dim)
+        values = torch.randn(num_frames, args.batch_size, args.value_dim)
+        lengths = torch.LongTensor(np.random.randint(num_frames // 2, num_frames + 1, size=args.batch_size))
+        lengths[0] = num_frames
+        inputs = torch.zeros(1, args.batch_size).long()
+        input_lengths = torch.ones(args.batch_size).long()
+        for window in [0, args.attention_window]:
+            decoder.attention_window = window
+
+            def step():
+                with torch.no_grad():
+                    decoder(inputs, input_lengths, keys, values, lengths, future=args.generator_length)
+            sec = time_fn(step, args.repeats)
+            print('window %d, %d encoder frames: %.4f seconds per batch' % (window, num_frames, sec))
+
+
+def bench_pool(args):
+    # Sweeps worker processes x threads per worker for CPU greedy decoding with transcribe.py's pool
+    args.cuda = False
+    args.encoder_type = 'lstm'
+    args.stream_chunk = 0
+    args.ctc_weight = 0.
+    args.decode_mode = 'greedy'
+    model = Seq2SeqModel(args, vocab_size=args.vocab_size)
+    model.eval()
+    charset = [chr(0x4e00 + i) for i in range(args.vocab_size)]
+    max_frames = args.frames[0]
+    lengths = np.random.randint(max_frames // 2, max_frames + 1, size=args.pool_utterances).tolist()
+    dataset = [(torch.randn(l, INPUT_DIM), None) for l in lengths]
+    batches = frame_batches(lengths, args.batch_size * max_frames)
+    base = None
+    for workers in args.pool_workers:
+        for threads in args.pool_threads:
+            t0 = time.time()
+            for _ in pool_transcripts(args, model, dataset, batches, charset, workers, threads):
+                pass
+            rate = len(lengths) / (time.time() - t0)
+            if base is None:
+                base = rate / (workers * threads)
+            oversubscribed = ' (oversubscribed)' if workers * threads > (os.cpu_count() or 1) else ''
+            print('%d workers x %d threads: %.2f utterances per second, %.2fx single-core, %.0f%% efficiency%s' % (
+                workers, threads, rate, rate / base, 100 * rate / (base * workers * threads), oversubscribed))
+
+
+def bench_stream(args):
+    # Feeds random utterances in real time and compares first- and final-token latency
+    # of streaming decoding with offline decoding once the utterance has ended
+    args.cuda = False
+    args.encoder_type = 'lstm'
+    args.ctc_weight = 0.
+    model = Seq2SeqModel(args, vocab_size=args.vocab_size)
+    model.eval()
+    charset = [chr(0x4e00 + i) for i in range(args.vocab_size)]
+    recognizer = StreamingRecognizer(model, charset, max_len=args.generator_length)
+    for num_frames in args.frames:
+        utterance = torch.randn(num_frames, INPUT_DIM)
+        duration = num_frames * args.frame_shift
+        first, final, tokens = [], [], []
+        for _ in range(args.repeats):
+            # simulated clock: frames arrive every frame_shift seconds and
+            # the recognizer handles them once it is done with earlier ones
+            recognizer.reset()
+            clock = 0.
+            first_token = None
+            for start in range(0, num_frames, args.push_frames):
+                end = min(start + args.push_frames, num_frames)
+                clock = max(clock, end * args.frame_shift)
+                t0 = time.time()
+                kept = recognizer.push(utterance[start:end])
+                clock += time.time() - t0
+                if kept and first_token is None:
+                    first_token = clock
+            clock = max(clock, duration)
+            t0 = time.time()
+            recognizer.finish()
+            clock += time.time() - t0
+            first.append(first_token if first_token is not None else clock)
+            final.append(clock - duration)
+            tokens.append(len(recognizer.tokens))
+
+        # offline: the bidirectional encoder with the same weights, then greedy decoding
+        def offline():
+            with torch.no_grad():
+                keys, values, lengths = EncoderModel.forward(
+                    model.encoder, utterance.unsqueeze(1), torch.IntTensor([num_frames]))
+                model.decoder.beam_search(keys[:, 0], values[:, 0], beam_width=1, max_len=args.generator_length)
+        offline_sec = time_fn(offline, args.repeats)
+        print('%.2f seconds of audio: streaming first token %.3f s after the audio starts, final token %.3f s after it ends (%.0f tokens); offline final token %.3f s after it ends' % (
+            duration, np.mean(first), np.mean(final), np.mean(tokens), offline_sec))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench-mode', type=str, default='encoder', help='Benchmark mode: encoder, attention, checkpoint, pool, stream')
+    parser.add_argument('--batch-size', type=int, default=32, metavar='N', help='batch size')
+    parser.add_argument('--frames', type=int, nargs='+', default=[500, 1000, 2000], help='max frames per batch')
+    parser.add_argument('--repeats', type=int, default=5, metavar='N', help='timed repetitions')
+    parser.add_argument('--threads', type=int, default=0, metavar='N', help='intra-op threads (0 keeps default)')
+    parser.add_argument('--no-cuda', action='store_true', default=False, help='benchmark on CPU only')
+
+    parser.add_argument('--encoder-dim', type=int, default=256, metavar='N', help='hidden dimension')
+    parser.add_argument('--checkpoint-encoder', type=int, nargs='*', default=[], metavar='N', help='lstm encoder layers (0-3) to recompute on backward')
+    parser.add_argument('--encoder-layers', type=int, default=6, metavar='N', help='transformer encoder layers')
+    parser.add_argument('--encoder-heads', type=int, default=4, metavar='N', help='transformer attention heads')
+    parser.add_argument('--encoder-ff-dim', type=int, default=1024, metavar='N', help='transformer feedforward dimension')
+    parser.add_argument('--encoder-dropout', type=float, default=0.1, metavar='N', help='transformer dropout')
+    parser.add_argument('--value-dim', type=int, default=128, metavar='N', help='hidden dimension')
+    parser.add_argument('--key-dim', type=int, default=128, metavar='N', help='hidden dimension')
+    parser.add_argument('--decoder-dim', type=int, default=512, metavar='N', help='hidden dimension')
+    parser.add_argument('--vocab-size', type=int, default=3000, metavar='N', help='decoder vocabulary size')
+    parser.add_argument('--teacher-force-rate', type=float, default=0.9, metavar='N', help='teacher forcing rate')
+    parser.add_argument('--generator-length', type=int, default=250, metavar='N', help='maximum length to generate')
+    parser.add_argument('--attention-window', type=int, default=16, metavar='N', help='windowed attention half-width')
+    parser.add_argument('--attention-confidence', type=float, default=0.1, metavar='N', help='minimum previous attention peak for windowed attention')
+    parser.add_argument('--pool-workers', type=int, nargs='+', default=[1, 2, 4, 8], help='worker process counts for the pool benchmark')
+    parser.add_argument('--pool-threads', type=int, nargs='+', default=[1, 2, 4], help='threads per worker for the pool benchmark')
+    parser.add_argument('--pool-utterances', type=int, default=64, metavar='N', help='utterances decoded per pool configuration')
+    parser.add_argument('--stream-chunk', type=int, default=32, metavar='N', help='input frames per chunk for the stream benchmark')
+    parser.add_argument('--stream-right-context', type=int, default=16, metavar='N', help='look-ahead input frames per chunk for the stream benchmark')
+    parser.add_argument('--push-frames', type=int, default=10, metavar='N', help='input frames per push in the stream benchmark')
+    parser.add_argument('--frame-shift', type=float, default=0.01, metavar='N', help='seconds of audio per input frame')
+    parser.add_argument('--beam-width', type=int, default=5, metavar='N', help='Beam search width')
+    parser.add_argument('--ctc-decode-weight', type=float, default=0.3, metavar='N', help='CTC prefix score weight in beam search')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print('Using %d threads' % torch.get_num_threads())
+    if args.bench_mode == 'encoder':
+        bench_encoder(args)
+    elif args.bench_mode == 'attention':
+        bench_attention(args)
+    elif args.bench_mode == 'checkpoint':
+        bench_checkpoint(args)
+    elif args.bench_mode == 'pool':
+        bench_pool(args)
+    elif args.bench_mode == 'stream':
+        bench_stream(args)
+    else:
+        raise ValueError('unknown bench-mode: %s' % args.bench_mode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Script to score checkpoints written by baseline.py off the training process
+
+Polls the save directory for new or updated model.ckpt (best model) and
+model_XX.ckpt (per-epoch, see --save-all and --no-inline-cer) files, decodes
+the first --eval-max-dev dev utterances with --decode-mode and appends the CER
+to the metrics file, e.g.
+
+    python3 evaluate_checkpoints.py --save-directory output/baseline/v1 --decode-mode ctc_greedy
+
+The trainer writes checkpoints with an atomic rename, so a checkpoint is never
+read half-written
+'''
+
+import glob
+import numpy as np
+import os
+import time
+import torch
+
+from baseline import parse_args, Seq2SeqModel
+from model_utils import *
+
+
+def find_checkpoints(save_directory):
+    '''
+    Return:
+        list of (path, mtime), oldest first
+    '''
+    paths = glob.glob(os.path.join(save_directory, 'model.ckpt'))
+    paths += glob.glob(os.path.join(save_directory, 'model_[0-9]*.ckpt'))
+    ckpts = []
+    for path in paths:
+        try:
+            ckpts.append((path, os.path.getmtime(path)))
+        except OSError: # replaced between glob and stat
+            pass
+    return sorted(ckpts, key=lambda c: c[1])
+
+
+def load_evaluated(metrics_path):
+    # (checkpoint name, mtime) pairs already in the metrics file
+    evaluated = set()
+    if os.path.exists(metrics_path):
+        with open(metrics_path, 'r') as inf:
+            for line in inf.readlines()[1:]:
+                fields = line.strip().split('\t')
+                evaluated.add((fields[0], fields[1]))
+    return evaluated
+
+
+def evaluate_checkpoint(args, model, path, loader, charset, ys):
+    '''
+    Return:
+        cer: average normalized CER over ys
+        seconds: decoding and scoring time
+    '''
+    t0 = time.time()
+    model.load_state_dict(torch.load(path, map_location=lambda storage, loc: storage))
+    with torch.no_grad():
+        cer_val = cer(args, model, loader, charset, ys)
+    return cer_val, time.time() - t0
+
+
+def main():
+    args = parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    print("Loading Data")
+    _, dev_paths, _ = load_paths()
+    dev_paths = dev_paths[:args.max_dev][:args.max_data][:args.eval_max_dev]
+    train_ys = load_y_data('train')
+    dev_ys = load_y_data('dev')
+    test_ys = load_y_data('test')
+    charset = build_charset(np.concatenate((train_ys, dev_ys, test_ys), axis=0))
+    charmap = make_charmap(charset)
+    dev_ys = dev_ys[:len(dev_paths)]
+    devchars = map_characters(dev_ys, charmap)
+    # unshuffled, so that transcripts line up with dev_ys
+    dev_loader = make_loader(dev_paths, devchars, args, shuffle=False, batch_size=args.batch_size)
+
+    print("Building Model")
+    model = Seq2SeqModel(args, vocab_size=len(charset))
+    if args.cuda:
+        model = model.cuda()
+
+    METRICS_PATH = os.path.join(args.save_directory, args.metrics_file)
+    if not os.path.exists(METRICS_PATH):
+        with open(METRICS_PATH, 'w') as ouf:
+            ouf.write('checkpoint\tmtime\tcer\tseconds\n')
+    evaluated = load_evaluated(METRICS_PATH)
+
+    while True:
+        for path, mtime in find_checkpoints(args.save_directory):
+            key = (os.path.basename(path), '%.3f' % mtime)
+            if key in evaluated:
+                continue
+            try:
+                cer_val, sec = evaluate_checkpoint(args, model, path, dev_loader, charset, dev_ys)
+            except (IOError, OSError) as e: # replaced while loading, picked up on the next poll
+                print('skipping %s: %s' % (path, e))
+                continue
+            evaluated.add(key)
+            with open(METRICS_PATH, 'a') as ouf:
+                ouf.write('%s\t%s\t%f\t%.2f\n' % (key[0], key[1], cer_val, sec))
+            print('%s CER: %f (%.2f Seconds)' % (key[0], cer_val, sec))
+        if args.eval_once:
+            break
+        time.sleep(args.eval_poll)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+'''
+Script to spawn local data-parallel workers for baseline.py
+
+Takes the same arguments as baseline.py; --world-size sets the number of
+worker processes. Uses the gloo backend by default so it also runs on CPU-only
+machines, e.g.
+
+    python3 launch_distributed.py --world-size 4 --no-cuda --save-directory output/ddp
+'''
+
+import torch.multiprocessing as mp
+
+from baseline import main, parse_args
+
+
+def run_worker(rank, args):
+    args.rank = rank
+    main(args)
+
+
+def launch():
+    args = parse_args()
+    args.distributed = True
+    mp.spawn(run_worker, args=(args,), nprocs=args.world_size, join=True)
+
+
+if __name__ == '__main__':
+    launch()
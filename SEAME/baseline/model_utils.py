@@ -12,15 +12,25 @@ Peter Wu
 peterw1@andrew.cmu.edu
 '''
 
+import gc
 import itertools
+import math
 import os
 import numpy as np
+import queue
+import random
+import sys
+import threading
 import torch
+import torch.distributed as dist
 
-from nltk.metrics import edit_distance
 from torch.autograd import Variable
 from torch.utils.data import DataLoader, Dataset
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))  # shared modules
+from sampler import BucketBatchSampler
+from scoring import edit_distances, error_rates
+
 def output_mask(maxlen, lengths):
     """
     Create a mask on-the-fly
@@ -108,6 +118,94 @@ def decode_output(output, charset):
         chars.append(charset[o - 1])
     return "".join(chars)
 
+def ctc_greedy_decode(log_probs, lengths):
+    '''Single-pass CTC decoding: framewise argmax, merge repeats, drop blanks
+
+    Index 0 is the CTC blank (the decoder's start/end token never occurs inside
+    a transcript)
+
+    Args:
+        log_probs: shape (T, B, vocab_size)
+        lengths: shape (B,)
+
+    Return:
+        list of B int lists
+    '''
+    best = torch.max(log_probs, 2)[1].transpose(0, 1).cpu().numpy()  # (B, T)
+    lengths = lengths.cpu().numpy()
+    outputs = []
+    for i in range(best.shape[0]):
+        path = best[i, :lengths[i]]
+        keep = np.ones(len(path), dtype=bool)
+        keep[1:] = path[1:] != path[:-1]
+        keep &= path != 0
+        outputs.append(path[keep].tolist())
+    return outputs
+
+class CTCPrefixScorer(object):
+    '''Computes CTC prefix probabilities for one utterance
+
+    Used in beam search to rescore attention candidates. Index 0 is both the CTC
+    blank and the decoder end token, so extending a prefix with 0 scores the
+    probability of the prefix being complete.
+
+    States are (r, psi, last): r has shape (T, 2) holding the log probabilities of
+    the prefix ending in a non-blank and a blank at each frame, psi is the prefix
+    score and last is the final label (None for the empty prefix). Both frame
+    recursions are linear in the probability domain, so they are solved with
+    cumulative sums and logcumsumexp instead of a loop over frames, in float64
+    to keep the long cumulative sums accurate
+    '''
+    def __init__(self, log_probs):
+        '''
+        Args:
+            log_probs: shape (T, vocab_size), only valid frames
+        '''
+        self.log_probs = log_probs.double()
+        self.num_frames = log_probs.size(0)
+
+    def initial_state(self):
+        r = self.log_probs.new_full((self.num_frames, 2), -float('inf'))
+        r[:, 1] = torch.cumsum(self.log_probs[:, 0], 0)
+        return r, 0.0, None
+
+    def score(self, states, candidates):
+        '''Scores the candidate extensions of several prefixes at once
+
+        Args:
+            states: list of n (r, psi, last) prefix states
+            candidates: LongTensor of labels, shape (n, K)
+
+        Return:
+            psi: prefix scores of the extended prefixes, shape (n, K)
+            r: shape (T, 2, n, K)
+        '''
+        n, num_cands = candidates.size()
+        r_prev = torch.stack([s[0] for s in states], 1)  # (T, n, 2)
+        x = self.log_probs[:, candidates]  # (T, n, K)
+        blank = self.log_probs[:, 0].view(-1, 1, 1)  # (T, 1, 1)
+        r_sum = torch.logsumexp(r_prev, 2)  # (T, n)
+        lasts = torch.LongTensor([-1 if s[2] is None else s[2] for s in states]).to(candidates.device)
+        # a repeated label needs a blank in between
+        phi = torch.where((candidates == lasts.unsqueeze(1)).unsqueeze(0),
+                          r_prev[:, :, 1:], r_sum.unsqueeze(2))  # (T, n, K)
+        neg_inf = x.new_full((1, n, num_cands), -float('inf'))
+        empty = torch.BoolTensor([s[2] is None for s in states]).to(candidates.device).view(1, n, 1)
+        start = torch.where(empty, x[0:1], neg_inf)
+
+        # r[t, 0] = logaddexp(r[t-1, 0], phi[t-1]) + x[t]
+        a = torch.cat((start, phi[:-1] + x[1:]), 0)  # (T, n, K)
+        cx = torch.cumsum(x, 0)
+        r0 = cx + torch.logcumsumexp(a - cx, 0)
+        # r[t, 1] = logaddexp(r[t-1, 1], r[t-1, 0]) + blank[t]
+        c = torch.cat((neg_inf, r0[:-1] + blank[1:]), 0)
+        cb = torch.cumsum(blank, 0)
+        r1 = cb + torch.logcumsumexp(c - cb, 0)
+
+        psi = torch.logsumexp(a, 0)  # (n, K)
+        psi = torch.where(candidates == 0, r_sum[-1].unsqueeze(1), psi)
+        return psi, torch.stack((r0, r1), 1)
+
 def generate_transcripts(args, model, loader, charset):
     '''Iteratively returns string transcriptions
     
@@ -126,6 +224,19 @@ def generate_transcripts(args, model, loader, charset):
         l1array = Variable(l1array)
         llens = Variable(llens)
 
+        if args.decode_mode == 'ctc_greedy':
+            log_probs, lens = model.forward_ctc(uarray, ulens)
+            for output in ctc_greedy_decode(log_probs, lens):
+                yield decode_output(output, charset)
+            continue
+        if args.decode_mode == 'beam':
+            outputs = model.beam_search(
+                uarray, ulens, beam_width=args.beam_width,
+                max_len=args.generator_length, ctc_weight=args.ctc_decode_weight)
+            for output in outputs:
+                yield decode_output(output, charset)
+            continue
+
         logits, generated, lens = model(
             uarray, ulens, l1array, llens,
             future=args.generator_length)
@@ -145,46 +256,27 @@ def cer(args, model, loader, charset, ys, truncate=True):
         number
     '''
     model.eval()
-    norm_dists = []
-    transcripts = generate_transcripts(args, model, loader, charset)
-    for i, t in enumerate(transcripts):
-        if truncate:
-            dist = edit_distance(t[:len(ys[i])], ys[i])
-        else:
-            dist = edit_distance(t, ys[i])
-        norm_dist = dist / len(ys[i])
-        norm_dists.append(norm_dist)
+    transcripts = list(generate_transcripts(args, model, loader, charset))
+    if truncate:
+        transcripts = [t[:len(ys[i])] for i, t in enumerate(transcripts)]
+    dists = edit_distances(transcripts, ys[:len(transcripts)])
+    norm_dists = [d / len(y) for d, y in zip(dists, ys)]
     return sum(norm_dists)/len(ys)
 
-def cer_from_transcripts(transcripts, ys, log_path, truncate=True, spaces='best'):
+def cer_from_transcripts(transcripts, ys, log_path, truncate=True, spaces='best', processes=1):
     '''
     Return:
         norm_dists: list of CER values
         dist: edit distances
         spaces: no, yes, best (to account for incongruity in raw data spacing)
     '''
-    norm_dists = []
-    dists = []
-    for i, t in enumerate(transcripts):
-        curr_t = t
-        curr_y = ys[i]
-        if len(curr_y) == 0:
+    for i, y in enumerate(ys[:len(transcripts)]):
+        if len(y) == 0:
             print('%d is 0' % i)
-        curr_t_nos = curr_t.replace(' ', '')
-        curr_y_nos = curr_y.replace(' ', '')
-        if truncate:
-            curr_t = curr_t[:len(curr_y)]
-            curr_t_nos = curr_t_nos[:len(curr_y_nos)]
-        dist = edit_distance(curr_t, curr_y)
-        norm_dist = dist / len(curr_y)
-        dist_nos = edit_distance(curr_t_nos, curr_y_nos)
-        norm_dist_nos = dist_nos / len(curr_y_nos)
-        best_dist = min(dist, dist_nos)
-        best_norm = min(norm_dist, norm_dist_nos)
-        with open(log_path, 'a') as ouf:
+    norm_dists, dists = error_rates(transcripts, ys, truncate=truncate, spaces=spaces, processes=processes)
+    with open(log_path, 'a') as ouf:
+        for best_dist, best_norm in zip(dists, norm_dists):
             ouf.write('dist: %.2f, norm_dist: %.2f\n' % (best_dist, best_norm))
-        norm_dists.append(best_norm)
-        dists.append(best_dist)
     return norm_dists, dists
 
 def print_log(s, log_path):
@@ -313,14 +405,269 @@ def load_y_data(stage):
     ys = [y.strip() for y in ys]
     return np.array(ys)
 
-def make_loader(ids, labels, args, shuffle=True, batch_size=64):
+def read_frame_counts(index_path):
+    '''Reads the frame count index, skipping malformed (e.g. truncated) lines
+
+    Return:
+        dict mapping mfcc paths to frame counts
+    '''
+    counts = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as inf:
+            for l in inf:
+                fields = l.rstrip('\n').rsplit('\t', 1)
+                if len(fields) == 2 and fields[1].isdigit():
+                    counts[fields[0]] = int(fields[1])
+    return counts
+
+def load_frame_counts(paths, args=None):
+    '''Number of frames in each mfcc file
+
+    Counts are kept in split/frame_counts.tsv, so each file is only read once
+    over all runs. The index is rewritten to a temporary file and moved into
+    place, and when args.distributed is set only rank 0 updates it while the
+    other replicas wait at a barrier.
+
+    Return:
+        list of ints, aligned with paths
+    '''
+    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    index_path = os.path.join(parent_dir, 'split', 'frame_counts.tsv')
+    distributed = args is not None and args.distributed
+    if not distributed or args.rank == 0:
+        counts = read_frame_counts(index_path)
+        missing = set(p for p in paths if p not in counts)
+        if missing:
+            for path in missing:
+                # mfcc files hold one frame per line
+                with open(path, 'r') as inf:
+                    counts[path] = sum(1 for l in inf if l.strip())
+            tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+            with open(tmp_path, 'w') as ouf:
+                for path in sorted(counts):
+                    ouf.write('%s\t%d\n' % (path, counts[path]))
+            os.replace(tmp_path, index_path)
+    if distributed:
+        dist.barrier()
+        if args.rank != 0:
+            counts = read_frame_counts(index_path)
+    return [counts[p] for p in paths]
+
+def make_loader(ids, labels, args, shuffle=True, batch_size=64, bucket=False):
     '''
     Args:
         features: list of file id strings (files contain x values)
         labels: list of 1-dim int np arrays
+        bucket: batch by input frames with BucketBatchSampler, sharded over
+            replicas when args.distributed is set
     '''
     # Build the DataLoaders
     kwargs = {'pin_memory': True, 'num_workers': args.num_workers} if args.cuda else {}
     dataset = ASRDataset(ids, labels)
+    if bucket:
+        lengths = load_frame_counts(ids, args)
+        num_replicas, rank = (args.world_size, args.rank) if args.distributed else (1, 0)
+        sampler = BucketBatchSampler(lengths, batch_size, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
+        return DataLoader(dataset, collate_fn=speech_collate_fn, batch_sampler=sampler, **kwargs)
     loader = DataLoader(dataset, collate_fn=speech_collate_fn, shuffle=shuffle, batch_size=batch_size, **kwargs)
-    return loader
\ No newline at end of file
+    return loader
+
+def setup_distributed(args):
+    '''Joins the process group when args.distributed is set
+
+    Return:
+        True on the process that logs and saves checkpoints (rank 0)
+    '''
+    if not args.distributed:
+        return True
+    os.environ.setdefault('MASTER_ADDR', args.master_addr)
+    os.environ.setdefault('MASTER_PORT', str(args.master_port))
+    dist.init_process_group(args.dist_backend, rank=args.rank, world_size=args.world_size)
+    if args.cuda:
+        torch.cuda.set_device(args.rank % torch.cuda.device_count())
+    return args.rank == 0
+
+def all_reduce_sum(args, *values):
+    '''Sums python numbers over all replicas (no-op unless distributed)
+
+    Return:
+        list of floats
+    '''
+    if not args.distributed:
+        return [float(v) for v in values]
+    tens = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    if args.cuda:
+        tens = tens.cuda()
+    dist.all_reduce(tens)
+    return tens.tolist()
+
+def all_reduce_gradients(args, parameters):
+    '''Sums gradients over all replicas in one flattened all-reduce
+
+    Parameters without a gradient get zeros so that every replica reduces
+    tensors of the same shape
+    '''
+    if not args.distributed:
+        return
+    params = list(parameters)
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    flat = torch.cat([p.grad.data.view(-1) for p in params])
+    dist.all_reduce(flat)
+    offset = 0
+    for p in params:
+        n = p.grad.numel()
+        p.grad.data.copy_(flat[offset:offset+n].view_as(p.grad))
+        offset += n
+
+def is_oom_error(e):
+    # CUDA OOM and CPU allocator failures both surface as RuntimeError
+    msg = str(e)
+    return isinstance(e, RuntimeError) and (
+        'out of memory' in msg or "can't allocate memory" in msg or 'DefaultCPUAllocator' in msg)
+
+def free_memory(args):
+    gc.collect()
+    if args.cuda:
+        torch.cuda.empty_cache()
+
+def slice_batch(batch, idx):
+    '''Selects the utterances idx from a collated batch, trimming the padding
+
+    Args:
+        batch: (uarray, ulens, l1array, llens, l2array) from speech_collate_fn
+        idx: LongTensor of batch indices
+    '''
+    uarray, ulens, l1array, llens, l2array = batch
+    ulens, llens = ulens[idx], llens[idx]
+    umax, lmax = int(ulens.max()), int(llens.max())
+    return uarray[:umax, idx], ulens, l1array[:lmax, idx], llens, l2array[:lmax, idx]
+
+class SafeBatchSizes(object):
+    '''Largest micro-batch size known to fit in memory, per utterance length bucket
+
+    Buckets are max_frames // bucket_frames. A failure in one bucket also caps
+    every longer bucket, since longer utterances never need less memory
+    '''
+    def __init__(self, bucket_frames=200):
+        self.bucket_frames = bucket_frames
+        self.sizes = {}
+        self.events = 0
+        self.dropped = 0
+
+    def bucket(self, max_frames):
+        return int(max_frames) // self.bucket_frames
+
+    def get(self, bucket, batch_size):
+        for b, size in self.sizes.items():
+            if b <= bucket:
+                batch_size = min(batch_size, size)
+        return batch_size
+
+    def record(self, bucket, failed_size):
+        self.events += 1
+        self.sizes[bucket] = min(self.sizes.get(bucket, failed_size), max(failed_size // 2, 1))
+
+    def state_dict(self):
+        return {'sizes': dict(self.sizes), 'events': self.events, 'dropped': self.dropped}
+
+    def load_state_dict(self, state):
+        self.sizes = dict(state['sizes'])
+        self.events = state['events']
+        self.dropped = state['dropped']
+
+    def summary(self):
+        sizes = ', '.join('%d-%d frames: %d' % (b*self.bucket_frames, (b+1)*self.bucket_frames, self.sizes[b])
+                          for b in sorted(self.sizes))
+        return 'OOM Events: %d, Dropped Utterances: %d, Safe Sizes: {%s}' % (self.events, self.dropped, sizes)
+
+def epoch_loader(loader, batches):
+    '''DataLoader over a fixed list of index batches drawn from loader's batch sampler
+
+    Lets a resumed epoch replay the same batch order and skip the batches
+    that were already trained on without loading them
+    '''
+    return DataLoader(loader.dataset, batch_sampler=batches, collate_fn=loader.collate_fn,
+                      num_workers=loader.num_workers, pin_memory=loader.pin_memory)
+
+def get_rng_states():
+    # the numpy key array is stored as a tensor so the state also loads with weights_only
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    numpy_state = (name, torch.from_numpy(keys.astype(np.int64)), int(pos), int(has_gauss), float(cached))
+    states = {'python': random.getstate(), 'numpy': numpy_state, 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    name, keys, pos, has_gauss, cached = states['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached))
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+def cpu_copy(obj):
+    # snapshot of (nested) checkpoint contents that later training steps cannot modify
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+def atomic_save(obj, path):
+    # write to a temporary file and rename it, so path is never left half-written
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as ouf:
+        torch.save(obj, ouf)
+        ouf.flush()
+        os.fsync(ouf.fileno())
+    os.replace(tmp_path, path)
+
+class CheckpointSaver(object):
+    '''Writes checkpoints with atomic_save from a background thread
+
+    save() only copies the tensors to CPU memory before returning, so
+    serialization and disk writes overlap with training. Errors from the
+    writer thread are raised on the next call
+    '''
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            obj, path = item
+            try:
+                atomic_save(obj, path)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, obj, path):
+        self.check()
+        self.queue.put((cpu_copy(obj), path))
+
+    def wait(self):
+        # blocks until every queued checkpoint is on disk
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
@@ -0,0 +1,407 @@
+'''
+Local transcription server with micro-batching
+
+Loads the model once and serves it over HTTP on --host/--port, or on a Unix
+socket with --socket-path. Requests wait in a queue until --max-wait-ms after
+the first waiting request or until one more request would exceed
+--batch-frames padded frames. The batch is then decoded with --decode-mode in
+a single executor thread, so the event loop keeps accepting requests.
+
+    POST /transcribe  body is one utterance, chosen by Content-Type:
+                      application/x-npy (np.save of a (frames, 39) array),
+                      audio/wav (16-bit PCM, needs torchaudio) or
+                      text/plain (np.savetxt format, like the .mfcc files)
+    GET /stats        latency percentiles, queue depth and batch sizes
+
+e.g.
+    python3 serve.py --save-directory output/baseline/v1 --port 8000 --decode-mode beam --lm-path ../../lm/models/best.pt
+    curl -H 'Content-Type: application/x-npy' --data-binary @utt.npy localhost:8000/transcribe
+    python3 serve.py --port 8000 --client utt1.mfcc utt2.npy
+
+Local testing without data or a checkpoint:
+    python3 serve.py --random-weights --port 0 --smoke-test 64
+'''
+
+import asyncio
+import collections
+import io
+import json
+import numpy as np
+import os
+import sys
+import time
+import torch
+import torch.nn.functional as F
+import wave
+
+from concurrent.futures import ThreadPoolExecutor
+
+from baseline import parse_args, Seq2SeqModel, INPUT_DIM
+from model_utils import *
+from transcribe import load_model
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def wav_to_features(body):
+    '''13 Kaldi MFCCs (25 ms frames every 10 ms) with deltas and delta-deltas
+
+    These must match the features the model was trained on; send
+    precomputed features otherwise
+    '''
+    import torchaudio # only needed for WAV requests
+    with wave.open(io.BytesIO(body), 'rb') as w:
+        if w.getsampwidth() != 2:
+            raise ValueError('expected 16-bit PCM WAV')
+        rate = w.getframerate()
+        channels = w.getnchannels()
+        samples = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2')
+    samples = samples.reshape(-1, channels).mean(1).astype(np.float32)
+    mfcc = torchaudio.compliance.kaldi.mfcc(torch.from_numpy(samples)[None, :], sample_frequency=rate, num_ceps=13)
+    mfcc = mfcc.t() # shape: (13, frames)
+    deltas = torchaudio.functional.compute_deltas(mfcc)
+    delta_deltas = torchaudio.functional.compute_deltas(deltas)
+    return torch.cat([mfcc, deltas, delta_deltas], 0).t().numpy()
+
+
+def parse_features(body, content_type):
+    '''
+    Return:
+        FloatTensor with shape (frames, INPUT_DIM)
+    '''
+    if content_type == 'application/x-npy':
+        feats = np.load(io.BytesIO(body), allow_pickle=False)
+    elif content_type in ('audio/wav', 'audio/x-wav', 'audio/wave'):
+        feats = wav_to_features(body)
+    else:
+        feats = np.loadtxt(io.StringIO(body.decode('utf-8')), ndmin=2)
+    feats = np.asarray(feats, dtype=np.float32)
+    if feats.ndim != 2 or feats.shape[0] == 0 or feats.shape[1] != INPUT_DIM:
+        raise ValueError('expected features of shape (frames, %d), got %s' % (INPUT_DIM, feats.shape))
+    return torch.from_numpy(feats)
+
+
+class LMReranker(object):
+    '''Picks the beam hypothesis with the lowest lm/ language model loss, as lm/rerank.py does'''
+    def __init__(self, lm_path, lm_dir):
+        sys.path.insert(0, os.path.abspath(lm_dir))
+        argv = sys.argv
+        sys.argv = argv[:1] # lm/configs.py parses the command line on import
+        try:
+            from configs import DEVICE
+            from utils.data import las_to_lm
+        finally:
+            sys.argv = argv
+        self.device = DEVICE
+        self.las_to_lm = las_to_lm
+        self.lm = torch.load(lm_path, map_location=DEVICE, weights_only=False)
+        self.lm.to(DEVICE)
+        self.lm.eval()
+
+    def best(self, sents):
+        if any(len(sent) == 0 for sent in sents):
+            return sents[0]
+        losses = []
+        for sent in sents:
+            lm_sent = self.las_to_lm(sent.split())
+            targets = torch.LongTensor([self.lm.vocab[tok] for tok in lm_sent[1:]]).to(self.device)
+            logits = self.lm(lm_sent)[0]
+            losses.append(F.cross_entropy(logits, targets).item())
+        self.lm.detach()
+        return sents[int(np.argmin(losses))]
+
+
+class Recognizer(object):
+    def __init__(self, args, model, charset, reranker=None):
+        self.args = args
+        self.model = model
+        self.charset = charset
+        self.reranker = reranker
+
+    def decode(self, feats):
+        '''
+        Args:
+            feats: list of FloatTensors with shape (frames, INPUT_DIM)
+
+        Return:
+            list of transcripts
+        '''
+        batch = speech_collate_fn([(f, None) for f in feats])
+        with torch.no_grad():
+            if self.reranker is None or self.args.decode_mode != 'beam':
+                return list(generate_transcripts(self.args, self.model, [batch], self.charset))
+            uarray, ulens = batch[0], batch[1]
+            if self.args.cuda:
+                uarray, ulens = uarray.cuda(), ulens.cuda()
+            nbests = self.model.beam_search(
+                uarray, ulens, beam_width=self.args.beam_width, max_len=self.args.generator_length,
+                ctc_weight=self.args.ctc_decode_weight, nbest=max(self.args.beam_width, 2))
+            return [self.reranker.best([decode_output(o, self.charset) for o in nbest]) for nbest in nbests]
+
+
+class MicroBatcher(object):
+    '''Collects queued requests into batches and decodes them in an executor thread
+
+    A batch is closed max_wait seconds after its first request arrived, or
+    when one more request would take it past max_frames padded frames.
+    Requests that queued up while the previous batch was decoding are batched
+    right away
+    '''
+    def __init__(self, recognizer, max_wait, max_frames, history=10000):
+        self.recognizer = recognizer
+        self.max_wait = max_wait
+        self.max_frames = max_frames
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None # request that did not fit in the previous batch
+        self.latencies = collections.deque(maxlen=history)
+        self.batch_sizes = collections.deque(maxlen=history)
+        self.served = 0
+        self.failed = 0
+
+    async def submit(self, feats):
+        '''
+        Return:
+            transcript, size of the batch it was decoded in
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((feats, future, time.time()))
+        return await future
+
+    async def next_batch(self):
+        if self.pending is not None:
+            batch = [self.pending]
+            self.pending = None
+        else:
+            batch = [await self.queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        max_len = batch[0][0].size(0)
+        while True:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                else:
+                    item = self.queue.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            new_max_len = max(max_len, item[0].size(0))
+            if new_max_len*(len(batch)+1) > self.max_frames:
+                self.pending = item
+                break
+            batch.append(item)
+            max_len = new_max_len
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                transcripts = await loop.run_in_executor(self.executor, self.recognizer.decode, [item[0] for item in batch])
+            except Exception as e:
+                self.failed += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.time()
+            for (_, future, arrival), t in zip(batch, transcripts):
+                self.latencies.append(now - arrival)
+                if not future.done(): # the client may have gone away
+                    future.set_result((t, len(batch)))
+            self.served += len(batch)
+            self.batch_sizes.append(len(batch))
+
+    def stats(self):
+        latencies = 1000*np.array(self.latencies)
+        percentiles = {}
+        for p in [50, 90, 95, 99]:
+            percentiles['p%d' % p] = float(np.percentile(latencies, p)) if len(latencies) > 0 else None
+        return {
+            'served': self.served,
+            'failed': self.failed,
+            'queue_depth': self.queue.qsize() + (self.pending is not None),
+            'batches': len(self.batch_sizes),
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else None,
+            'latency_ms': percentiles,
+        }
+
+
+async def route(method, target, headers, body, batcher):
+    '''
+    Return:
+        HTTP status, JSON payload
+    '''
+    if method == 'GET' and target == '/stats':
+        return 200, batcher.stats()
+    if method == 'POST' and target == '/transcribe':
+        t0 = time.time()
+        content_type = headers.get('content-type', 'text/plain').split(';')[0].strip()
+        loop = asyncio.get_running_loop()
+        try:
+            feats = await loop.run_in_executor(None, parse_features, body, content_type)
+        except Exception as e:
+            return 400, {'error': str(e)}
+        try:
+            transcript, batch_size = await batcher.submit(feats)
+        except Exception as e:
+            return 500, {'error': str(e)}
+        return 200, {'transcript': transcript, 'frames': feats.size(0), 'batch_size': batch_size,
+            'latency_ms': 1000*(time.time()-t0)}
+    return 404, {'error': 'unknown endpoint %s %s' % (method, target)}
+
+
+async def handle_http(reader, writer, batcher):
+    # one request per connection
+    try:
+        request_line = await reader.readline()
+        if not request_line:
+            return
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {'error': 'malformed request: %s' % e}
+        else:
+            status, payload = await route(method, target, headers, body, batcher)
+        data = json.dumps(payload).encode('utf-8')
+        head = 'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (
+            status, REASONS[status], len(data))
+        writer.write(head.encode('latin-1') + data)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def http_request(address, method, target, body=b'', content_type='application/x-npy'):
+    '''Minimal client for the server
+
+    Args:
+        address: Unix socket path, or (host, port)
+
+    Return:
+        HTTP status, JSON payload
+    '''
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(*address)
+    head = '%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (
+        method, target, content_type, len(body))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    head, _, payload = data.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload.decode('utf-8'))
+
+
+def npy_bytes(feats):
+    f = io.BytesIO()
+    np.save(f, np.asarray(feats, dtype=np.float32))
+    return f.getvalue()
+
+
+async def smoke_test(address, num_requests, max_wait):
+    '''Sends num_requests random utterances at random times, checks the replies and prints the stats'''
+    rng = np.random.RandomState(0)
+
+    async def send(i):
+        await asyncio.sleep(rng.uniform(0, 20*max_wait))
+        feats = rng.randn(rng.randint(50, 500), INPUT_DIM)
+        status, payload = await http_request(address, 'POST', '/transcribe', npy_bytes(feats))
+        assert status == 200, payload
+        return payload
+
+    t0 = time.time()
+    replies = await asyncio.gather(*[send(i) for i in range(num_requests)])
+    seconds = time.time() - t0
+    status, payload = await http_request(address, 'POST', '/transcribe', b'not features', 'text/plain')
+    assert status == 400, payload
+    status, stats = await http_request(address, 'GET', '/stats')
+    assert status == 200 and stats['served'] == num_requests, stats
+    print('%d requests in %.2f seconds, largest batch %d' % (num_requests, seconds, max(r['batch_size'] for r in replies)))
+    print(json.dumps(stats, indent=2))
+
+
+def client_body(path):
+    if path.endswith('.npy'):
+        with open(path, 'rb') as f:
+            return f.read(), 'application/x-npy'
+    if path.endswith('.wav'):
+        with open(path, 'rb') as f:
+            return f.read(), 'audio/wav'
+    with open(path, 'rb') as f:
+        return f.read(), 'text/plain'
+
+
+async def run_client(address, paths):
+    for path in paths:
+        body, content_type = client_body(path)
+        status, payload = await http_request(address, 'POST', '/transcribe', body, content_type)
+        print('%s\t%s' % (path, payload.get('transcript', payload)))
+
+
+async def serve(args, recognizer):
+    batcher = MicroBatcher(recognizer, args.max_wait_ms/1000., args.batch_frames)
+    batch_task = asyncio.ensure_future(batcher.run())
+
+    async def handler(reader, writer):
+        await handle_http(reader, writer, batcher)
+    if args.socket_path is not None:
+        server = await asyncio.start_unix_server(handler, path=args.socket_path)
+        address = args.socket_path
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+        address = server.sockets[0].getsockname()[:2]
+    print('Serving on %s' % (address,))
+    try:
+        if args.smoke_test > 0:
+            await smoke_test(address, args.smoke_test, batcher.max_wait)
+        else:
+            await server.serve_forever()
+    finally:
+        server.close()
+        batch_task.cancel()
+        batcher.executor.shutdown(wait=False)
+
+
+def main():
+    args = parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    if args.client:
+        address = args.socket_path if args.socket_path is not None else (args.host, args.port)
+        asyncio.run(run_client(address, args.client))
+        return
+
+    print("Loading Model")
+    if args.random_weights:
+        charset = [chr(ord('a') + i) for i in range(26)] + [' ']
+        model = Seq2SeqModel(args, vocab_size=len(charset))
+        if args.cuda:
+            model = model.cuda()
+        model.eval()
+    else:
+        train_ys = load_y_data('train')
+        dev_ys = load_y_data('dev')
+        test_ys = load_y_data('test')
+        charset = build_charset(np.concatenate((train_ys, dev_ys, test_ys), axis=0))
+        model = load_model(args, len(charset), os.path.join(args.save_directory, 'model.ckpt'))
+    reranker = LMReranker(args.lm_path, args.lm_dir) if args.lm_path is not None else None
+    recognizer = Recognizer(args, model, charset, reranker)
+    asyncio.run(serve(args, recognizer))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+'''
+Incremental recognition with the latency-controlled encoder
+
+Models trained with --stream-chunk N encode utterances chunk by chunk, so
+recognition can start before an utterance ends:
+
+    recognizer = StreamingRecognizer(model, charset)
+    for frames in audio_source:  # shape (t, INPUT_DIM) tensors, any t
+        new_tokens = recognizer.push(frames)
+    recognizer.finish()
+    print(recognizer.transcript())
+
+A chunk is encoded as soon as its --stream-right-context look-ahead frames have
+arrived, so encoder latency is chunk plus look-ahead instead of the utterance
+duration. Decoding is greedy; benchmark.py --bench-mode stream measures first-
+and final-token latency against offline decoding.
+
+Streaming models take the initial decoder context from the first chunk in
+training and offline decoding too (DecoderModel.initial_frames), so it is the
+same here. Later steps still differ from offline beam_search(beam_width=1):
+their attention only covers the chunks encoded so far, so transcripts match
+offline decoding exactly only when all frames are buffered before the first
+decode (see tests/test_streaming.py).
+'''
+
+import torch
+
+from baseline import StreamingEncoderModel
+from model_utils import *
+
+
+class StreamingRecognizer(object):
+    '''Greedy recognition of one utterance whose frames arrive incrementally
+
+    After each encoded chunk, decoding runs over the keys and values so far and
+    keeps a token only if its attention peak lies before the newest chunk, i.e.
+    once attention has moved past a chunk boundary; otherwise it waits for the
+    next chunk and retries that step. finish() encodes the remaining frames and
+    decodes to the end token.
+    '''
+    def __init__(self, model, charset, max_len=250):
+        assert isinstance(model.encoder, StreamingEncoderModel), 'model needs a streaming encoder (--stream-chunk)'
+        self.encoder = model.encoder
+        self.decoder = model.decoder
+        self.charset = charset
+        self.max_len = max_len
+        self.device = next(model.parameters()).device
+        self.reset()
+
+    def reset(self):
+        '''Starts a new utterance'''
+        self.frames = torch.zeros(0, INPUT_DIM, device=self.device)  # input frames of the next chunks
+        self.states = self.encoder.initial_states(1)
+        self.keys = []  # per chunk, shape (C, key_dim)
+        self.values = []  # per chunk, shape (C, value_dim)
+        self.num_frames = 0  # encoder frames so far
+        self.boundary = 0  # first encoder frame of the newest chunk
+        self.tokens = []
+        self.input_states = [rnn.initial_state(1) for rnn in self.decoder.input_rnns]
+        self.ctx = None  # None until the first token is kept
+        self.attn = None
+        self.done = False
+
+    def push(self, frames):
+        '''Adds input frames
+
+        Args:
+            frames: shape (t, INPUT_DIM)
+
+        Return:
+            list of token ids that became final
+        '''
+        self.frames = torch.cat([self.frames, frames.to(self.device)], 0)
+        window = self.encoder.chunk + self.encoder.right_context
+        encoded = False
+        while self.frames.size(0) >= window:
+            self.encode(self.frames[:window], self.encoder.chunk)
+            self.frames = self.frames[self.encoder.chunk:]
+            encoded = True
+        return self.decode(final=False) if encoded else []
+
+    def finish(self):
+        '''Encodes the remaining frames and decodes to the end
+
+        Return:
+            list of token ids that became final
+        '''
+        window = self.encoder.chunk + self.encoder.right_context
+        while self.frames.size(0) >= self.encoder.min_frames:
+            self.encode(self.frames[:window], min(self.frames.size(0), self.encoder.chunk))
+            self.frames = self.frames[self.encoder.chunk:]
+        return self.decode(final=True)
+
+    def transcript(self):
+        return decode_output(self.tokens, self.charset)
+
+    def encode(self, window, chunk_length):
+        with torch.no_grad():
+            h, lengths, self.states = self.encoder.encode_chunk(
+                window.unsqueeze(1), [window.size(0)], [chunk_length], self.states)
+            h = h[:lengths[0], 0]
+                # shape: (C, 2*encoder_dim)
+            self.keys.append(self.encoder.key_projection(h))
+            self.values.append(self.encoder.value_projection(h))
+        self.boundary = self.num_frames
+        self.num_frames += lengths[0]
+
+    def decode(self, final):
+        '''Greedily extends the transcript over the frames encoded so far
+
+        Args:
+            final: no more frames will arrive, so every step is kept
+
+        Return:
+            list of token ids kept
+        '''
+        if self.done or self.num_frames == 0:
+            return []
+        keys = torch.cat(self.keys, 0).unsqueeze(0)
+            # shape: (1, T, key_dim)
+        values = torch.cat(self.values, 0).unsqueeze(0)
+            # shape: (1, T, value_dim)
+        mask = keys.new_ones((1, keys.size(1)))
+        kept = []
+        with torch.no_grad():
+            ctx, attn = self.ctx, self.attn
+            if ctx is None:
+                # the first chunk is always encoded by now, so this matches DecoderModel.forward
+                ctx, attn = self.decoder.initial_context(keys, values, mask, self.input_states)
+            attn = torch.cat([attn, attn.new_zeros((1, keys.size(1) - attn.size(1)))], 1)
+            while len(self.tokens) < self.max_len:
+                input_t = torch.LongTensor([self.tokens[-1] if self.tokens else 0]).to(self.device)
+                logit, _, new_ctx, new_attn, new_states = self.decoder.forward_pass(
+                    input_t=input_t, keys=keys, values=values, mask=mask, ctx=ctx,
+                    input_states=self.input_states, prev_attn=attn
+                )
+                if not final and int(new_attn.argmax(1)) >= self.boundary:
+                    break  # still attending to the newest chunk
+                ctx, attn, self.input_states = new_ctx, new_attn, new_states
+                self.ctx, self.attn = ctx, attn
+                token = int(logit.argmax(1))
+                if token == 0:
+                    self.done = True
+                    break
+                self.tokens.append(token)
+                kept.append(token)
+        if final:
+            self.done = True
+        return kept
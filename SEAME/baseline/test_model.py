@@ -88,7 +88,7 @@ def main():
     CSV_PATH = os.path.join(args.save_directory, 'submission.csv')
     
     if 'transcript' in args.test_mode:
-        print('generating transcripts')
+        print('generating transcripts (%s decoding)' % args.decode_mode)
         with open(TRANSCRIPT_LOG_PATH, 'w+') as ouf:
             pass
         if not os.path.exists(CSV_PATH):
@@ -16,12 +16,12 @@ import time
 import torch
 
 from autocorrect import spell
-from nltk.metrics import edit_distance
 from torch.autograd import Variable
 from torch.utils.data import DataLoader, Dataset
 
 from baseline import parse_args, Seq2SeqModel, write_transcripts
 from model_utils import *
+from scoring import levenshtein
 
 
 def is_chinese_char(ch):
@@ -53,7 +53,7 @@ def closest_word(word, vocab, threshold=5, sub_thres=2):
     best_dist = float("inf")
     prefix_len_best = float("inf")
     for vocab_word in vocab:
-        curr_dist = edit_distance(word, vocab_word)
+        curr_dist = levenshtein(word, vocab_word)
         if curr_dist < best_dist:
             best_dist = curr_dist
             best_word = vocab_word
@@ -74,7 +74,7 @@ def closest_word(word, vocab, threshold=5, sub_thres=2):
                     vocab_word1 = vocab_word
                     curr_dist = 0
                     break
-                dist1 = edit_distance(word1, vocab_word)
+                dist1 = levenshtein(word1, vocab_word)
                 if dist1 < curr_dist:
                     vocab_word1 = vocab_word
                     curr_dist = dist1
@@ -86,7 +86,7 @@ def closest_word(word, vocab, threshold=5, sub_thres=2):
                         vocab_word2 = vocab_word
                         curr_dist2 = 0
                         break
-                    dist2 = edit_distance(word2, vocab_word)
+                    dist2 = levenshtein(word2, vocab_word)
                     if dist2 < curr_dist2:
                         vocab_word2 = vocab_word
                         curr_dist2 = dist2
@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('numpy')
+
+from model_utils import read_frame_counts
+
+
+def test_read_frame_counts_skips_malformed_lines(tmp_path):
+    index_path = tmp_path / 'frame_counts.tsv'
+    index_path.write_text('a.mfcc\t12\nb mfcc\t7\n\nc.mfcc\nd.mfcc\t3x\ne.mfcc\t4')
+    assert read_frame_counts(str(index_path)) == {'a.mfcc': 12, 'b mfcc': 7, 'e.mfcc': 4}
+
+
+def test_read_frame_counts_missing_index(tmp_path):
+    assert read_frame_counts(str(tmp_path / 'frame_counts.tsv')) == {}
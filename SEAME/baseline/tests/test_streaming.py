@@ -0,0 +1,68 @@
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('numpy')
+
+from baseline import Seq2SeqModel, parse_args
+from model_utils import INPUT_DIM
+from streaming import StreamingRecognizer
+
+
+def make_model(monkeypatch, chunk, right_context):
+    monkeypatch.setattr(sys, 'argv', [
+        'baseline.py', '--no-cuda', '--stream-chunk', str(chunk), '--stream-right-context', str(right_context),
+        '--encoder-dim', '16', '--decoder-dim', '16', '--key-dim', '8', '--value-dim', '8'])
+    torch.manual_seed(0)
+    model = Seq2SeqModel(parse_args(), vocab_size=10)
+    model.eval()
+    return model
+
+
+def test_initial_context_only_sees_first_chunk(monkeypatch):
+    model = make_model(monkeypatch, 32, 16)
+    decoder = model.decoder
+    assert decoder.initial_frames == 4
+    keys, values = torch.randn(1, 11, 8), torch.randn(1, 11, 8)
+    input_states = [rnn.initial_state(1) for rnn in decoder.input_rnns]
+    with torch.no_grad():
+        ctx, attn = decoder.initial_context(keys, values, keys.new_ones((1, 11)), input_states)
+        first_ctx, first_attn = decoder.initial_context(keys[:, :4], values[:, :4], keys.new_ones((1, 4)), input_states)
+    assert torch.allclose(ctx, first_ctx)
+    assert torch.allclose(attn[:, :4], first_attn)
+    assert torch.all(attn[:, 4:] == 0)
+
+
+def test_buffered_utterance_matches_offline_beam_search(monkeypatch):
+    # shorter than chunk + look-ahead, so nothing is decoded before finish()
+    model = make_model(monkeypatch, 64, 32)
+    utterance = torch.randn(90, INPUT_DIM)
+    recognizer = StreamingRecognizer(model, [chr(ord('a') + i) for i in range(10)], max_len=20)
+    assert recognizer.push(utterance) == []
+    recognizer.finish()
+    offline = model.beam_search(utterance.unsqueeze(1), torch.IntTensor([90]), beam_width=1, max_len=20)[0]
+    assert len(offline) > 0
+    assert recognizer.tokens == offline
+
+
+def test_incremental_decoding_keeps_the_offline_initial_context(monkeypatch):
+    # later steps only attend over the chunks encoded so far, so only the start is shared
+    model = make_model(monkeypatch, 32, 16)
+    utterance = torch.randn(200, INPUT_DIM)
+    recognizer = StreamingRecognizer(model, [chr(ord('a') + i) for i in range(10)], max_len=20)
+    for start in range(0, 200, 10):
+        recognizer.push(utterance[start:start + 10])
+    recognizer.finish()
+    with torch.no_grad():
+        keys, values, lengths = model.encoder(utterance.unsqueeze(1), torch.IntTensor([200]))
+        streamed_keys = torch.cat(recognizer.keys, 0)
+        assert torch.allclose(streamed_keys, keys[:, 0], atol=1e-5)
+        input_states = [rnn.initial_state(1) for rnn in model.decoder.input_rnns]
+        mask = keys.new_ones((1, keys.size(0)))
+        offline_ctx, _ = model.decoder.initial_context(keys.transpose(0, 1), values.transpose(0, 1), mask, input_states)
+        streamed_ctx, _ = model.decoder.initial_context(
+            streamed_keys[:4].unsqueeze(0), torch.cat(recognizer.values, 0)[:4].unsqueeze(0),
+            mask[:, :4], input_states)
+    assert torch.allclose(offline_ctx, streamed_ctx, atol=1e-5)
+    assert 0 < len(recognizer.tokens) <= 20
@@ -0,0 +1,46 @@
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('numpy')
+
+from torch.utils.data import DataLoader
+
+import baseline
+from baseline import GradientAccumulator, parse_args, train_epoch
+from model_utils import INPUT_DIM, speech_collate_fn
+
+
+def fake_train_batch(args, net, model, criterion, batch, accumulator, safe_sizes, log, log_path):
+    # backpropagates a per-utterance sum, like train_batch
+    ulens, llens = batch[1], batch[3]
+    (model.weight.sum() * ulens.size(0)).backward()
+    accumulator.contribute(ulens.size(0), torch.sum(llens).item())
+    return 1., 1.
+
+
+@pytest.mark.parametrize('accum_frames', [0, 10**6])
+def test_invalid_final_batch_still_steps(monkeypatch, accum_frames):
+    monkeypatch.setattr(sys, 'argv', ['baseline.py', '--no-cuda', '--accum-frames', str(accum_frames)])
+    monkeypatch.setattr(baseline, 'train_batch', fake_train_batch)
+    args = parse_args()
+    args.cuda = False
+    model = torch.nn.Linear(2, 1, bias=False)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    accumulator = GradientAccumulator(args, model, optimizer)
+    # the last utterance is too short, so the final batch is skipped
+    dataset = [(torch.randn(n, INPUT_DIM), torch.LongTensor([1, 2, 3])) for n in [20, 30, 25, 5]]
+    loader = DataLoader(dataset, collate_fn=speech_collate_fn, batch_size=2)
+    batches = [[0], [1, 2], [3]]
+    before = model.weight.detach().clone()
+
+    l, tot_perp, num_train = train_epoch(
+        args, model, model, None, loader, batches, accumulator, None, lambda s, log_path: None, None)
+
+    assert num_train == 3
+    assert accumulator.utterances == 0
+    assert accumulator.num_updates == (2 if accum_frames == 0 else 1)
+    assert accumulator.tot_utterances == 3
+    assert model.weight.grad is None or torch.all(model.weight.grad == 0)
+    assert not torch.equal(model.weight, before)
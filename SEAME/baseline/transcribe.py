@@ -0,0 +1,239 @@
+'''
+Script to transcribe a split with length-sorted batching
+
+Utterances are sorted by frame count (longest first, counts read from the
+length index in split/frame_counts.tsv) and grouped into batches of at most
+--batch-frames padded frames, then decoded with --decode-mode.
+Transcripts are written to submission.csv and transcript_log.txt in the
+original order as soon as every earlier utterance is done, through one
+buffered writer flushed every --flush-every lines, e.g.
+
+    python3 transcribe.py --save-directory output/baseline/v1 --batch-frames 40000 --decode-mode beam
+
+With --transcribe-workers N on a CPU-only run, batches are decoded by N forked
+worker processes with --worker-threads intra-op threads each. The model's
+parameters are moved to shared memory before forking, so all workers read a
+single copy of the weights.
+
+Reports the real-time factor (decoding time / audio duration) and utterances
+per second
+'''
+
+import csv
+import numpy as np
+import os
+import queue
+import time
+import torch
+import torch.multiprocessing as mp
+import traceback
+
+from torch.utils.data import DataLoader
+
+from baseline import parse_args, Seq2SeqModel
+from model_utils import *
+
+
+def load_model(args, vocab_size, ckpt_path):
+    model = Seq2SeqModel(args, vocab_size=vocab_size)
+    model.load_state_dict(torch.load(ckpt_path, map_location=lambda storage, loc: storage))
+    if args.cuda:
+        model = model.cuda()
+    model.eval()
+    return model
+
+
+def frame_batches(lengths, batch_frames):
+    '''Groups utterances, longest first, into batches of at most batch_frames padded frames
+
+    A batch always holds at least one utterance
+
+    Return:
+        list of int lists, indices into lengths
+    '''
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+    batches = []
+    curr = []
+    for i in order.tolist():
+        # the first utterance of a batch is its longest
+        if curr and (len(curr)+1)*lengths[curr[0]] > batch_frames:
+            batches.append(curr)
+            curr = []
+        curr.append(i)
+    if curr:
+        batches.append(curr)
+    return batches
+
+
+class OrderedWriter(object):
+    '''Writes transcripts in utterance order while they arrive in any order
+
+    Finished transcripts wait until every earlier one is written; both files
+    are flushed every flush_every lines
+    '''
+    def __init__(self, csv_path, log_path, flush_every=100):
+        self.csv_file = open(csv_path, 'w', newline='')
+        self.log_file = open(log_path, 'w')
+        self.writer = csv.writer(self.csv_file)
+        self.flush_every = flush_every
+        self.pending = {}
+        self.next_i = 0
+
+    def add(self, i, transcript):
+        self.pending[i] = transcript
+        while self.next_i in self.pending:
+            t = self.pending.pop(self.next_i)
+            self.writer.writerow([self.next_i+1, t])
+            self.log_file.write('%s\n' % t)
+            self.next_i += 1
+            if self.next_i % self.flush_every == 0:
+                self.csv_file.flush()
+                self.log_file.flush()
+
+    def close(self):
+        self.csv_file.close()
+        self.log_file.close()
+
+
+def serial_transcripts(args, model, dataset, batches, charset):
+    '''
+    Return:
+        generator of (utterance index, transcript) pairs, in batch order
+    '''
+    kwargs = {'pin_memory': True, 'num_workers': args.num_workers} if args.cuda else {}
+    loader = DataLoader(dataset, collate_fn=speech_collate_fn, batch_sampler=batches, **kwargs)
+    order = [i for batch in batches for i in batch]
+    for k, t in enumerate(generate_transcripts(args, model, loader, charset)):
+        yield order[k], t
+
+
+def inference_worker(args, model, dataset, charset, num_threads, task_queue, result_queue):
+    '''Decodes batches of utterance indices from task_queue until it receives None'''
+    torch.set_num_threads(num_threads)
+    with torch.no_grad():
+        while True:
+            batch = task_queue.get()
+            if batch is None:
+                return
+            try:
+                collated = speech_collate_fn([dataset[i] for i in batch])
+                result = list(generate_transcripts(args, model, [collated], charset))
+            except Exception:
+                result = traceback.format_exc()
+            result_queue.put((batch, result))
+
+
+def pool_transcripts(args, model, dataset, batches, charset, workers, threads=0):
+    '''Decodes batches with forked CPU worker processes sharing the model's weights
+
+    Batches are queued in the given order and taken by whichever worker is free
+
+    Args:
+        threads: intra-op threads per worker (0 splits the cores evenly)
+
+    Return:
+        generator of (utterance index, transcript) pairs, in completion order
+    '''
+    if threads <= 0:
+        threads = max((os.cpu_count() or 1) // workers, 1)
+    model.share_memory()
+    ctx = mp.get_context('fork')
+    task_queue, result_queue = ctx.Queue(), ctx.Queue()
+    for batch in batches:
+        task_queue.put(batch)
+    for _ in range(workers):
+        task_queue.put(None)
+    procs = [ctx.Process(target=inference_worker, args=(args, model, dataset, charset, threads, task_queue, result_queue), daemon=True) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    try:
+        for _ in range(len(batches)):
+            while True:
+                try:
+                    batch, result = result_queue.get(timeout=1.)
+                    break
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in procs):
+                        raise RuntimeError('inference worker exited unexpectedly')
+            if isinstance(result, str):
+                raise RuntimeError('inference worker failed:\n%s' % result)
+            for i, t in zip(batch, result):
+                yield i, t
+        for p in procs:
+            p.join()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+
+
+def transcribe(args, model, paths, charset, csv_path, log_path):
+    '''
+    Return:
+        transcripts: list of strings, in the order of paths
+        frames: total number of input frames
+        seconds: decoding time
+    '''
+    lengths = load_frame_counts(paths)  # from the cached length index
+    batches = frame_batches(lengths, args.batch_frames)
+    dataset = ASRDataset(paths, None)
+    if args.transcribe_workers > 0 and not args.cuda:
+        results = pool_transcripts(args, model, dataset, batches, charset, args.transcribe_workers, args.worker_threads)
+    else:
+        results = serial_transcripts(args, model, dataset, batches, charset)
+    transcripts = [None]*len(paths)
+    writer = OrderedWriter(csv_path, log_path, flush_every=args.flush_every)
+    t0 = time.time()
+    with torch.no_grad():
+        for k, (i, t) in enumerate(results):
+            transcripts[i] = t
+            writer.add(i, t)
+            if (k+1) % 100 == 0:
+                print('Decoded %d / %d Utterances (%.2f Seconds)' % (k+1, len(paths), time.time()-t0))
+    if args.cuda:
+        torch.cuda.synchronize()
+    seconds = time.time() - t0
+    writer.close()
+    return transcripts, sum(lengths), seconds
+
+
+def main():
+    args = parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    t0 = time.time()
+
+    if not os.path.exists(args.save_directory):
+        os.makedirs(args.save_directory)
+    LOG_PATH = os.path.join(args.save_directory, 'transcribe_log')
+
+    print("Loading Data")
+    train_paths, dev_paths, test_paths = load_paths()
+    paths = {'train': train_paths, 'dev': dev_paths, 'test': test_paths}[args.transcribe_split]
+    max_split = {'train': args.max_train, 'dev': args.max_dev, 'test': args.max_test}[args.transcribe_split]
+    paths = paths[:max_split][:args.max_data]
+    train_ys = load_y_data('train')
+    dev_ys = load_y_data('dev')
+    test_ys = load_y_data('test')
+    charset = build_charset(np.concatenate((train_ys, dev_ys, test_ys), axis=0))
+    t1 = time.time()
+    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+
+    print("Loading Model")
+    CKPT_PATH = os.path.join(args.save_directory, 'model.ckpt')
+    model = load_model(args, len(charset), CKPT_PATH)
+    t1 = time.time()
+    print_log('%.2f Seconds' % (t1-t0), LOG_PATH)
+
+    print('Transcribing %d %s utterances (%s decoding)' % (len(paths), args.transcribe_split, args.decode_mode))
+    if args.transcribe_workers > 0 and args.cuda:
+        print('Decoding on the GPU, ignoring --transcribe-workers')
+    CSV_PATH = os.path.join(args.save_directory, 'submission.csv')
+    TRANSCRIPT_LOG_PATH = os.path.join(args.save_directory, 'transcript_log.txt')
+    transcripts, frames, seconds = transcribe(args, model, paths, charset, CSV_PATH, TRANSCRIPT_LOG_PATH)
+    audio_seconds = frames*args.frame_shift
+    print_log('Decoded %d utterances (%.1f seconds of audio) in %.2f seconds' % (len(transcripts), audio_seconds, seconds), LOG_PATH)
+    print_log('RTF: %.4f, %.2f utterances per second' % (seconds/max(audio_seconds, 1e-8), len(transcripts)/max(seconds, 1e-8)), LOG_PATH)
+
+if __name__ == '__main__':
+    main()
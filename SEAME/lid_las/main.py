@@ -223,6 +223,119 @@ class DecoderModel(nn.Module):
             nn.LeakyReLU(),
             nn.Linear(args.decoder_dim, 2)
         )
+        self.lid_vocabs = None
+
+    def set_char_lids(self, char_lids):
+        '''Stores the output indices allowed for each language
+
+        Args:
+            char_lids: output of char_lids(charset)
+        '''
+        device = self.embedding.weight.device
+        self.lid_vocabs = [
+            torch.LongTensor([i for i, l in enumerate(char_lids) if l == lid or l == -1]).to(device)
+            for lid in (0, 1)]
+
+    def constrained_char_logits(self, ht, lid_generated):
+        '''Character logits restricted to the predicted language
+
+        Only the output rows of each language's characters are computed; all other
+        logits are set to a large negative number
+
+        Args:
+            ht: shape (B, decoder_dim+value_dim)
+            lid_generated: shape (B,)
+        '''
+        hidden = self.char_projection[:-1](ht)
+        out_layer = self.char_projection[-1]
+        logit = hidden.new_full((hidden.size(0), out_layer.weight.size(0)), -1e4)
+        for lid, cols in enumerate(self.lid_vocabs):
+            rows = (lid_generated == lid).nonzero().view(-1)
+            if rows.numel() == 0:
+                continue
+            sub_logit = nn.functional.linear(hidden[rows], out_layer.weight[cols], out_layer.bias[cols])
+            logit[rows.unsqueeze(1), cols.unsqueeze(0)] = sub_logit
+        return logit
+
+    def forward_pass_joint(self, input_t, keys, values, mask, ctx, input_states, constrain=False):
+        '''Single timestep producing both character and LID predictions
+
+        Args:
+            constrain: restrict characters to the language predicted at this step
+
+        Return:
+            logit: shape (B, vocab_size+1)
+            lid_logit: shape (B, 2)
+            generated: predicted character (chosen from logit)
+            lid_generated: predicted language, shape (B,)
+            ctx, attn, new_input_states: as in forward_pass
+        '''
+        embed = self.embedding(input_t)
+        ht = torch.cat((embed, ctx), dim=1)
+        new_input_states = []
+        for rnn, state in zip(self.input_rnns, input_states):
+            ht, newstate = rnn(ht, state)
+            new_input_states.append((ht, newstate))
+        query = self.query_projection(ht)
+        attn = calculate_attention(keys=keys, mask=mask, queries=query)
+        ctx = calculate_context(attn=attn, values=values)
+        ht = torch.cat((ht, ctx), dim=1)
+            # shape: (B, decoder_dim+value_dim)
+
+        lid_logit = self.lid_projection(ht)
+        lid_generated = torch.max(lid_logit, 1)[1]
+        if constrain:
+            logit = self.constrained_char_logits(ht, lid_generated)
+        else:
+            logit = self.char_projection(ht)
+        generated = gumbel_argmax(logit, 1)
+        return logit, lid_logit, generated, lid_generated, ctx, attn, new_input_states
+
+    def forward_joint(self, inputs, input_lengths, keys, values, utterance_lengths, future=0, constrain=False):
+        '''Greedy decoding of characters and LIDs in one decoder run
+
+        Args:
+            keys: shape (T, B, key_dim)
+            values: shape (T, B, value_dim)
+
+        Return:
+            logits: shape (L, B, vocab_size+1)
+            lid_logits: shape (L, B, 2)
+            generateds: shape (L, B)
+            lid_generateds: shape (L, B)
+        '''
+        assert not constrain or self.lid_vocabs is not None, 'call set_char_lids first'
+        mask = Variable(output_mask(values.size(0), utterance_lengths).transpose(0, 1)).float()
+        keys_t = keys.transpose(0, 1)
+        values_t = values.transpose(0, 1)
+        n = inputs.size(1)
+
+        input_states = [rnn.initial_state(n) for rnn in self.input_rnns]
+        query = self.query_projection(input_states[-1][0])
+        attn = calculate_attention(keys_t, mask, query)
+        ctx = calculate_context(attn, values_t)
+
+        logits = []
+        lid_logits = []
+        generateds = []
+        lid_generateds = []
+        input_t = inputs[0]
+        for _ in range(inputs.size(0) + future):
+            logit, lid_logit, generated, lid_generated, ctx, attn, input_states = self.forward_pass_joint(
+                input_t=input_t, keys=keys_t, values=values_t, mask=mask, ctx=ctx,
+                input_states=input_states, constrain=constrain
+            )
+            logits.append(logit)
+            lid_logits.append(lid_logit)
+            generateds.append(generated)
+            lid_generateds.append(lid_generated)
+            input_t = generated
+
+        logits = torch.stack(logits, dim=0)
+        lid_logits = torch.stack(lid_logits, dim=0)
+        generateds = torch.stack(generateds, dim=0)
+        lid_generateds = torch.stack(lid_generateds, dim=0)
+        return logits, lid_logits, generateds, lid_generateds
 
     def forward_pass(self, input_t, keys, values, mask, ctx, input_states):
         '''
@@ -481,12 +594,49 @@ class Seq2SeqModel(nn.Module):
         logits, attns, generated = self.decoder.forward_lid(chars, char_lengths, keys, values, lengths, future=future)
         return logits, generated, char_lengths
 
+    def forward_joint(self, utterances, utterance_lengths, chars, char_lengths, future=0, constrain=False):
+        _, keys, values, lengths = self.encoder(utterances, utterance_lengths)
+        return self.decoder.forward_joint(chars, char_lengths, keys, values, lengths, future=future, constrain=constrain)
+
+    def forward_multitask(self, utterances, utterance_lengths, chars, char_lengths):
+        '''Runs the encoder once and fans its output out to the character and LID decoders
+
+        Return:
+            prediction: (logits, generated, char_lengths) for characters
+            prediction_lid: (logits, generated, char_lengths) for language IDs
+        '''
+        _, keys, values, lengths = self.encoder(utterances, utterance_lengths)
+        logits, _, generated = self.decoder(chars, char_lengths, keys, values, lengths)
+        lid_logits, _, lid_generated = self.decoder.forward_lid(chars, char_lengths, keys, values, lengths)
+        return (logits, generated, char_lengths), (lid_logits, lid_generated, char_lengths)
+
     def forward(self, utterances, utterance_lengths, chars, char_lengths, future=0):
         _, keys, values, lengths = self.encoder(utterances, utterance_lengths)
         logits, attns, generated = self.decoder(chars, char_lengths, keys, values, lengths, future=future)
         return logits, generated, char_lengths
 
 
+def write_transcripts_with_lids(path, args, model, loader, charset, log_path, lid_path, constrain=False):
+    '''Writes characters and language IDs from a single decoding pass
+
+    The CSV rows are (id, transcript, lids); lid_path gets the per-step Mandarin
+    posteriors of each utterance on one line
+    '''
+    model.eval()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    transcripts = []
+    with open(path, 'w', newline='') as f, open(log_path, 'a') as log_f, open(lid_path, 'w') as lid_f:
+        w = csv.writer(f)
+        outputs = generate_transcripts_with_lids(args, model, loader, charset, constrain=constrain)
+        for i, (t, lid_str, lid_probs) in enumerate(outputs):
+            w.writerow([i+1, t, lid_str])
+            log_f.write('%s\n' % t)
+            lid_f.write('%s\n' % ' '.join('%.3f' % p for p in lid_probs))
+            transcripts.append(t)
+            if (i+1) % 100 == 0:
+                print('Wrote %d Lines' % (i+1))
+    return transcripts
+
 def write_transcripts(path, args, model, loader, charset, log_path):
     # Write CSV file
     model.eval()
@@ -541,7 +691,12 @@ def parse_args():
     parser.add_argument('--key-dim', type=int, default=128, metavar='N', help='hidden dimension')
     parser.add_argument('--generator-length', type=int, default=250, metavar='N', help='maximum length to generate')
 
+    parser.add_argument('--multitask-mode', type=str, default='joint', choices=['joint', 'alternate'], help='joint: one backward over weighted losses, alternate: one step per head from the shared encoder pass')
+    parser.add_argument('--asr-weight', type=float, default=1.0, metavar='N', help='character decoder loss weight')
+    parser.add_argument('--lid-weight', type=float, default=1.0, metavar='N', help='LID decoder loss weight')
+
     parser.add_argument('--test-mode', type=str, default='transcript', help='Test mode: transcript, cer, perp')
+    parser.add_argument('--constrain-lid', action='store_true', default=False, help='restrict each decoded character to the predicted language')
 
     return parser.parse_args()
 
@@ -632,24 +787,22 @@ def main():
                         ulens.cuda(args.cuda), y1array.cuda(args.cuda), ylens.cuda(args.cuda), y2array.cuda(args.cuda), \
                         lid1_arr.cuda(args.cuda), lid2_arr.cuda(args.cuda)
                 
-                optimizer.zero_grad()
-                prediction = model(uarray, ulens, y1array, ylens)
+                prediction, prediction_lid = model.forward_multitask(uarray, ulens, y1array, ylens)
                 logits, _, char_lengths = prediction
                 perp = perplexity(logits, y2array, char_lengths, args)
                 tot_perp += perp.item()
                 loss_asr = seq_cross_entropy(prediction, y2array)
                 tot_loss_asr += loss_asr.item()
-                loss_asr.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                optimizer.step()
-
-                optimizer.zero_grad()
-                prediction_lid = model.forward_lid(uarray, ulens, y1array, ylens)
                 loss_lid = seq_cross_entropy(prediction_lid, lid2_arr)
                 tot_loss_lid += loss_lid.item()
-                loss_lid.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-                optimizer.step()
+                losses = [args.asr_weight * loss_asr, args.lid_weight * loss_lid]
+                if args.multitask_mode == 'alternate':
+                    alternating_step(optimizer, list(model.parameters()), losses)
+                else:
+                    optimizer.zero_grad()
+                    sum(losses).backward()
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
+                    optimizer.step()
 
                 loss = loss_asr+loss_lid
                 tot_loss += loss.item()
@@ -8,12 +8,16 @@ peterw1@andrew.cmu.edu
 import itertools
 import os
 import numpy as np
+import sys
 import torch
 
 from nltk.metrics import edit_distance
 from torch.autograd import Variable
 from torch.utils.data import DataLoader, Dataset
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preprocess'))
+from mk_lid import is_chinese_char # the rule behind the LID labels in split/
+
 def output_mask(maxlen, lengths):
     """
     Create a mask on-the-fly
@@ -26,6 +30,25 @@ def output_mask(maxlen, lengths):
     mask = ran < lens
     return mask
 
+def alternating_step(optimizer, params, losses, max_norm=0.25):
+    '''Applies one optimizer step per loss
+
+    All gradients are taken before any update, so the losses can share a single
+    forward pass (e.g. one encoder run feeding several heads)
+
+    Args:
+        params: list of parameters updated by optimizer
+        losses: list of scalar losses, stepped in order
+    '''
+    all_grads = [torch.autograd.grad(loss, params, retain_graph=True, allow_unused=True) for loss in losses]
+    for grads in all_grads:
+        optimizer.zero_grad()
+        for p, g in zip(params, grads):
+            if g is not None:
+                p.grad = g
+        torch.nn.utils.clip_grad_norm_(params, max_norm)
+        optimizer.step()
+
 def log_l(logits, target, lengths, args):
     '''Calculates the log-likelihood for the given batch
 
@@ -108,7 +131,8 @@ def generate_transcripts(args, model, loader, charset):
         generator object comprised of transcripts (each a string)
     '''
     # Create and yield transcripts
-    for uarray, ulens, l1array, llens, l2array in loader:
+    for t in loader:
+        uarray, ulens, l1array, llens, l2array = t[:5]
         if args.cuda:
             uarray = uarray.cuda(args.cuda)
             ulens = ulens.cuda(args.cuda)
@@ -128,6 +152,34 @@ def generate_transcripts(args, model, loader, charset):
             transcript = decode_output(generated[:, i], charset)
             yield transcript
 
+def generate_transcripts_with_lids(args, model, loader, charset, constrain=False):
+    '''Iteratively returns transcriptions and language IDs from one decoder run
+
+    Return:
+        generator object of (transcript, lid_str, lid_probs), where lid_str has one
+        0 (English) / 1 (Mandarin) digit per character and lid_probs holds the
+        per-step Mandarin posteriors
+    '''
+    for t in loader:
+        uarray, ulens, l1array, llens = t[:4]
+        uarray, ulens, l1array, llens = Variable(uarray), Variable(ulens), Variable(l1array), Variable(llens)
+        if torch.cuda.is_available():
+            uarray, ulens, l1array, llens = uarray.cuda(args.cuda), ulens.cuda(args.cuda), \
+                l1array.cuda(args.cuda), llens.cuda(args.cuda)
+
+        with torch.no_grad():
+            logits, lid_logits, generated, lid_generated = model.forward_joint(
+                uarray, ulens, l1array, llens,
+                future=args.generator_length, constrain=constrain)
+        generated = generated.data.cpu().numpy()  # (L, BS)
+        lid_generated = lid_generated.data.cpu().numpy()  # (L, BS)
+        lid_probs = torch.softmax(lid_logits, 2)[:, :, 1].data.cpu().numpy()  # (L, BS)
+        n = uarray.size(1)
+        for i in range(n):
+            transcript = decode_output(generated[:, i], charset)
+            lid_str = ''.join(str(lid) for lid in lid_generated[:len(transcript), i])
+            yield transcript, lid_str, lid_probs[:len(transcript), i]
+
 def cer(args, model, loader, charset, ys, truncate=True):
     '''Calculates the average normalized CER for the given data
     
@@ -185,6 +237,24 @@ def print_log(s, log_path):
     with open(log_path, 'a+') as ouf:
         ouf.write("%s\n" % s)
 
+def char_lids(charset):
+    '''Language of each decoder output index
+
+    Return:
+        list with len(charset)+1 entries: 1 for Mandarin characters, 0 for English
+        letters, -1 for characters shared by both languages (including the end
+        token at index 0)
+    '''
+    lids = [-1]
+    for ch in charset:
+        if is_chinese_char(ch):
+            lids.append(1)
+        elif ch.isalpha():
+            lids.append(0)
+        else:
+            lids.append(-1)
+    return lids
+
 def build_charset(utterances):
     # Create a character set
     chars = set(itertools.chain.from_iterable(utterances))
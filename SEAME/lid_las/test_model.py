@@ -0,0 +1,83 @@
+'''
+Script to evaluate LID-LAS model
+
+Characters and language IDs are decoded together in one decoder run, so no
+separate LID pass over the transcripts is needed
+
+Assumes that model.ckpt exists
+Supported test-mode values: transcript, cer, and combos
+'''
+
+import csv
+import numpy as np
+import os
+import time
+import torch
+
+from main import parse_args, Seq2SeqModel, write_transcripts_with_lids
+from model_utils import *
+
+def main():
+    args = parse_args()
+
+    t0 = time.time()
+
+    if not os.path.exists(args.save_directory):
+        os.makedirs(args.save_directory)
+
+    print("Loading File Paths")
+    train_paths, dev_paths, test_paths = load_paths()
+    test_paths = test_paths[:args.max_test][:args.max_data]
+
+    print("Loading Y Data")
+    train_ys = load_y_data('train') # 1-dim np array of strings
+    dev_ys = load_y_data('dev')
+    test_ys = load_y_data('test')
+
+    print("Building Charset")
+    charset = build_charset(np.concatenate((train_ys, dev_ys, test_ys), axis=0))
+    charmap = make_charmap(charset) # {string: int}
+    charcount = len(charset)
+
+    print("Building Loader")
+    testchars = map_characters(test_ys, charmap)
+    test_loader = make_loader(test_paths, testchars, args, shuffle=False, batch_size=args.batch_size)
+
+    TRANSCRIPT_LOG_PATH = os.path.join(args.save_directory, 'transcript_log.txt')
+    LID_PATH = os.path.join(args.save_directory, 'lid_posteriors.txt')
+    CSV_PATH = os.path.join(args.save_directory, 'submission.csv')
+
+    if 'transcript' in args.test_mode:
+        print("Building Model")
+        model = Seq2SeqModel(args, vocab_size=charcount)
+        CKPT_PATH = os.path.join(args.save_directory, 'model.ckpt')
+        model.load_state_dict(torch.load(CKPT_PATH, map_location=lambda storage, loc: storage))
+        if torch.cuda.is_available():
+            model = model.cuda(args.cuda)
+        model.decoder.set_char_lids(char_lids(charset))
+        print("Loaded Checkpoint")
+
+        print('generating transcripts and lids')
+        with open(TRANSCRIPT_LOG_PATH, 'w+') as ouf:
+            pass
+        write_transcripts_with_lids(
+            path=CSV_PATH, args=args, model=model, loader=test_loader, charset=charset,
+            log_path=TRANSCRIPT_LOG_PATH, lid_path=LID_PATH, constrain=args.constrain_lid)
+        print('%.2f Seconds' % (time.time()-t0))
+
+    if 'cer' in args.test_mode:
+        print('calculating cer values')
+        CER_LOG_PATH = os.path.join(args.save_directory, 'cer_log.txt')
+        with open(CER_LOG_PATH, 'w+') as ouf:
+            pass
+        transcripts = []
+        with open(CSV_PATH, 'r') as csvfile:
+            raw_csv = csv.reader(csvfile)
+            for row in raw_csv:
+                transcripts.append(row[1].strip())
+        norm_dists, dists = cer_from_transcripts(transcripts, test_ys, CER_LOG_PATH)
+        np.save(os.path.join(args.save_directory, 'test_cer.npy'), norm_dists)
+        np.save(os.path.join(args.save_directory, 'test_dist.npy'), dists)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+Script to time one multi-head attention step across head counts
+
+Compares the batched matmul attention in main.py against the previous
+broadcast-and-sum formulation, which materializes (B, T, H, K) and (B, T, H, V)
+intermediates at every decoder step
+'''
+
+import argparse
+import time
+import torch
+
+from main import calculate_multihead_attention
+
+
+def broadcast_attention(keys, values, queries):
+    '''
+    Args:
+        keys: shape (B, T, num_heads, key_dim)
+        values: shape (B, T, num_heads, value_dim)
+        queries: shape (B, num_heads, key_dim)
+    '''
+    preheads = torch.sum(keys*queries[:, None, :, :], 3)
+    return torch.sum(preheads[:, :, :, None]*values, 1)
+
+
+def time_fn(fn, repeats):
+    fn()  # warm-up
+    t0 = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - t0) / repeats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=32, metavar='N', help='batch size')
+    parser.add_argument('--frames', type=int, default=250, metavar='N', help='encoder frames')
+    parser.add_argument('--key-dim', type=int, default=64, metavar='N', help='per-head key and value dimension')
+    parser.add_argument('--heads', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='head counts')
+    parser.add_argument('--steps', type=int, default=100, metavar='N', help='decoder steps per repetition')
+    parser.add_argument('--repeats', type=int, default=5, metavar='N', help='timed repetitions')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    n, t, d = args.batch_size, args.frames, args.key_dim
+    mask = torch.ones(n, t)
+    for num_heads in args.heads:
+        keys = torch.randn(n, t, num_heads, d)
+        values = torch.randn(n, t, num_heads, d)
+        queries = torch.randn(n, num_heads, d)
+
+        def old_steps():
+            for _ in range(args.steps):
+                broadcast_attention(keys, values, queries)
+
+        def new_steps():
+            # keys and values are reshaped once per utterance, as in DecoderModel.forward
+            keys_h = keys.permute(0, 2, 1, 3).contiguous()
+            values_h = values.permute(0, 2, 1, 3).contiguous()
+            for _ in range(args.steps):
+                calculate_multihead_attention(keys_h, values_h, mask, queries)
+
+        with torch.no_grad():
+            old_sec = time_fn(old_steps, args.repeats)
+            new_sec = time_fn(new_steps, args.repeats)
+        print('%d heads: broadcast %.4f s, matmul %.4f s (%.2fx)' % (
+            num_heads, old_sec, new_sec, old_sec / new_sec))
+
+
+if __name__ == '__main__':
+    main()
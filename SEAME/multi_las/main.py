@@ -158,6 +158,26 @@ class AdvancedLSTMCell(nn.LSTMCell):
         )
 
 
+def calculate_multihead_attention(keys, values, mask, queries):
+    """Multi-head attention context with a masked softmax over valid frames
+
+    Args:
+        keys: shape (B, num_heads, T, key_dim)
+        values: shape (B, num_heads, T, value_dim)
+        mask: lengths, shape (B, T)
+        queries: shape (B, num_heads, key_dim)
+
+    Return:
+        heads: shape (B, num_heads, value_dim)
+    """
+    energy = torch.matmul(keys, queries.unsqueeze(3)).squeeze(3) / np.sqrt(keys.size(3))
+        # shape: (B, num_heads, T)
+    energy = energy.masked_fill(mask.unsqueeze(1) == 0, -1e4)
+    attn = torch.softmax(energy, dim=2)
+    heads = torch.matmul(attn.unsqueeze(2), values).squeeze(2)
+    return heads
+
+
 class DecoderModel(nn.Module):
     # Speller/Decoder
     def __init__(self, args, vocab_size):
@@ -183,8 +203,9 @@ class DecoderModel(nn.Module):
         Assumes key_dim == value_vim
 
         Args:
-            keys: shape (B, T, num_heads, key_dim)
-            values: shape (B, T, num_heads, value_dim)
+            keys: shape (B, num_heads, T, key_dim)
+            values: shape (B, num_heads, T, value_dim)
+            mask: lengths, shape (B, T)
             multihead: context, shape (B, decoder_dim)
         '''
         # Embed the previous character
@@ -205,10 +226,8 @@ class DecoderModel(nn.Module):
             # shape: (B, key_dim*num_heads)
         queries = queries.view(B, self.num_heads, -1)
             # shape: (B, num_heads, key_dim)
-        preheads = torch.sum(keys*queries[:, None, :, :], 3)/multihead.shape[1]
-            # shape: (B, T, num_heads)
-        heads = torch.sum(preheads[:, :, :, None]*values, 1)
-            # shape: (B, value_dim, num_heads)
+        heads = calculate_multihead_attention(keys, values, mask, queries)
+            # shape: (B, num_heads, value_dim)
         concatheads = heads.view(B, -1)
             # shape: (B, value_dim*num_heads)
         multihead = self.wo_layer(concatheads)
@@ -232,10 +251,11 @@ class DecoderModel(nn.Module):
             values: shape (T, B, num_heads, key_dim)
         '''
         mask = Variable(output_mask(values.size(0), utterance_lengths).transpose(0, 1)).float()
-        keys_t = keys.transpose(0, 1)
-            # shape: (B, T, num_heads, key_dim)
-        values_t = values.transpose(0, 1)
-            # shape: (B, T, num_heads, key_dim)
+        # Reshape once per utterance so every step is a batched matmul
+        keys_t = keys.permute(1, 2, 0, 3).contiguous()
+            # shape: (B, num_heads, T, key_dim)
+        values_t = values.permute(1, 2, 0, 3).contiguous()
+            # shape: (B, num_heads, T, value_dim)
         t = inputs.size(0)
         n = inputs.size(1)
 
@@ -249,10 +269,8 @@ class DecoderModel(nn.Module):
             # shape: (B, key_dim*num_heads)
         queries = queries.view(n, self.num_heads, -1)
             # shape: (B, num_heads, key_dim)
-        preheads = torch.sum(keys_t*queries[:, None, :, :], 3)
-            # shape: (B, T, num_heads)
-        heads = torch.sum(preheads[:, :, :, None]*values_t, 1)
-            # shape: (B, value_dim, num_heads)
+        heads = calculate_multihead_attention(keys_t, values_t, mask, queries)
+            # shape: (B, num_heads, value_dim)
         concatheads = heads.view(n, -1)
             # shape: (B, value_dim*num_heads)
         multihead = self.wo_layer(concatheads)
@@ -3,9 +3,9 @@ import csv
 import os
 import sys
 
-from nltk.metrics import edit_distance
-
 from discr_utils import *
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))  # shared modules
+from scoring import edit_distances
 
 def load_beams(path):
     raw_preds = []
@@ -29,14 +29,8 @@ def load_beams(path):
 def get_best(beams, y_true):
     best_beams = []
     for b_group, y in zip(beams, y_true):
-        best_i = 0
-        best_cer = sys.maxsize
-        for i, curr_beam in enumerate(b_group):
-            curr_cer = edit_distance(curr_beam, y)/100
-            if curr_cer < best_cer:
-                best_i = i
-                best_cer = curr_cer
-        best_beams.append(b_group[best_i])
+        cers = edit_distances(b_group, [y]*len(b_group))
+        best_beams.append(b_group[cers.index(min(cers))])
     return best_beams
 
 
@@ -6,16 +6,22 @@ peterw1@andrew.cmu.edu
 '''
 
 import csv
+import hashlib
 import itertools
+import multiprocessing as mp
 import numpy as np
 import os
 import pickle
+import sys
 import torch
 import torch.nn as nn
 
-from nltk.metrics import edit_distance
 from torch.utils.data import DataLoader, Dataset
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))  # shared modules
+from sampler import BucketBatchSampler
+from scoring import edit_distances
+
 
 def print_log(s, log_path):
     print(s)
@@ -68,16 +74,6 @@ def load_gens():
     return load_pkl(gens_path)
 
 
-def load_fid_to_cers(phase):
-    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    data_dir = os.path.join(parent_dir, 'data')
-    fid_to_cers_path = os.path.join(data_dir, 'discr', '%s_fid_to_cers.pkl' % phase)
-    if os.path.exists(fid_to_cers_path):
-        return load_pkl(fid_to_cers_path)
-    else:
-        return None
-
-
 def mk_fid_to_orig(fids, ys):
     '''
     Return:
@@ -89,33 +85,6 @@ def mk_fid_to_orig(fids, ys):
     return fid_to_orig
 
 
-def mk_fid_to_cers(fid_to_gens, fid_to_orig, phase):
-    '''
-    Args:
-        fid_to_gens: {fid: list of generated samples (aka list of strings)}
-        fid_to_orig: {fid: string true y value}
-    
-    Return:
-        fid_to_cers: {fid: list of CER values (aka list of floats, one float for each generated sample)}
-    '''
-    fid_to_cers = {}
-    for fid in fid_to_orig:
-        y_true = fid_to_orig[fid]
-        gens = []
-        if fid in fid_to_gens:
-            gens = fid_to_gens[fid]
-        cers = []
-        for gen in gens:
-            cer = edit_distance(y_true, gen)
-            cers.append(cer)
-        fid_to_cers[fid] = cers
-    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    data_dir = os.path.join(parent_dir, 'data')
-    fid_to_cers_path = os.path.join(data_dir, 'discr', '%s_fid_to_cers.pkl' % phase)
-    save_pkl(fid_to_cers, fid_to_cers_path)
-    return fid_to_cers
-
-
 def build_charset(utterances):
     # Create a character set
     chars = set(itertools.chain.from_iterable(utterances))
@@ -188,25 +157,157 @@ def load_preds(path):
     return raw_preds
 
 
-def map_characters_rerank(preds, charmap):
+def map_characters_rerank(preds, charmap, cuda=None):
     '''
     Args:
         preds: list of string lists
         charmap: character to int map
+        cuda: move the tensors to the GPU (default: if available)
     
     Return:
         list of lists, each sublist comprised of 1-dim int np arrays
     '''
+    if cuda is None:
+        cuda = torch.cuda.is_available()
     new_preds = []
     for p_group in preds:
         new_p = [np.array([charmap[c] for c in u], np.int32) for u in p_group]
         new_p = [torch.LongTensor(arr) for arr in new_p]
-        if torch.cuda.is_available():
+        if cuda:
             new_p = [tens.cuda() for tens in new_p]
         new_preds.append(new_p)
     return new_preds
 
 
+def mk_rerank_batches(lens, batch_frames):
+    '''Groups hypotheses, shortest first, into batches of at most batch_frames padded characters
+
+    Neighbouring lengths are close, so little padding is added, and the
+    discriminators pack each batch by length, so a hypothesis scores the same
+    as when it is scored alone
+
+    Args:
+        lens: list of hypothesis lengths
+        batch_frames: padded characters per batch (a batch holds at least one hypothesis)
+
+    Return:
+        list of int lists, each the indices into lens of one batch
+    '''
+    order = np.argsort(np.asarray(lens, np.int64), kind='stable')
+    batches = []
+    curr = []
+    for i in order.tolist():
+        # the last hypothesis of a batch is its longest
+        if curr and (len(curr)+1)*max(lens[i], 1) > batch_frames:
+            batches.append(curr)
+            curr = []
+        curr.append(i)
+    if curr:
+        batches.append(curr)
+    return batches
+
+
+def score_preds(model, all_preds, batch_frames=20000, column=None):
+    '''Discriminator scores of every hypothesis, one model call per padded batch
+
+    Args:
+        all_preds: list of lists of 1-dim LongTensors
+        column: for models returning logits, the column used as the score
+
+    Return:
+        FloatTensor with shape (num_hypotheses,), in utterance order
+    '''
+    device = next(model.parameters()).device
+    flat = [p for preds in all_preds for p in preds]
+    lens = [len(p) for p in flat]
+    scores = torch.empty(len(flat), device=device)
+    for idxs in mk_rerank_batches(lens, batch_frames):
+        batch_lens = torch.LongTensor([lens[i] for i in idxs])
+        x = torch.zeros(len(idxs), max(int(batch_lens.max()), 1), dtype=torch.long, device=device)
+            # shape: (batch_size, max_len), zero padded
+        for k, i in enumerate(idxs):
+            x[k, :lens[i]] = flat[i]
+        out = model(x, batch_lens)
+        if column is not None:
+            out = out[:, column]
+        scores[torch.tensor(idxs, device=device)] = out.float()
+    return scores
+
+
+def segment_argmax(scores, seg_ids, num_segs):
+    '''Index of the first maximum score of each segment
+
+    NaN scores never win and a segment without a finite score picks its first
+    element, as in a sequential scan with a strict comparison
+
+    Args:
+        scores: FloatTensor with shape (N,)
+        seg_ids: LongTensor with shape (N,), segment of each score
+
+    Return:
+        LongTensor with shape (num_segs,), indices into scores (N for empty segments)
+    '''
+    n = scores.size(0)
+    scores = torch.where(torch.isnan(scores), torch.full_like(scores, -float('inf')), scores)
+    seg_max = scores.new_full((num_segs,), -float('inf')).scatter_reduce(0, seg_ids, scores, reduce='amax')
+    positions = torch.arange(n, device=scores.device)
+    candidates = torch.where(scores == seg_max[seg_ids], positions, torch.full_like(positions, n))
+    return positions.new_full((num_segs,), n).scatter_reduce(0, seg_ids, candidates, reduce='amin')
+
+
+def find_best_preds(model, all_preds, batch_frames=20000, column=None):
+    '''
+    Return:
+        list with the index of the best hypothesis of each utterance
+            (-1 for utterances without hypotheses)
+    '''
+    scores = score_preds(model, all_preds, batch_frames, column)
+    counts = torch.LongTensor([len(preds) for preds in all_preds])
+    seg_ids = torch.repeat_interleave(torch.arange(len(all_preds)), counts).to(scores.device)
+    offsets = torch.cumsum(counts, 0) - counts
+    best = segment_argmax(scores, seg_ids, len(all_preds)).cpu() - offsets
+    return [b if c > 0 else -1 for b, c in zip(best.tolist(), counts.tolist())]
+
+
+rerank_state = None
+
+
+def init_rerank_worker(state, num_threads):
+    global rerank_state
+    torch.set_num_threads(num_threads)
+    rerank_state = state
+
+
+def rerank_shard(shard):
+    model, batch_frames, column = rerank_state
+    with torch.no_grad():
+        return find_best_preds(model, shard, batch_frames, column)
+
+
+def rerank(model, all_preds, batch_frames=20000, column=None, processes=1):
+    '''Picks the best hypothesis of each utterance with the discriminator
+
+    With processes > 1 and a CPU model, the utterances are split into
+    contiguous shards scored by worker processes, each with an equal share of
+    the intra-op threads
+
+    Return:
+        list with the index of the best hypothesis of each utterance
+            (-1 for utterances without hypotheses)
+    '''
+    model.eval()
+    if processes <= 1 or next(model.parameters()).is_cuda or len(all_preds) < 2:
+        with torch.no_grad():
+            return find_best_preds(model, all_preds, batch_frames, column)
+    processes = min(processes, len(all_preds))
+    shard_size = -(-len(all_preds) // processes)
+    shards = [all_preds[i:i+shard_size] for i in range(0, len(all_preds), shard_size)]
+    num_threads = max(torch.get_num_threads() // processes, 1)
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(processes, initializer=init_rerank_worker, initargs=((model, batch_frames, column), num_threads)) as pool:
+        return list(itertools.chain.from_iterable(pool.map(rerank_shard, shards)))
+
+
 def count_data(fid_to_gens, fid_to_orig):
     fids = list(fid_to_orig.keys())
     count = len(fids)
@@ -246,25 +347,30 @@ def simple_discr_collate_fn(batch):
     
     Return:
         xs: LongTensor with shape (batch_size, max_len)
+        lens: LongTensor with shape (batch_size,)
         ys: LongTensor with shape (batch_size,)
             real (orig) is 1, fake (gen) is 0
     '''
     batch_size = len(batch)
-    max_len = 0
+    max_len = 1 # empty sequences still get one padding token
     for (orig, gens) in batch:
         batch_size += len(gens)
         max_len = max([max_len, len(orig)]+[len(g) for g in gens])
     xs = torch.LongTensor(batch_size, max_len).zero_()
+    lens = torch.LongTensor(batch_size).zero_()
     ys = torch.LongTensor(batch_size).zero_()
     i = 0
     for (orig, gens) in batch:
         xs[i, :len(orig)] = torch.from_numpy(orig).long()
+        lens[i] = len(orig)
         ys[i] = 1
         for g in gens:
             i += 1
             xs[i, :len(g)] = torch.from_numpy(g).long()
+            lens[i] = len(g)
             ys[i] = 0
-    return xs, ys
+        i += 1
+    return xs, lens, ys
 
 
 def make_simple_loader(fid_to_orig, fid_to_gens, args, shuffle=True, batch_size=64):
@@ -274,63 +380,151 @@ def make_simple_loader(fid_to_orig, fid_to_gens, args, shuffle=True, batch_size=
     return loader
 
 
-class DiscrDataset(Dataset):
-    def __init__(self, fid_to_orig, fid_to_gens, fid_to_cers):
-        '''
-        Args:
-            fid_to_orig: {fid string: orig np array of ints}
-            fid_to_gens: {fid string: [g1 np array of ints, g2 np array of ints, ...]}
-            fid_to_cers: {fid string: [cer1 float, cer2 float, ...]}
-        '''
-        self.fids = list(set(fid_to_orig.keys()).intersection(set(fid_to_gens.keys())))
-        self.fid_to_orig = fid_to_orig
-        self.fid_to_gens = fid_to_gens
-        self.fid_to_cers = fid_to_cers
+TABLE_FIELDS = ['chars', 'offsets', 'true_idx', 'gen_idx', 'cers', 'groups']
 
-    def __len__(self):
-        return len(self.fids)
 
-    def __getitem__(self, index):
-        fid = self.fids[index]
-        return self.fid_to_orig[fid], self.fid_to_gens[fid], self.fid_to_cers[fid]
+def mk_discr_table(fid_to_orig, fid_to_gens, charmap, processes=1):
+    '''Compiles the real/generated pairs of a split into flat arrays
+
+    Sequence i is chars[offsets[i]:offsets[i+1]]. Pair j compares real sequence
+    true_idx[j] with generated sequence gen_idx[j] at edit distance cers[j], and
+    the pairs of utterance k are groups[k]:groups[k+1]. Utterances without
+    generated samples are left out
 
+    Args:
+        fid_to_orig: {fid: string true y value}
+        fid_to_gens: {fid: list of generated samples (aka list of strings)}
+        charmap: character to int map
+        processes: worker processes for the edit distances
 
-def discr_collate_fn(batch):
+    Return:
+        {field: np array} for the fields in TABLE_FIELDS
+    '''
+    seqs, true_idx, gen_idx, y_trues, gens, groups = [], [], [], [], [], [0]
+    for fid, orig in fid_to_orig.items():
+        curr_gens = fid_to_gens.get(fid, [])
+        if len(curr_gens) == 0:
+            continue
+        t = len(seqs)
+        seqs.append(orig)
+        for g in curr_gens:
+            true_idx.append(t)
+            gen_idx.append(len(seqs))
+            seqs.append(g)
+        y_trues += [orig]*len(curr_gens)
+        gens += curr_gens
+        groups.append(len(true_idx))
+    offsets = np.zeros(len(seqs)+1, np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    chars = np.array([charmap[c] for c in ''.join(seqs)], np.int32)
+    cers = np.array(edit_distances(y_trues, gens, processes=processes), np.float32)
+    return {'chars': chars, 'offsets': offsets, 'true_idx': np.array(true_idx, np.int64),
+        'gen_idx': np.array(gen_idx, np.int64), 'cers': cers, 'groups': np.array(groups, np.int64)}
+
+
+def discr_table_key(fid_to_orig, fid_to_gens, charmap):
+    h = hashlib.sha1()
+    h.update(''.join(sorted(charmap, key=charmap.get)).encode('utf-8'))
+    for fid, orig in fid_to_orig.items():
+        h.update(('\n%s\t%s' % (fid, orig)).encode('utf-8'))
+        for g in fid_to_gens.get(fid, []):
+            h.update(('\t%s' % g).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def load_discr_table(phase, fid_to_orig, fid_to_gens, charmap, processes=1):
+    '''Memory-maps the pair table of a split, building it first if it is not cached
+
+    Tables are cached in data/discr under a hash of the transcripts, generated
+    samples and charset, so changed inputs never reuse stale edit distances
+    '''
+    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    data_dir = os.path.join(parent_dir, 'data')
+    key = discr_table_key(fid_to_orig, fid_to_gens, charmap)
+    table_dir = os.path.join(data_dir, 'discr', '%s_table_%s' % (phase, key))
+    if not os.path.exists(table_dir):
+        table = mk_discr_table(fid_to_orig, fid_to_gens, charmap, processes=processes)
+        tmp_dir = table_dir + '.tmp'
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        for name in TABLE_FIELDS:
+            np.save(os.path.join(tmp_dir, '%s.npy' % name), table[name])
+        os.replace(tmp_dir, table_dir)
+    return {name: np.load(os.path.join(table_dir, '%s.npy' % name), mmap_mode='r') for name in TABLE_FIELDS}
+
+
+def pad_table_seqs(table, idxs):
     '''
     Args:
-        batch: list of (orig, gens, cers) pairs, where orig is np array of ints,
-            gens is list of np array of ints, and cers is list of floats
-    
+        idxs: 1-dim int np array of sequence indices
+
     Return:
-        xs_true: LongTensor with shape (batch_size, max_len_true)
-            batch_size equals the total number of generated samples in the batch
-        xs_gens: LongTensor with shape (batch_size, max_len_gens)
-        cers_tens: FloatTensor with shape (batch_size,)
+        xs: LongTensor with shape (len(idxs), max(max_len, 1)), zero padded
+        lens: LongTensor with shape (len(idxs),), 0 for empty sequences
     '''
-    batch_size = len(batch)
-    for (_, gens, _) in batch:
-        batch_size += len(gens)
-    max_len_true = 0
-    for (orig, _, _) in batch:
-        max_len_true = max(max_len_true, len(orig))
-    max_len_gens = 0
-    for (_, gens, _) in batch:
-        max_len_gens = max([max_len_gens]+[len(g) for g in gens])
-    xs_true = torch.LongTensor(batch_size, max_len_true).zero_()
-    xs_gens = torch.LongTensor(batch_size, max_len_gens).zero_()
-    cers_tens = torch.FloatTensor(batch_size)
-    i = 0
-    for (orig, gens, cers) in batch:
-        for g, cer in zip(gens, cers):
-            xs_true[i, :len(orig)] = torch.from_numpy(orig).long()
-            xs_gens[i, :len(g)] = torch.from_numpy(g).long()
-            cers_tens[i] = cer
-            i += 1
-    return xs_true, xs_gens, cers_tens
+    starts = table['offsets'][idxs]
+    lens = table['offsets'][idxs+1] - starts
+    cols = np.arange(max(lens.max(), 1))
+    mask = cols[None, :] < lens[:, None] # shape: (len(idxs), max_len)
+    xs = np.zeros(mask.shape, np.int64)
+    xs[mask] = table['chars'][(starts[:, None] + cols[None, :])[mask]]
+    return torch.from_numpy(xs), torch.from_numpy(lens)
+
+
+def table_group_lens(table):
+    # longest sequence among the pairs of each utterance
+    if len(table['groups']) < 2:
+        return np.zeros(0, np.int64)
+    seq_lens = np.diff(table['offsets'])
+    pair_lens = np.maximum(seq_lens[table['true_idx']], seq_lens[table['gen_idx']])
+    return np.maximum.reduceat(pair_lens, table['groups'][:-1])
+
+
+class DiscrDataset(Dataset):
+    '''Utterances of a pair table, as indices collated by DiscrCollate'''
+    def __init__(self, table):
+        self.num_groups = len(table['groups'])-1
+
+    def __len__(self):
+        return self.num_groups
+
+    def __getitem__(self, index):
+        return index
+
+
+class DiscrCollate(object):
+    def __init__(self, table):
+        self.table = table
+
+    def __call__(self, batch):
+        '''
+        Args:
+            batch: list of utterance indices into the table
+
+        Return:
+            xs_true: LongTensor with shape (batch_size, max_len_true)
+                batch_size equals the total number of generated samples in the batch
+            true_lens: LongTensor with shape (batch_size,)
+            xs_gens: LongTensor with shape (batch_size, max_len_gens)
+            gens_lens: LongTensor with shape (batch_size,)
+            cers_tens: FloatTensor with shape (batch_size,)
+        '''
+        groups = self.table['groups']
+        pairs = np.concatenate([np.arange(groups[k], groups[k+1]) for k in batch])
+        xs_true, true_lens = pad_table_seqs(self.table, self.table['true_idx'][pairs])
+        xs_gens, gens_lens = pad_table_seqs(self.table, self.table['gen_idx'][pairs])
+        cers_tens = torch.from_numpy(np.array(self.table['cers'][pairs]))
+        return xs_true, true_lens, xs_gens, gens_lens, cers_tens
 
 
-def make_loader(fid_to_orig, fid_to_gens, fid_to_cers, args, shuffle=True, batch_size=64):
+def make_loader(table, args, shuffle=True, batch_size=64):
+    '''
+    Args:
+        table: pair table from load_discr_table
+        batch_size: utterances per batch, each with all of its generated samples
+    '''
     kwargs = {'pin_memory': True, 'num_workers': args.num_workers} if torch.cuda.is_available() else {}
-    dataset = DiscrDataset(fid_to_orig, fid_to_gens, fid_to_cers)
-    loader = DataLoader(dataset, collate_fn=discr_collate_fn, shuffle=shuffle, batch_size=batch_size, **kwargs)
-    return loader
\ No newline at end of file
+    dataset = DiscrDataset(table)
+    sampler = BucketBatchSampler(table_group_lens(table), batch_size, shuffle=shuffle)
+    loader = DataLoader(dataset, collate_fn=DiscrCollate(table), batch_sampler=sampler, **kwargs)
+    return loader
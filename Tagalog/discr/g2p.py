@@ -1,63 +1,115 @@
+'''
+Script to build the grapheme-to-phoneme dictionaries used by g2p2g.py
+
+Transliterations are kept in data/g2p_cache.pkl, keyed by (lid, word) and
+shared by all phases and runs, so only words missing from the cache are sent
+to Epitran, spread over --processes workers, e.g.
+
+    python3 g2p.py --phase train dev test --processes 8
+'''
+
 import argparse
 import epitran
+import multiprocessing as mp
 import os
 import pickle
 
 
-epi_en = epitran.Epitran('eng-Latn')
-epi_tl = epitran.Epitran('tgl-Latn')
+EPITRAN_CODES = {'en': 'eng-Latn', 'tl': 'tgl-Latn'}
+epitrans = {} # per-process Epitran instances, created on first use
+
+def get_epitran(lid):
+    # any lid other than en is transliterated as Tagalog
+    code = EPITRAN_CODES['en'] if lid == 'en' else EPITRAN_CODES['tl']
+    if code not in epitrans:
+        epitrans[code] = epitran.Epitran(code)
+    return epitrans[code]
+
+def transliterate(item):
+    word, lid = item
+    return get_epitran(lid).transliterate(word)
+
+def load_pkl(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
 
 def save_pkl(obj, path):
-    with open(path, 'wb') as f:
+    # written to a temporary file first so that an interrupted run keeps the old file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
 
 def get_vocab(path, lid_path):
-    with open(path, 'r') as inf:
-        lines = inf.readlines()
-    with open(lid_path, 'r') as inf:
-        lid_lines = inf.readlines()
+    '''Reads the words of a split and their language IDs in one pass
+
+    Return:
+        vocab: set of words
+        word_to_lid: {word: lid of its last occurrence}
+    '''
     vocab = set()
     word_to_lid = {}
-    for l, lid_l in zip(lines, lid_lines):
-        l = l.strip()
-        l_list = l.split()
-        word_list = l_list[1:]
-        lid_list = lid_l.strip().split()[1:]
-        vocab = vocab.union(set(word_list))
-        for word, lid in zip(word_list, lid_list):
-            word_to_lid[word] = lid
+    with open(path, 'r') as inf, open(lid_path, 'r') as lid_inf:
+        for l, lid_l in zip(inf, lid_inf):
+            word_list = l.strip().split()[1:]
+            lid_list = lid_l.strip().split()[1:]
+            vocab.update(word_list)
+            for word, lid in zip(word_list, lid_list):
+                word_to_lid[word] = lid
     return vocab, word_to_lid
 
-def mk_g2p_dict(vocab, word_to_lid):
+def mk_g2p_dict(vocab, word_to_lid, cache=None, processes=1):
+    '''
+    Args:
+        cache: {(lid, word): IPA string}, updated in place with new transliterations
+        processes: worker processes for transliterating cache misses
+
+    Return:
+        g2p_dict: {word: IPA string}
+    '''
+    if cache is None:
+        cache = {}
+    keys = [(word_to_lid[word], word) for word in vocab]
+    misses = sorted(set(k for k in keys if k not in cache))
+    items = [(word, lid) for lid, word in misses]
+    if processes > 1 and len(items) > 1:
+        with mp.Pool(processes) as pool:
+            ps = pool.map(transliterate, items, chunksize=max(len(items) // (4*processes), 1))
+    else:
+        ps = [transliterate(item) for item in items]
+    cache.update(zip(misses, ps))
     g2p_dict = {}
-    for word in vocab:
-        lid = word_to_lid[word]
-        p = epi_en.transliterate(word) if lid == 'en' else epi_tl.transliterate(word)
-        g2p_dict[word] = p
+    for word, key in zip(vocab, keys):
+        g2p_dict[word] = cache[key]
     return g2p_dict
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--phase', type=str, default='train', help='train, dev, or test')
+    parser.add_argument('--phase', type=str, nargs='+', default=['train'], help='train, dev, and/or test')
+    parser.add_argument('--processes', type=int, default=1, metavar='N', help='worker processes for transliteration')
     return parser.parse_args()
 
 def main():
     args = parse_args()
-    
-    phase_file = '%s.txt' % args.phase
-    lid_file = '%s_lids.txt' % args.phase
+
     parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     data_dir = os.path.join(parent_dir, 'data')
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
     split_dir = os.path.join(parent_dir, 'split')
-    phase_path = os.path.join(split_dir, phase_file)
-    lid_path = os.path.join(split_dir, lid_file)
+    cache_path = os.path.join(data_dir, 'g2p_cache.pkl')
+    cache = load_pkl(cache_path) if os.path.exists(cache_path) else {}
 
-    vocab, word_to_lid = get_vocab(phase_path, lid_path)
-    g2p_dict = mk_g2p_dict(vocab, word_to_lid)
-    g2p_path = os.path.join(data_dir, 'g2p_dict_%s.pkl' % args.phase)
-    save_pkl(g2p_dict, g2p_path)
+    for phase in args.phase:
+        phase_path = os.path.join(split_dir, '%s.txt' % phase)
+        lid_path = os.path.join(split_dir, '%s_lids.txt' % phase)
+        vocab, word_to_lid = get_vocab(phase_path, lid_path)
+        num_cached = len(cache)
+        g2p_dict = mk_g2p_dict(vocab, word_to_lid, cache=cache, processes=args.processes)
+        print('%s: %d words, %d transliterated' % (phase, len(vocab), len(cache) - num_cached))
+        g2p_path = os.path.join(data_dir, 'g2p_dict_%s.pkl' % phase)
+        save_pkl(g2p_dict, g2p_path)
+        save_pkl(cache, cache_path)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
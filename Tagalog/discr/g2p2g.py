@@ -1,10 +1,26 @@
+'''
+Script to generate phonetically confusable sentences for discriminator training
+
+Each sentence is mapped to IPA with the g2p dictionary, cut into chunks of
+randomly sampled lengths, and every chunk is mapped back to the word with the
+closest pronunciation. The nearest pronunciation search uses a BK-tree over
+the dictionary, cached next to g2p_dict_<phase>.pkl, and --processes shards the
+input lines over a process pool, e.g.
+
+    python3 g2p2g.py --phase train --processes 8
+'''
+
 import argparse
+import csv
+import multiprocessing as mp
 import numpy as np
 import os
 import pickle
 import sys
 
-from nltk.metrics import edit_distance
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))  # shared modules
+from scoring import edit_distances
+from vocab_index import VocabIndex
 
 
 def load_pkl(path):
@@ -22,79 +38,101 @@ def g2p(g, g2p_dict):
     return p
 
 
-def dist(p1, p2):
-    return edit_distance(p1, p2)
+def find_closest_word_helper(p, p2g_dict, index):
+    # first pronunciation in dictionary order at the minimum distance
+    _, found = index.nearest(p)
+    best_p = index.words[found[0]]
+    return best_p, p2g_dict[best_p]
 
 
-def find_closest_word_helper(p, p2g_dict_by_len):
-    len_p = len(p)
-    min_dist_1 = sys.maxsize
-    best_p_1 = ''
-    for curr_p in p2g_dict_by_len[len_p]:
-        curr_dist = dist(p, curr_p)
-        if curr_dist < min_dist_1:
-            min_dist_1 = curr_dist
-            best_p_1 = curr_p
-    
-    min_dist_2 = sys.maxsize
-    if len_p > 2:
-        best_p_2 = ''
-        for curr_p in p2g_dict_by_len[len_p-1]:
-            curr_dist = dist(p, curr_p)
-            if curr_dist < min_dist_2:
-                min_dist_2 = curr_dist
-                best_p_2 = curr_p
-
-    min_dist_3 = sys.maxsize
-    if len_p > 4:
-        best_p_3 = ''
-        for curr_p in p2g_dict_by_len[len_p-2]:
-            curr_dist = dist(p, curr_p)
-            if curr_dist < min_dist_3:
-                min_dist_3 = curr_dist
-                best_p_3 = curr_p
-
-    best_p = best_p_1 if min_dist_1 < min_dist_2 and min_dist_1 < min_dist_3 else best_p_2 if min_dist_2 < min_dist_3 else best_p_3
-    return best_p, p2g_dict_by_len[len(best_p)][best_p]
-
-
-def find_closest_word(p, p2g_dict_by_len):
+def find_closest_word(p, p2g_dict, index, cache=None):
+    '''Maps a phoneme chunk to (pronunciation, word)
+
+    Exact matches of the chunk, or of the chunk without its last one or two
+    phonemes, are taken directly; otherwise the nearest pronunciation is used
+    '''
+    if cache is not None and p in cache:
+        return cache[p]
     new_p = p
     len_p = len(new_p)
-    if new_p in p2g_dict_by_len[len_p]:
-        return new_p, p2g_dict_by_len[len_p][new_p]
-    elif len_p > 2 and new_p[:-1] in p2g_dict_by_len[len_p-1]:
-        return new_p[:-1], p2g_dict_by_len[len_p-1][new_p[:-1]]
-    elif len_p > 4 and new_p[:-2] in p2g_dict_by_len[len_p-2]:
-        return new_p[:-2], p2g_dict_by_len[len_p-2][new_p[:-2]]
+    if new_p in p2g_dict:
+        result = new_p, p2g_dict[new_p]
+    elif len_p > 2 and new_p[:-1] in p2g_dict:
+        result = new_p[:-1], p2g_dict[new_p[:-1]]
+    elif len_p > 4 and new_p[:-2] in p2g_dict:
+        result = new_p[:-2], p2g_dict[new_p[:-2]]
     else:
-        return find_closest_word_helper(p, p2g_dict_by_len)
-
-
-def p2g(p, p2g_dict_by_len, distr, num_g):
+        result = find_closest_word_helper(p, p2g_dict, index)
+    if cache is not None:
+        cache[p] = result
+    return result
+
+
+def sample_chunk_lens(p, distr):
+    '''Samples chunk lengths covering p, drawing the lengths in batches'''
+    lens = []
+    covered = 0
+    while covered < len(p):
+        for curr_len in np.random.choice(len(distr), size=len(p), p=distr):
+            curr_len = min(curr_len, len(p)-covered)
+            lens.append(curr_len)
+            covered += curr_len
+            if covered >= len(p):
+                break
+    return lens
+
+
+def p2g(p, p2g_dict, index, distr, num_g, cache=None):
     '''p is a string comprised of IPA characters'''
     gs = []
     while len(gs) < num_g:
         g_sent_list = []
         curr_i = 0
-        while curr_i < len(p):
-            curr_len = np.where(np.random.multinomial(1, distr)==1)[0][0]
-            remaining_len = len(p)-curr_i
-            if remaining_len < curr_len:
-                curr_len = remaining_len
+        for curr_len in sample_chunk_lens(p, distr):
             curr_p = p[curr_i:curr_i+curr_len]
-            best_p, g_word = find_closest_word(curr_p, p2g_dict_by_len)
+            best_p, g_word = find_closest_word(curr_p, p2g_dict, index, cache)
             curr_i += curr_len # len(best_p)
             g_sent_list.append(g_word)
         g_sent = ' '.join(g_sent_list)
         gs.append(g_sent)
     return gs
 
-def mk_gs(g, g2p_dict, p2g_dict_by_len, distr, num_g):
+def mk_gs(g, g2p_dict, p2g_dict, index, distr, num_g, cache=None):
     p = g2p(g, g2p_dict)
-    gs = p2g(p, p2g_dict_by_len, distr, num_g)
+    gs = p2g(p, p2g_dict, index, distr, num_g, cache)
     return gs
 
+
+worker_state = None
+worker_cache = {} # phoneme chunk -> (pronunciation, word), shared by the lines of a worker
+
+
+def init_worker(state):
+    global worker_state
+    worker_state = state
+
+
+def process_line(item):
+    '''Generates the num_g best confusable sentences for one (line index, line) pair
+
+    The random state is seeded per line, so results do not depend on how the
+    lines are sharded over processes
+
+    Return:
+        list of strings: fid followed by the generated sentences
+    '''
+    i, l = item
+    g2p_dict, p2g_dict, index, distr, num_g, seed = worker_state
+    np.random.seed(seed + i)
+    l_list = l.strip().split()
+    fid = l_list[0]
+    words = ' '.join(l_list[1:])
+    gs = mk_gs(words, g2p_dict, p2g_dict, index, distr, num_g*2, cache=worker_cache)
+    dists = edit_distances([words]*len(gs), gs)
+    idxs = np.argsort(dists)
+    best_gs = [gs[j] for j in idxs[:num_g]]
+    return [fid] + best_gs
+
 def print_log(s, log_path):
     print(s)
     with open(log_path, 'a+') as ouf:
@@ -105,6 +143,8 @@ def parse_args():
     parser.add_argument('--num-g', type=int, default=5, metavar='N', help='number of new sentences per datapoint')
     parser.add_argument('--start-i', type=int, default=0, metavar='N', help='index to start at')
     parser.add_argument('--phase', type=str, default='train', help='train, dev, or test')
+    parser.add_argument('--processes', type=int, default=1, metavar='N', help='worker processes')
+    parser.add_argument('--seed', type=int, default=0, metavar='N', help='random seed')
     return parser.parse_args()
 
 def main():
@@ -124,36 +164,33 @@ def main():
     
     ps = list(p2g_dict.keys())
     lens = [len(w) for w in ps]
-    max_len = max(lens)
     distr = np.bincount(lens)/len(lens)
-    p2g_dict_by_len = [{}]*(max_len+1)
-    for p in p2g_dict:
-        p2g_dict_by_len[len(p)][p] = p2g_dict[p]
+    index = VocabIndex.load_or_build(ps, data_dir, sort=False, name='p2g_index_%s' % args.phase)
 
     with open(phase_path, 'r') as inf:
         lines = inf.readlines()
+    items = list(enumerate(lines))[args.start_i:]
+
+    state = (g2p_dict, p2g_dict, index, distr, args.num_g, args.seed)
+    if args.processes > 1:
+        pool = mp.Pool(args.processes, initializer=init_worker, initargs=(state,))
+        results = pool.imap(process_line, items, chunksize=16)
+    else:
+        pool = None
+        init_worker(state)
+        results = map(process_line, items)
 
     all_gs = []
-    for l in lines[args.start_i:]:
-        l = l.strip()
-        l_list = l.split()
-        fid = l_list[0]
-        print_log(fid, log_path)
-        words = ' '.join(l_list[1:])
-        num_raw_gs = args.num_g*2
-        gs = mk_gs(words, g2p_dict, p2g_dict_by_len, distr, num_raw_gs)
-        dists = [edit_distance(words, g) for g in gs]
-        idxs = np.argsort(dists)
-        sorted_gs = np.array(gs)[idxs]
-        best_gs = sorted_gs[:args.num_g]
-        best_gs = np.insert(best_gs, 0, fid)
+    for best_gs in results:
         for g in best_gs:
             print_log(g, log_path)
         all_gs.append(best_gs)
-    all_gs = np.stack(all_gs)
+    if pool is not None:
+        pool.close()
+        pool.join()
     gs_path = os.path.join(data_dir, 'gs_%s.csv' % args.phase)
-    np.savetxt(gs_path, all_gs, delimiter=",")
-
+    with open(gs_path, 'w', newline='') as f:
+        csv.writer(f).writerows(all_gs)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
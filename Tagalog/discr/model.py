@@ -9,7 +9,52 @@ import torch
 import torch.nn as nn
 
 from torch.autograd import Variable
-from torch.distributions.bernoulli import Bernoulli
+from torch.nn.utils.rnn import pack_padded_sequence
+
+
+def word_dropout(x, lens, prob_keep):
+    '''Drops each character of each sequence independently and compacts the rest
+
+    The kept characters of a sequence are moved to its front, in order. A
+    sequence that would lose every character keeps its first one
+
+    Args:
+        x: LongTensor with shape (batch_size, seq_len)
+        lens: LongTensor with shape (batch_size,)
+
+    Return:
+        x: LongTensor with shape (batch_size, new_seq_len)
+        lens: LongTensor with shape (batch_size,), on the CPU
+    '''
+    positions = torch.arange(x.shape[1], device=x.device)
+    valid = positions[None, :] < lens.to(x.device)[:, None] # shape: (batch_size, seq_len)
+    keep = (torch.rand(x.shape, device=x.device) < prob_keep) & valid
+    empty = keep.sum(1) == 0
+    keep[:, 0] = keep[:, 0] | empty
+    order = torch.argsort((~keep).int(), dim=1, stable=True) # kept positions first
+    new_lens = keep.sum(1).cpu()
+    x = x.gather(1, order)[:, :int(new_lens.max())]
+    return x, new_lens
+
+
+def final_states(rnn, x_emb, lens=None):
+    '''Last layer's final hidden states of a bidirectional LSTM over padded sequences
+
+    Empty sequences are read as a single padding token, since packing needs
+    at least one step per sequence
+
+    Args:
+        x_emb: FloatTensor with shape (batch_size, seq_len, emb_dim), seq_len >= 1
+        lens: LongTensor with shape (batch_size,), or None if nothing is padded
+
+    Return:
+        FloatTensor with shape (batch_size, 2*hidden_dim)
+    '''
+    if lens is not None:
+        x_emb = pack_padded_sequence(x_emb, lens.cpu().clamp(min=1), batch_first=True, enforce_sorted=False)
+    _, (h, _) = rnn(x_emb) # h shape: (num_layers*2, batch_size, hidden_dim), in input order
+    return torch.cat([h[-2], h[-1]], 1)
+
 
 class SimpleLSTMDiscriminator(nn.Module):
     def __init__(self, vocab_size, num_layers=2, word_dropout=0.2, emb_dim=300, hidden_dim=650):
@@ -24,14 +69,18 @@ class SimpleLSTMDiscriminator(nn.Module):
             nn.Linear(hidden_dim*2, 2)
         )
 
-    def forward(self, x):
-        x_emb = self.emb_mat(x) # shape: (batch_size, seq_len, emb_dim)
+    def forward(self, x, lens=None):
+        '''
+        Args:
+            x: LongTensor with shape (batch_size, seq_len)
+            lens: LongTensor with shape (batch_size,), or None if nothing is padded
+        '''
         if self.training:
-            rw = Bernoulli(self.prob_keep).sample((x_emb.shape[1], ))
-            x_emb = x_emb[:, rw==1] # (batch_size, new_seq_len, emb_dim)
-        _, (h, _) = self.rnn(x_emb)
-        h = h.view(self.num_layers, 2, -1, self.hidden_dim) # num_layers, 2, batch_size, hidden_dim)
-        h = torch.cat([h[-1][0], h[-1][1]], 1) # (batch_size, 2*hidden_dim)
+            if lens is None:
+                lens = torch.full((x.shape[0],), x.shape[1], dtype=torch.long)
+            x, lens = word_dropout(x, lens, self.prob_keep)
+        x_emb = self.emb_mat(x) # shape: (batch_size, seq_len, emb_dim)
+        h = final_states(self.rnn, x_emb, lens) # (batch_size, 2*hidden_dim)
         out = self.fc(h)
         return out
 
@@ -48,34 +97,35 @@ class LSTMDiscriminator(nn.Module):
         self.rnn = nn.LSTM(emb_dim, hidden_dim, batch_first=True, num_layers=num_layers, dropout=0.35, bidirectional=True)
         self.w = nn.Parameter(torch.randn(2*hidden_dim))
 
-    def forward_repr(self, x):
+    def forward_repr(self, x, lens=None):
         '''
         Args:
             x: LongTensor with shape (batch_size, seq_len)
+            lens: LongTensor with shape (batch_size,), or None if nothing is padded
         '''
-        x_emb = self.emb_mat(x) # shape: (batch_size, seq_len, emb_dim)
         if self.training:
-            rw = Bernoulli(self.prob_keep).sample((x_emb.shape[1], ))
-            x_emb = x_emb[:, rw==1] # (batch_size, new_seq_len, emb_dim)
-        _, (h, _) = self.rnn(x_emb)
-        h = h.view(self.num_layers, 2, -1, self.hidden_dim) # num_layers, 2, batch_size, hidden_dim)
-        h = torch.cat([h[-1][0], h[-1][1]], 1) # (batch_size, 2*hidden_dim)
+            if lens is None:
+                lens = torch.full((x.shape[0],), x.shape[1], dtype=torch.long)
+            x, lens = word_dropout(x, lens, self.prob_keep)
+        x_emb = self.emb_mat(x) # shape: (batch_size, seq_len, emb_dim)
+        h = final_states(self.rnn, x_emb, lens) # (batch_size, 2*hidden_dim)
         return h
 
-    def forward_score(self, x):
+    def forward_score(self, x, lens=None):
         '''
         Args:
             x: LongTensor with shape (batch_size, seq_len)
+            lens: LongTensor with shape (batch_size,), or None if nothing is padded
         
         Args:
             score: FloatTensor with shape (batch_size,)
         '''
-        h = self.forward_repr(x)
+        h = self.forward_repr(x, lens)
         score = (self.w[None, :]*h).sum(1)
         return score
 
-    def forward(self, x):
-        return self.forward_score(x)
+    def forward(self, x, lens=None):
+        return self.forward_score(x, lens)
 
 class WERDiscriminatorLoss(nn.Module):
     def __init__(self):
@@ -96,15 +146,35 @@ class WERDiscriminatorLoss(nn.Module):
 
 
 class LSTMLM(nn.Module):
+    '''Character LSTM language model
+
+    With full teacher forcing (always the case in eval mode) the whole sequence
+    runs through one nn.LSTM call; the stepwise loop is only used for scheduled
+    sampling, where each input depends on the previous prediction. Version 1
+    checkpoints, which stored an nn.LSTMCell as rnn_cell, load into the same
+    weights
+    '''
+    _version = 2
+
     def __init__(self, vocab_size, args):
         super(LSTMLM, self).__init__()
         self.hidden_dim = args.hidden_dim
         self.emb_mat = nn.Embedding(vocab_size, args.emb_dim)
-        self.rnn_cell = nn.LSTMCell(args.emb_dim, self.hidden_dim)
+        self.rnn = nn.LSTM(args.emb_dim, self.hidden_dim)
         self.char_projection = nn.Sequential(
             nn.Linear(self.hidden_dim, vocab_size)
         )
         self.force_rate = args.teacher_force_rate
+        self.fused = True # set to False to always run the stepwise loop
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, *args, **kwargs):
+        version = local_metadata.get('version', None)
+        if version is None or version < 2:
+            for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+                old_key = '%srnn_cell.%s' % (prefix, name)
+                if old_key in state_dict:
+                    state_dict['%srnn.%s_l0' % (prefix, name)] = state_dict.pop(old_key)
+        super(LSTMLM, self)._load_from_state_dict(state_dict, prefix, local_metadata, *args, **kwargs)
 
     def forward_step(self, prev_char, prev_hidden):
         '''
@@ -118,11 +188,26 @@ class LSTMLM(nn.Module):
             new_hidden: pair of tensors with shape (batch_size, hidden_dim)
         '''
         emb = self.emb_mat(prev_char) # (batch_size, emb_dim)
-        h, c = self.rnn_cell(emb, prev_hidden) # h shape: (batch_size, hidden_dim)
+        h0, c0 = prev_hidden
+        _, (h, c) = self.rnn(emb.unsqueeze(0), (h0.unsqueeze(0), c0.unsqueeze(0)))
+        h, c = h[0], c[0] # shape: (batch_size, hidden_dim)
         logits = self.char_projection(h)
         y_pred = torch.max(logits, 1)[1]
         return logits, y_pred, (h, c)
 
+    def forward_fused(self, x, hidden):
+        '''
+        Args:
+            x: tensor with shape (maxlen, batch_size)
+            hidden: pair of tensors with shape (batch_size, hidden_dim)
+        '''
+        emb = self.emb_mat(x) # shape: (maxlen, batch_size, emb_dim)
+        h0, c0 = hidden
+        out, _ = self.rnn(emb, (h0.unsqueeze(0), c0.unsqueeze(0))) # shape: (maxlen, batch_size, hidden_dim)
+        all_logits = self.char_projection(out) # shape: (maxlen, batch_size, vocab_size)
+        y_preds = torch.max(all_logits, 2)[1].t() # shape: (batch_size, maxlen)
+        return all_logits, y_preds
+
     def forward(self, x, lens):
         '''
         Args:
@@ -132,11 +217,14 @@ class LSTMLM(nn.Module):
         '''
         maxlen, batch_size = x.shape
 
-        hidden = (torch.randn(batch_size, self.hidden_dim), torch.randn(batch_size, self.hidden_dim))
+        hidden = (torch.randn(batch_size, self.hidden_dim, device=x.device), torch.randn(batch_size, self.hidden_dim, device=x.device))
+        sampling = self.force_rate < 1 and self.training
+        if self.fused and not sampling:
+            return self.forward_fused(x, hidden)
         all_logits = []
         y_preds = []
         for i in range(maxlen):
-            if len(y_preds) > 0 and self.force_rate < 1 and self.training:
+            if len(y_preds) > 0 and sampling:
                 forced_char = x[i, :] # shape: (batch_size,)
                 gen_char = y_preds[-1]
                 force_mask = Variable(forced_char.data.new(*forced_char.size()).bernoulli_(self.force_rate))
@@ -15,7 +15,6 @@ import csv
 import itertools
 import numpy as np
 import os
-import sys
 import time
 import torch
 
@@ -29,22 +28,6 @@ from model import *
 from train_discr import parse_args
 
 
-def find_best_pred(model, preds):
-    '''
-    Args:
-        model: nn.Module, discriminator
-        preds: list of 1-dim np int arrays
-    '''
-    best_score = -sys.maxsize-1
-    best_i = 0
-    for i, p in enumerate(preds):
-        score = model(p.unsqueeze(0))[0].item()
-        if score > best_score:
-            best_i = i
-            best_score = score
-    return preds[best_i], best_i
-
-
 def main():
     args = parse_args()
 
@@ -84,25 +67,18 @@ def main():
     preds_path = os.path.join(args.save_directory, args.beam_file)
     raw_preds = load_preds(preds_path) # list of string lists
     print('%d beam groups, each of size %d' % (len(raw_preds), len(raw_preds[0])))
-    all_preds = map_characters_rerank(raw_preds, charmap)
+    all_preds = map_characters_rerank(raw_preds, charmap, cuda=False)
         # list of lists, each sublist comprised of 1-dim int np arrays
     t1 = time.time()
     print_log('%.2f Seconds' % (t1-t0), log_path)
 
     print("Reranking")
-    reranked_preds = []
-    model.eval()
-    with torch.no_grad():
-        for pred_i, preds in enumerate(all_preds):
-            if len(preds) > 0:
-                best_pred, best_i = find_best_pred(model, preds)
-                best_pred_str = raw_preds[pred_i][best_i]
-            else:
-                best_pred_str = ''
-            reranked_preds.append(best_pred_str)
-            if (pred_i+1) % 100 == 0:
-                t1 = time.time()
-                print('Processed %d / %d groups (%.2f Seconds)' % (pred_i+1, len(all_preds), t1-t0))
+    if args.rerank_processes > 1 and torch.cuda.is_available():
+        print('Scoring on the GPU, ignoring --rerank-processes')
+    best_idxs = rerank(model, all_preds, batch_frames=args.rerank_batch_frames, processes=args.rerank_processes)
+    reranked_preds = [raw_preds[pred_i][best_i] if best_i >= 0 else '' for pred_i, best_i in enumerate(best_idxs)]
+    t1 = time.time()
+    print_log('Reranked %d groups (%.2f Seconds)' % (len(all_preds), t1-t0), log_path)
     reranked_preds_path = os.path.join(args.save_directory, 'reranked.csv')
     with open(reranked_preds_path, 'w+', newline='') as f:
         w = csv.writer(f)
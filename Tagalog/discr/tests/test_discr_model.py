@@ -0,0 +1,37 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from discr_utils import pad_table_seqs, simple_discr_collate_fn
+from model import LSTMDiscriminator, SimpleLSTMDiscriminator
+
+
+@pytest.mark.parametrize('cls', [LSTMDiscriminator, SimpleLSTMDiscriminator])
+@pytest.mark.parametrize('training', [False, True])
+def test_empty_sequences(cls, training):
+    model = cls(10, emb_dim=8, hidden_dim=6)
+    model.train(training)
+    x = torch.LongTensor([[3, 4, 5], [0, 0, 0]])
+    out = model(x, torch.LongTensor([3, 0]))
+    assert out.shape[0] == 2
+    assert torch.isfinite(out).all()
+
+
+def test_empty_batch():
+    model = LSTMDiscriminator(10, emb_dim=8, hidden_dim=6)
+    model.eval()
+    table = {'offsets': np.array([0, 0, 0]), 'chars': np.zeros(0, np.int64)}
+    xs, lens = pad_table_seqs(table, np.array([0, 1]))
+    assert xs.shape == (2, 1)
+    assert lens.tolist() == [0, 0]
+    assert model(xs, lens).shape == (2,)
+
+
+def test_simple_collate_empty_generation():
+    xs, lens, ys = simple_discr_collate_fn([(np.array([1, 2]), [np.array([], np.int64)])])
+    assert lens.tolist() == [2, 0]
+    assert ys.tolist() == [1, 0]
+    model = SimpleLSTMDiscriminator(10, emb_dim=8, hidden_dim=6)
+    model.eval()
+    assert model(xs, lens).shape == (2, 2)
@@ -0,0 +1,34 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from discr_utils import find_best_preds, mk_rerank_batches, score_preds
+from model import LSTMDiscriminator, SimpleLSTMDiscriminator
+
+
+def test_mk_rerank_batches():
+    lens = [5, 1, 3, 3, 8, 0]
+    batches = mk_rerank_batches(lens, batch_frames=9)
+    assert sorted(i for b in batches for i in b) == list(range(len(lens)))
+    for b in batches:
+        assert len(b) == 1 or len(b) * max(lens[i] for i in b) <= 9
+
+
+@pytest.mark.parametrize('cls,column', [(LSTMDiscriminator, None), (SimpleLSTMDiscriminator, 1)])
+def test_padded_scores_match_single(cls, column):
+    torch.manual_seed(0)
+    model = cls(10, emb_dim=8, hidden_dim=6)
+    model.eval()
+    all_preds = [[torch.randint(1, 10, (n,)) for n in ns] for ns in [[4, 7, 1], [], [0, 3], [12]]]
+    with torch.no_grad():
+        scores = score_preds(model, all_preds, batch_frames=20, column=column)
+        flat = [p for preds in all_preds for p in preds]
+        for k, p in enumerate(flat):
+            x = torch.zeros(1, max(len(p), 1), dtype=torch.long)
+            x[0, :len(p)] = p
+            out = model(x, torch.LongTensor([len(p)]))
+            single = out[0] if column is None else out[0, column]
+            assert torch.allclose(scores[k], single, atol=1e-5)
+        best = find_best_preds(model, all_preds, batch_frames=20, column=column)
+    assert best[1] == -1
+    assert len(best) == len(all_preds)
@@ -32,6 +32,7 @@ def parse_args():
     parser.add_argument('--patience', type=int, default=10, help='patience for early stopping')
     parser.add_argument('--num-workers', type=int, default=2, metavar='N', help='number of workers')
     parser.add_argument('--cuda', type=int, default=0, help='CUDA device')
+    parser.add_argument('--processes', type=int, default=1, metavar='N', help='worker processes for building the CER tables')
 
     parser.add_argument('--lr', type=float, default=1e-3, metavar='N', help='learning rate')
     parser.add_argument('--weight-decay', type=float, default=1e-5, metavar='N', help='weight decay')
@@ -44,6 +45,8 @@ def parse_args():
     parser.add_argument('--hidden-dim', type=int, default=650, metavar='N', help='hidden dimension')
 
     parser.add_argument('--beam-file', type=str, default='preds.csv', help='beam outputs file')
+    parser.add_argument('--rerank-batch-frames', type=int, default=20000, metavar='N', help='characters per discriminator batch when reranking')
+    parser.add_argument('--rerank-processes', type=int, default=1, metavar='N', help='CPU worker processes for reranking')
 
     return parser.parse_args()
 
@@ -74,20 +77,6 @@ def main():
     t1 = time.time()
     print_log('%.2f Seconds' % (t1-t0), log_path)
 
-    train_fid_to_cers = load_fid_to_cers('train')
-    if train_fid_to_cers is None:
-        print("Building Train CER Dictionary")
-        train_fid_to_cers = mk_fid_to_cers(fid_to_gens, train_fid_to_orig, 'train')
-        t1 = time.time()
-        print_log('%.2f Seconds' % (t1-t0), log_path)
-
-    dev_fid_to_cers = load_fid_to_cers('dev')
-    if dev_fid_to_cers is None:
-        print("Building Dev CER Dictionary")
-        dev_fid_to_cers = mk_fid_to_cers(fid_to_gens, dev_fid_to_orig, 'dev')
-        t1 = time.time()
-        print_log('%.2f Seconds' % (t1-t0), log_path)
-
     print("Building Charset")
     charset = build_charset(np.concatenate((train_orig, dev_orig), axis=0))
     charmap = make_charmap(charset) # {string: int}
@@ -95,16 +84,15 @@ def main():
     t1 = time.time()
     print_log('%.2f Seconds' % (t1-t0), log_path)
 
-    print("Mapping Characters")
-    train_fid_to_orig = map_characters_orig(train_fid_to_orig, charmap)
-    dev_fid_to_orig = map_characters_orig(dev_fid_to_orig, charmap)
-    fid_to_gens = map_characters_gens(fid_to_gens, charmap)
+    print("Loading Pair Tables") # built with CERs on the first run for each input
+    train_table = load_discr_table('train', train_fid_to_orig, fid_to_gens, charmap, processes=args.processes)
+    dev_table = load_discr_table('dev', dev_fid_to_orig, fid_to_gens, charmap, processes=args.processes)
     t1 = time.time()
     print_log('%.2f Seconds' % (t1-t0), log_path)
 
     print("Building Loader") # TODO add wer to loader
-    train_loader = make_loader(train_fid_to_orig, fid_to_gens, train_fid_to_cers, args, shuffle=True, batch_size=args.batch_size)
-    dev_loader = make_loader(dev_fid_to_orig, fid_to_gens, dev_fid_to_cers, args, shuffle=False, batch_size=args.batch_size)
+    train_loader = make_loader(train_table, args, shuffle=True, batch_size=args.batch_size)
+    dev_loader = make_loader(dev_table, args, shuffle=False, batch_size=args.batch_size)
     t1 = time.time()
     print_log('%.2f Seconds' % (t1-t0), log_path)
 
@@ -133,13 +121,14 @@ def main():
         # train
         model.train()
         optimizer.zero_grad()
+        train_loader.batch_sampler.set_epoch(e)
         l = 0
-        for i, (xs_true, xs_gens, cers) in enumerate(train_loader):
+        for i, (xs_true, true_lens, xs_gens, gens_lens, cers) in enumerate(train_loader):
             xs_true, xs_gens, cers = Variable(xs_true), Variable(xs_gens), Variable(cers)
             if torch.cuda.is_available():
                 xs_true, xs_gens, cers = xs_true.cuda(args.cuda), xs_gens.cuda(args.cuda), cers.cuda(args.cuda)
-            true_scores = model(xs_true)
-            gens_scores = model(xs_gens)
+            true_scores = model(xs_true, true_lens)
+            gens_scores = model(xs_gens, gens_lens)
             loss = criterion(true_scores, gens_scores, cers)
             l += loss.item()
             loss.backward()
@@ -156,12 +145,12 @@ def main():
             l = 0
             num_correct = 0.0
             tot_dev = 0
-            for i, (xs_true, xs_gens, cers) in enumerate(dev_loader):
+            for i, (xs_true, true_lens, xs_gens, gens_lens, cers) in enumerate(dev_loader):
                 xs_true, xs_gens, cers = Variable(xs_true), Variable(xs_gens), Variable(cers)
                 if torch.cuda.is_available():
                     xs_true, xs_gens, cers = xs_true.cuda(args.cuda), xs_gens.cuda(args.cuda), cers.cuda(args.cuda)
-                true_scores = model(xs_true)
-                gens_scores = model(xs_gens)
+                true_scores = model(xs_true, true_lens)
+                gens_scores = model(xs_gens, gens_lens)
                 loss = criterion(true_scores, gens_scores, cers)
                 l += loss.item()
                 num_correct = num_correct + (true_scores > gens_scores).sum()
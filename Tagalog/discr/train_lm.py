@@ -42,9 +42,47 @@ def parse_args():
     parser.add_argument('--emb-dim', type=int, default=300, metavar='N', help='hidden dimension')
     parser.add_argument('--hidden-dim', type=int, default=650, metavar='N', help='hidden dimension')
 
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N', help='time N teacher-forced batches with the fused and stepwise LSTM and exit')
+
     return parser.parse_args()
 
 
+def benchmark(args, model, criterion, loader, log_path):
+    '''Times fully teacher-forced training steps of the fused and stepwise paths
+
+    Both paths see the same batches and random initial states, so their losses
+    should match up to floating point error
+    '''
+    batches = list(itertools.islice(loader, args.benchmark))
+    force_rate = model.force_rate
+    model.force_rate = 1.0
+    model.train()
+    losses = {}
+    for fused in [True, False]:
+        model.fused = fused
+        torch.manual_seed(0)
+        losses[fused] = []
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.time()
+        for l1array, llens, l2array in batches:
+            if torch.cuda.is_available():
+                l1array, llens, l2array = l1array.cuda(args.cuda), llens.cuda(args.cuda), l2array.cuda(args.cuda)
+            logits, y_preds = model(l1array, llens)
+            loss = criterion((logits, y_preds, llens), l2array)
+            loss.backward()
+            losses[fused].append(loss.item())
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t1 = time.time()
+        model.zero_grad()
+        print_log('%s: %.2f ms per batch' % ('fused' if fused else 'stepwise', 1000*(t1-t0)/len(batches)), log_path)
+    max_diff = max(abs(a-b) for a, b in zip(losses[True], losses[False]))
+    print_log('max loss difference: %g' % max_diff, log_path)
+    model.fused = True
+    model.force_rate = force_rate
+
+
 def main():
     args = parse_args()
 
@@ -96,6 +134,10 @@ def main():
     if torch.cuda.is_available():
         model = model.cuda(args.cuda)
 
+    if args.benchmark > 0:
+        benchmark(args, model, criterion, train_loader, LOG_PATH)
+        return
+
     best_val_loss = sys.maxsize
     prev_best_epoch = 0
     for e in range(args.epochs):
@@ -44,6 +44,8 @@ def parse_args():
     parser.add_argument('--hidden-dim', type=int, default=650, metavar='N', help='hidden dimension')
 
     parser.add_argument('--beam-file', type=str, default='preds.csv', help='beam outputs file')
+    parser.add_argument('--rerank-batch-frames', type=int, default=20000, metavar='N', help='characters per discriminator batch when reranking')
+    parser.add_argument('--rerank-processes', type=int, default=1, metavar='N', help='CPU worker processes for reranking')
 
     return parser.parse_args()
 
@@ -119,11 +121,11 @@ def main():
         model.train()
         optimizer.zero_grad()
         l = 0
-        for i, (xs, ys) in enumerate(train_loader):
+        for i, (xs, lens, ys) in enumerate(train_loader):
             xs, ys = Variable(xs), Variable(ys)
             if torch.cuda.is_available():
                 xs, ys = xs.cuda(args.cuda), ys.cuda(args.cuda)
-            logits = model(xs)
+            logits = model(xs, lens)
             loss = criterion(logits, ys)
             l += loss.item()
             loss.backward()
@@ -139,11 +141,11 @@ def main():
         with torch.no_grad():
             l = 0
             num_correct = 0.0
-            for i, (xs, ys) in enumerate(dev_loader):
+            for i, (xs, lens, ys) in enumerate(dev_loader):
                 xs, ys = Variable(xs), Variable(ys)
                 if torch.cuda.is_available():
                     xs, ys = xs.cuda(args.cuda), ys.cuda(args.cuda)
-                logits = model(xs)
+                logits = model(xs, lens)
                 loss = criterion(logits, ys)
                 _, y_pred = torch.max(logits, 1)
                 l += loss.item()
@@ -0,0 +1,50 @@
+'''
+Length-bucketed batch sampler for the DataLoaders of the experiment scripts
+
+Shared by the experiment directories, which put src/ on sys.path
+'''
+
+import math
+import numpy as np
+
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    '''Batches utterances of similar length and shards the batches over replicas
+
+    Like DistributedSampler, every replica gets the same number of batches (some
+    are repeated to even out the split, see is_repeat) and set_epoch should be
+    called at the start of each epoch so that all replicas shuffle the same way.
+    With the default single replica, the fixed batches are just reshuffled every
+    epoch
+    '''
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0):
+        order = np.argsort(lengths, kind='stable')
+        self.batches = [order[i:i+batch_size].tolist() for i in range(0, len(order), batch_size)]
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = int(math.ceil(len(self.batches) / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        batches = list(self.batches)
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        total = self.num_batches * self.num_replicas
+        while len(batches) < total:
+            batches += batches[:total - len(batches)]
+        return iter(batches[self.rank:total:self.num_replicas])
+
+    def __len__(self):
+        return self.num_batches
+
+    def is_repeat(self, i):
+        # whether this replica's i-th batch only pads the split, so metrics can skip it
+        return self.rank + i * self.num_replicas >= len(self.batches)
@@ -0,0 +1,208 @@
+'''
+Edit distance scoring for CER, WER and MER
+
+Sequences are compared as integer codes (characters by code point, words
+through a shared vocabulary). Single pairs use the bit-parallel Levenshtein
+algorithm, lists of pairs can be spread over a process pool, and batches of
+equal-sized work can use a NumPy dynamic program. All distances are identical
+to nltk.metrics.edit_distance with its default unit costs (see tests/)
+
+Shared by the experiment directories, which put src/ on sys.path
+'''
+
+import itertools
+import multiprocessing as mp
+import numpy as np
+
+
+def encode(seq):
+    # strings by character code point, int sequences unchanged
+    return [ord(c) for c in seq] if isinstance(seq, str) else list(seq)
+
+
+def encode_words(lines, vocab=None):
+    '''Maps whitespace-separated words to int codes for WER
+
+    Args:
+        lines: list of strings
+        vocab: {word: int}, extended in place with unseen words
+
+    Return:
+        list of int lists, vocab
+    '''
+    if vocab is None:
+        vocab = {}
+    encoded = []
+    for l in lines:
+        encoded.append([vocab.setdefault(w, len(vocab)) for w in l.split()])
+    return encoded, vocab
+
+
+def levenshtein(a, b):
+    '''Bit-parallel Levenshtein distance (Myers 1999, in Hyyro's formulation)
+
+    Python ints act as bit vectors over the positions of b, so every character
+    of a costs a constant number of integer operations regardless of len(b)
+
+    Args:
+        a, b: strings or int sequences
+    '''
+    a, b = encode(a), encode(b)
+    m = len(b)
+    if m == 0:
+        return len(a)
+    peq = {}
+    for i, c in enumerate(b):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for c in a:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
+def pair_distances(pairs):
+    return [levenshtein(a, b) for a, b in pairs]
+
+
+def edit_distances(hyps, refs, processes=1, chunk_size=2000):
+    '''Levenshtein distances for lists of pairs, optionally over a process pool
+
+    Args:
+        hyps: list of strings or int sequences
+        refs: list of strings or int sequences
+        processes: worker processes (1 computes in this process)
+
+    Return:
+        list of ints
+    '''
+    pairs = list(zip(hyps, refs))
+    if processes <= 1 or len(pairs) <= chunk_size:
+        return pair_distances(pairs)
+    chunks = [pairs[i:i+chunk_size] for i in range(0, len(pairs), chunk_size)]
+    with mp.Pool(processes) as pool:
+        return list(itertools.chain.from_iterable(pool.map(pair_distances, chunks)))
+
+
+def batch_edit_distance(hyps, refs):
+    '''Levenshtein distances for a batch of sequence pairs
+
+    Runs the dynamic program one hypothesis position at a time for the whole
+    batch, resolving insertions within a row with a cumulative minimum
+
+    Args:
+        hyps: list of strings or int sequences
+        refs: list of strings or int sequences
+
+    Return:
+        dists: int np array of shape (B,)
+    '''
+    n = len(hyps)
+    hyp_lens = np.array([len(h) for h in hyps], dtype=np.int64)
+    ref_lens = np.array([len(r) for r in refs], dtype=np.int64)
+    max_h = int(hyp_lens.max()) if n > 0 else 0
+    max_r = int(ref_lens.max()) if n > 0 else 0
+    # padding values differ so that padding never matches
+    hyp = np.full((n, max_h), -1, dtype=np.int64)
+    ref = np.full((n, max_r), -2, dtype=np.int64)
+    for b in range(n):
+        hyp[b, :hyp_lens[b]] = encode(hyps[b])
+        ref[b, :ref_lens[b]] = encode(refs[b])
+    cols = np.arange(max_r + 1)
+    row = np.tile(cols, (n, 1)) # shape: (B, max_r+1)
+    dists = row[np.arange(n), ref_lens]
+    for i in range(max_h):
+        new_row = np.empty_like(row)
+        new_row[:, 0] = i + 1
+        new_row[:, 1:] = np.minimum(row[:, :-1] + (hyp[:, i:i+1] != ref), row[:, 1:] + 1)
+        row = np.minimum.accumulate(new_row - cols, axis=1) + cols
+        done = hyp_lens == i + 1
+        dists[done] = row[done, ref_lens[done]]
+    return dists
+
+
+def align(hyp, ref):
+    '''Edit distance with the operation counts of one optimal alignment
+
+    Ties are broken towards substitutions, then deletions, then insertions
+
+    Return:
+        dist, substitutions, insertions (extra hyp tokens), deletions (missing ref tokens)
+    '''
+    hyp, ref = encode(hyp), encode(ref)
+    n, m = len(hyp), len(ref)
+    d = [list(range(m + 1))]
+    for i in range(1, n + 1):
+        row = [i] + [0] * m
+        prev = d[-1]
+        for j in range(1, m + 1):
+            row[j] = min(prev[j-1] + (hyp[i-1] != ref[j-1]), prev[j] + 1, row[j-1] + 1)
+        d.append(row)
+    subs = ins = dels = 0
+    i, j = n, m
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and d[i][j] == d[i-1][j-1] + (hyp[i-1] != ref[j-1]):
+            subs += hyp[i-1] != ref[j-1]
+            i, j = i - 1, j - 1
+        elif j > 0 and d[i][j] == d[i][j-1] + 1:
+            dels += 1
+            j -= 1
+        else:
+            ins += 1
+            i -= 1
+    return d[n][m], subs, ins, dels
+
+
+def error_rates(transcripts, ys, truncate=True, spaces='best', processes=1):
+    '''Normalized and raw edit distances, as computed by cer_from_transcripts
+
+    Args:
+        transcripts: list of strings (or of word-mapped strings for WER and MER)
+        ys: list of reference strings
+        truncate: cut each transcript to the length of its reference
+        spaces: no, yes, best (to account for incongruity in raw data spacing)
+
+    Return:
+        norm_dists: list of floats
+        dists: list of ints
+    '''
+    hyps, refs, hyps_nos, refs_nos = [], [], [], []
+    for t, y in zip(transcripts, ys):
+        t_nos = t.replace(' ', '')
+        y_nos = y.replace(' ', '')
+        if truncate:
+            t = t[:len(y)]
+            t_nos = t_nos[:len(y_nos)]
+        hyps.append(t)
+        refs.append(y)
+        hyps_nos.append(t_nos)
+        refs_nos.append(y_nos)
+    norm_dists = []
+    dists = []
+    if spaces != 'no':
+        spaced = edit_distances(hyps, refs, processes=processes)
+    if spaces != 'yes':
+        nos = edit_distances(hyps_nos, refs_nos, processes=processes)
+    for i in range(len(refs)):
+        candidates = []
+        if spaces != 'no':
+            candidates.append((spaced[i], spaced[i] / len(refs[i])))
+        if spaces != 'yes':
+            candidates.append((nos[i], nos[i] / len(refs_nos[i])))
+        dists.append(min(c[0] for c in candidates))
+        norm_dists.append(min(c[1] for c in candidates))
+    return norm_dists, dists
+
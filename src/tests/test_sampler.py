@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('numpy')
+
+from sampler import BucketBatchSampler
+
+
+def test_single_replica_reshuffles_fixed_batches():
+    lengths = [5, 1, 9, 3, 7, 2, 8]
+    sampler = BucketBatchSampler(lengths, 3, seed=1)
+    sampler.set_epoch(0)
+    first = list(sampler)
+    sampler.set_epoch(1)
+    second = list(sampler)
+    assert len(sampler) == 3
+    assert sorted(first) == sorted(second) == sorted(sampler.batches)
+    assert sorted(i for b in first for i in b) == list(range(len(lengths)))
+    for b in first:
+        assert max(lengths[i] for i in b) - min(lengths[i] for i in b) <= 4
+    assert not any(sampler.is_repeat(i) for i in range(len(sampler)))
+
+
+def test_replicas_get_equal_shares():
+    lengths = list(range(10))
+    samplers = [BucketBatchSampler(lengths, 2, num_replicas=3, rank=r) for r in range(3)]
+    shares = [list(s) for s in samplers]
+    assert [len(s) for s in shares] == [2, 2, 2]
+    counted = [b for s, share in zip(samplers, shares) for i, b in enumerate(share) if not s.is_repeat(i)]
+    assert sorted(counted) == sorted(samplers[0].batches)
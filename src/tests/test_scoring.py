@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+pytest.importorskip('numpy')
+nltk = pytest.importorskip('nltk')
+
+from scoring import align, batch_edit_distance, edit_distances, encode_words, error_rates, levenshtein
+
+
+def random_pairs(n=500, seed=0):
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(n):
+        alphabet = 'abc d' if rng.random() < 0.5 else 'abcdefghij我你他 '
+        a = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 80)))
+        b = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 80)))
+        pairs.append((a, b))
+    # edge cases, and lengths past one machine word for the bit vectors
+    pairs += [('', ''), ('', 'abc'), ('abc', ''), ('a' * 150, 'ab' * 70), ('kitten', 'sitting')]
+    return pairs
+
+
+PAIRS = random_pairs()
+EXPECTED = [nltk.edit_distance(a, b) for a, b in PAIRS]
+
+
+def test_levenshtein():
+    assert [levenshtein(a, b) for a, b in PAIRS] == EXPECTED
+
+
+def test_edit_distances_pool():
+    hyps, refs = [p[0] for p in PAIRS], [p[1] for p in PAIRS]
+    assert edit_distances(hyps, refs) == EXPECTED
+    assert edit_distances(hyps, refs, processes=2, chunk_size=100) == EXPECTED
+
+
+def test_batch_edit_distance():
+    hyps, refs = [p[0] for p in PAIRS], [p[1] for p in PAIRS]
+    assert batch_edit_distance(hyps, refs).tolist() == EXPECTED
+
+
+def test_align():
+    for (a, b), dist in zip(PAIRS, EXPECTED):
+        d, subs, ins, dels = align(a, b)
+        assert d == dist == subs + ins + dels
+        assert len(a) - ins == len(b) - dels
+
+
+def test_words():
+    hyps = ['the cat sat', 'a b c d', '']
+    refs = ['the cat sat down', 'a c d e', 'x y']
+    enc_hyps, vocab = encode_words(hyps)
+    enc_refs, vocab = encode_words(refs, vocab)
+    expected = [nltk.edit_distance(h.split(), r.split()) for h, r in zip(hyps, refs)]
+    assert edit_distances(enc_hyps, enc_refs) == expected
+
+
+def test_error_rates():
+    hyps = ['ab cd', 'abcd', 'xyz']
+    refs = ['abcd', 'ab cd', 'xy']
+    norm_dists, dists = error_rates(hyps, refs, truncate=False, spaces='yes')
+    assert dists == [nltk.edit_distance(h, r) for h, r in zip(hyps, refs)]
+    assert norm_dists == [d / len(r) for d, r in zip(dists, refs)]
+    norm_dists, dists = error_rates(hyps, refs, truncate=False, spaces='best')
+    assert dists == [0, 0, 1]
@@ -0,0 +1,21 @@
+from vocab_index import VocabIndex, closest_words
+
+
+def test_closest_word():
+    index = VocabIndex(['cat', 'cart', 'dog', 'house'])
+    assert index.closest_word('cot') == 'cat'
+    assert index.closest_word('catdog', threshold=1, sub_thres=1) == 'cat dog'
+
+
+def test_cache_keeps_thresholds_apart():
+    index = VocabIndex(['cat', 'dog'])
+    assert index.closest_word('catdog', threshold=5) == 'cat'
+    assert index.closest_word('catdog', threshold=1, sub_thres=1) == 'cat dog'
+    assert index.closest_word('catdog', threshold=5) == 'cat'
+
+
+def test_closest_words_pool():
+    index = VocabIndex(['cat', 'dog', 'house'])
+    words = ['cot', 'dgo', 'hous', 'catdog']
+    expected = [VocabIndex(['cat', 'dog', 'house']).closest_word(w, 1, 1) for w in words]
+    assert closest_words(index, words, processes=2, threshold=1, sub_thres=1) == expected
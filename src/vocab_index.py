@@ -0,0 +1,144 @@
+'''
+Nearest-vocabulary lookup for the autocorrect step of WER/MER scoring
+
+VocabIndex is a BK-tree over the vocabulary under Levenshtein distance, so a
+query only computes distances to the words the triangle inequality cannot rule
+out instead of scanning the whole vocabulary. closest_word answers whole-word
+and two-word-split queries with the rules of the original linear scan, taking
+the vocabulary in sorted order (or in the given order with sort=False)
+'''
+
+import hashlib
+import multiprocessing as mp
+import os
+import pickle
+
+from scoring import levenshtein
+
+
+class VocabIndex(object):
+    def __init__(self, vocab, sort=True):
+        self.words = sorted(vocab) if sort else list(vocab)
+        self.root = None # node: [word index, {distance: child node}]
+        for i in range(len(self.words)):
+            self.add(i)
+        self.cache = {}
+
+    def add(self, i):
+        node = [i, {}]
+        if self.root is None:
+            self.root = node
+            return
+        curr = self.root
+        while True:
+            dist = levenshtein(self.words[i], self.words[curr[0]])
+            child = curr[1].get(dist)
+            if child is None:
+                curr[1][dist] = node
+                return
+            curr = child
+
+    def nearest(self, query, max_dist=float('inf')):
+        '''Finds every vocabulary word at the minimum distance from query
+
+        Return:
+            dist: minimum distance (max_dist if nothing is within max_dist)
+            idxs: sorted indices into self.words of the words at that distance
+        '''
+        best = max_dist
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            i, children = stack.pop()
+            dist = levenshtein(query, self.words[i])
+            if dist < best:
+                best = dist
+                found = [i]
+            elif dist == best:
+                found.append(i)
+            for k, child in children.items():
+                if dist - best <= k <= dist + best:
+                    stack.append(child)
+        return best, sorted(found)
+
+    def closest_word(self, word, threshold=5, sub_thres=2):
+        '''Finds closest word in the vocabulary (w.r.t. edit distance)
+
+        Among the words at the minimum distance, a later word replaces the
+        current choice only if its length is closer to word's and it shares a
+        longer prefix with word. If the best distance is above threshold, word
+        is split in two and each half is matched separately (the first half
+        must be within sub_thres)
+
+        Returns 2 words if no closest word found
+        '''
+        key = (word, threshold, sub_thres)
+        if key in self.cache:
+            return self.cache[key]
+        best_word = word
+        best_dist, found = self.nearest(word)
+        if found:
+            best_word = self.words[found[0]]
+            prefix_len_best = len(os.path.commonprefix([word, best_word]))
+            for i in found[1:]:
+                vocab_word = self.words[i]
+                if abs(len(best_word)-len(word)) > abs(len(vocab_word)-len(word)):
+                    prefix_len_vocab = len(os.path.commonprefix([word, vocab_word]))
+                    if prefix_len_best < prefix_len_vocab:
+                        best_word = vocab_word
+                        prefix_len_best = prefix_len_vocab
+        if best_dist > threshold:
+            for i in range(len(word)-1):
+                dist1, found1 = self.nearest(word[:i+1], max_dist=sub_thres)
+                if not found1:
+                    continue
+                dist2, found2 = self.nearest(word[i+1:])
+                if dist1 + dist2 < best_dist:
+                    best_word = self.words[found1[0]]+' '+self.words[found2[0]]
+                    best_dist = dist1 + dist2
+        self.cache[key] = best_word
+        return best_word
+
+    @staticmethod
+    def load_or_build(vocab, cache_dir, sort=True, name='vocab_index'):
+        '''Loads the index for vocab from cache_dir, building and saving it if missing'''
+        words = sorted(vocab) if sort else list(vocab)
+        key = hashlib.sha1('\n'.join(words).encode('utf-8')).hexdigest()[:16]
+        path = os.path.join(cache_dir, '%s_%s.pkl' % (name, key))
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        index = VocabIndex(words, sort=False)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb+') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return index
+
+
+worker_index = None
+worker_thresholds = None
+
+
+def init_worker(index, threshold, sub_thres):
+    global worker_index, worker_thresholds
+    worker_index = index
+    worker_thresholds = (threshold, sub_thres)
+
+
+def worker_closest_word(word):
+    return worker_index.closest_word(word, *worker_thresholds)
+
+
+def closest_words(index, words, processes=1, threshold=5, sub_thres=2):
+    '''closest_word for a list of words, spreading unseen words over a process pool
+
+    Return:
+        list of strings, one per word
+    '''
+    unseen = sorted(set(w for w in words if (w, threshold, sub_thres) not in index.cache))
+    if processes > 1 and len(unseen) > 1:
+        with mp.Pool(processes, initializer=init_worker, initargs=(index, threshold, sub_thres)) as pool:
+            results = pool.map(worker_closest_word, unseen, chunksize=max(len(unseen) // (4*processes), 1))
+        index.cache.update(((w, threshold, sub_thres), r) for w, r in zip(unseen, results))
+    return [index.closest_word(w, threshold, sub_thres) for w in words]